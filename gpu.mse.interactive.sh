@@ -43,7 +43,7 @@ python $PROJECT_DIR/interactive_mse.py \
   --gv2i ${L2_DATA}/${L1_DATA_NAME}/l2.v2idx.pkl \
   --cloze_model $TRAINED_MODEL \
   --key ${L2_DATA}/${L1_DATA_NAME}/l1.l2.key.pkl \
-  --per_line_key ${L2_DATA}/${L1_DATA_NAME}/per_line.l1.l2.key.pkl \
+  --per_line_key ${L2_DATA}/${L1_DATA_NAME}/per_line.l1.l2.key.offsets.npy \
   --use_per_line_key $USE_PER_LINE_KEY \
   --beam_size $BEAM_SIZE \
   --swap_limit $SWAP_LIMIT \
@@ -17,6 +17,8 @@ from search_mse import apply_swap
 from search_mse import nearest_neighbors
 
 from src.utils.utils import ParallelTextDataset
+from src.utils.utils import PerLineKeys
+from src.utils.bundle import ArtifactBundle
 from src.utils.utils import SPECIAL_TOKENS
 from src.utils.utils import TEXT_EFFECT
 
@@ -41,6 +43,11 @@ if __name__ == '__main__':
     opt.add_argument('--l2_init_weights', action='store', dest='l2_init_weights', required=False, default="")
     opt.add_argument('--key', action='store', dest='key', required=True)
     opt.add_argument('--per_line_key', action='store', dest='per_line_key', required=True)
+    opt.add_argument('--bundle', action='store', dest='bundle', required=False, default=None,
+                     help='artifact bundle from preprocess.py --bundle, the files named by the vocab/key/matrix flags are read from it')
+    opt.add_argument('--precision', action='store', dest='precision', default='fp32',
+                     choices=['fp32', 'bf16'],
+                     help='bf16 runs the cloze model forward under autocast, weights and updates stay fp32')
     opt.add_argument('--stochastic', action='store', dest='stochastic', default=0, type=int, choices=[0, 1])
     opt.add_argument('--beam_size', action='store', dest='beam_size', default=10, type=int)
     opt.add_argument('--swap_limit', action='store', dest='swap_limit', default=0.3, type=float)
@@ -70,20 +77,21 @@ if __name__ == '__main__':
     else:
         print("using CPU")
 
-    v2i = pickle.load(open(options.v2i, 'rb'))
-    i2v = dict((v, k) for k, v in v2i.items())
-    gv2i = pickle.load(open(options.gv2i, 'rb')) if options.gv2i is not None else None
-    i2gv = dict((v, k) for k, v in gv2i.items())
-    l1_key, l2_key = zip(*pickle.load(open(options.key, 'rb')))
-    l2_key = torch.LongTensor(list(l2_key))
-    l1_key = torch.LongTensor(list(l1_key))
-    pkl_list = pickle.load(open(options.per_line_key, 'rb'))
-    per_line_key = []
-    for pkl in pkl_list:
-        l2_k, l1_k = zip(*pkl)
-        torch.LongTensor(list(l2_k))
-        torch.LongTensor(list(l1_k))
-        per_line_key.append((torch.LongTensor(list(l2_k)), torch.LongTensor(list(l1_k))))
+    bundle = ArtifactBundle(options.bundle) if options.bundle is not None else None
+    if bundle is not None:
+        v2i, i2v = bundle.vocab(options.v2i)
+        gv2i, i2gv = bundle.vocab(options.gv2i)
+        l1_key, l2_key = bundle.key(options.key)
+        per_line_key = bundle.per_line_keys(options.per_line_key)
+    else:
+        v2i = pickle.load(open(options.v2i, 'rb'))
+        i2v = dict((v, k) for k, v in v2i.items())
+        gv2i = pickle.load(open(options.gv2i, 'rb')) if options.gv2i is not None else None
+        i2gv = dict((v, k) for k, v in gv2i.items())
+        l1_key, l2_key = zip(*pickle.load(open(options.key, 'rb')))
+        l2_key = torch.LongTensor(list(l2_key))
+        l1_key = torch.LongTensor(list(l1_key))
+        per_line_key = PerLineKeys(options.per_line_key)
 
     dataset = ParallelTextDataset(options.parallel_corpus, v2i, gv2i)
     v_max_vocab = len(v2i)
@@ -96,7 +104,10 @@ if __name__ == '__main__':
         l2_encoder.weight.data[:] = 0.0
     else:
         print('using l2_init_weights from ' + options.l2_init_weights)
-        l2_init_weights = torch.load(options.l2_init_weights)
+        if bundle is not None and options.l2_init_weights in bundle:
+            l2_init_weights = bundle.array(options.l2_init_weights)
+        else:
+            l2_init_weights = torch.load(options.l2_init_weights)
         l2_encoder = make_wl_encoder(None, None, l2_init_weights)
         pdb.set_trace()
     cloze_model = L2_MSE_CLOZE(encoder=l1_cloze_model.encoder,
@@ -111,6 +122,7 @@ if __name__ == '__main__':
                                ortho_mode=l1_cloze_model.ortho_mode)
     if options.gpuid > -1:
         cloze_model.init_cuda()
+    cloze_model.set_precision(options.precision)
     cloze_model.init_key()
     #en_en_sim = batch_cosine_sim(cloze_model.encoder.weight.data.clone(),
     #                             cloze_model.encoder.weight.data.clone())
@@ -136,8 +148,7 @@ if __name__ == '__main__':
         not_swapped = set([])
         #swappable = set(range(1, l1_data[0, :].size(0) - 1))
         swappable = set([idx for idx, i in enumerate(l2_data[0, :]) if i != gv2i[SPECIAL_TOKENS.UNK]][1:-1])
-        line_l1_key = per_line_key[batch_idx][1]
-        line_l2_key = per_line_key[batch_idx][0]
+        line_l1_key, line_l2_key = per_line_key[batch_idx]
         macaronic_0 = MacaronicSentence(l1_tokens,
                                         l2_tokens,
                                         l1_data.clone(),
@@ -6,11 +6,40 @@ import fastText
 import pickle
 from src.preprocessing.preprocess_l1_corpus import Preprocess as Preprocess_L1
 from src.preprocessing.preprocess_l2_corpus import Preprocess as Preprocess_L2
-from src.preprocessing.preprocess_l1_corpus import load_word_vec
+from src.preprocessing.preprocess_l1_corpus import extract_word_vecs
 from src.preprocessing.dump_nn import save_nn_mat
+from src.preprocessing.compile_corpus import compile_corpus
+from src.utils.utils import find_corpus
+from src.utils.utils import load_mat
+from src.utils.utils import compiled_corpus_files
+from src.preprocessing.stage_cache import StageCache
+from src.utils.bundle import L1_VOCABS, L1_ARRAYS, L2_VOCABS, L2_ARRAYS
+from src.utils.bundle import collect_artifacts
+from src.utils.bundle import write_bundle
 import torch
 import editdistance
 
+L1_VOCAB_FILES = ['l1.vocab.pkl', 'l1.v2idx.pkl', 'l1.idx2v.pkl', 'l1.vidx2unigram_prob.pkl'] + \
+                 ['l1.vidx2c{}gram_spelling.npy'.format(n) for n in range(1, 5)] + \
+                 ['l1.c{}gram2idx.pkl'.format(n) for n in range(1, 5)]
+
+
+def build_l1_vectors(args, l1_data_dir, l1_v2idx):
+    print("loading word_vec_bin...")
+    extract_word_vecs(fastText.load_model(args.word_vec_bin), sorted(l1_v2idx, key=l1_v2idx.get),
+                      os.path.join(l1_data_dir, 'l1.mat.npy'), num_workers=args.num_workers)
+    torch.save(load_mat(os.path.join(l1_data_dir, 'l1.mat.npy')), os.path.join(l1_data_dir, 'l1.mat.pt'))
+
+
+def build_l1_vocab(args, l1_data_dir, corpus_file, dev_file):
+    Preprocess_L1().build(data_dir=l1_data_dir,
+                          corpus_file=corpus_file,
+                          dev_file=dev_file,
+                          max_word_len=args.max_word_len,
+                          max_vocab=args.max_vocab,
+                          num_workers=args.num_workers)
+
+
 if __name__ == '__main__':
     opt = argparse.ArgumentParser(description="write program description here")
 
@@ -29,27 +58,57 @@ if __name__ == '__main__':
                      default='/export/b07/arenduc1/macaronic-multi-agent/lmdata', required=False)
     opt.add_argument('--aligned_data', action='store', dest='aligned_data',
                      default='/export/b07/arenduc1/macaronic-multi-agent/aligned_data', required=False)
+    opt.add_argument('--num_workers', action='store', dest='num_workers',
+                     default=1, type=int, required=False,
+                     help='processes for l1 vocab counting and the l2 edit distance search')
+    opt.add_argument('--nn_index', action='store', dest='nn_index', default='exact', choices=['exact', 'ivf'],
+                     help='index used for the l1 nearest neighbor table (l1.nn.pt)')
+    opt.add_argument('--nn_nprobe', action='store', dest='nn_nprobe', default=16, type=int,
+                     help='ivf buckets searched per word, higher is slower with better recall')
+    opt.add_argument('--nn_precision', action='store', dest='nn_precision', default='fp32',
+                     choices=['fp32', 'bf16', 'fp16'],
+                     help='exact nn_index scan precision, candidates are re-ranked in fp32')
+    opt.add_argument('--compile_corpus', action='store_true', dest='compile_corpus', required=False, default=False,
+                     help='also write memory-mappable token id files for the corpora (see --corpus_format mmap)')
+    opt.add_argument('--bundle', action='store_true', dest='bundle', required=False, default=False,
+                     help='also write the vocabs, keys, matrices and spellings into one memory-mappable file, '
+                          'l1.bundle (l1 outputs) and l1.l2.bundle (l1 and l2 outputs), see --bundle in the train/search scripts')
+    opt.add_argument('--rebuild', action='store_true', dest='rebuild', required=False, default=False,
+                     help='rerun every stage, by default stages whose inputs and settings did not change are skipped')
     args = opt.parse_args()
     print(args)
 
     if args.do_l1:
         print("l1 preprocessing...")
-        preprocess_l1 = Preprocess_L1()
-        corpus_file = os.path.join(args.lmdata, args.l1_data_name, 'corpus.en')
-        dev_file = os.path.join(args.lmdata, args.l1_data_name, 'dev.en')
-        l1_v2idx = preprocess_l1.build(data_dir=os.path.join(args.lmdata, args.l1_data_name),
-                                       corpus_file=corpus_file,
-                                       dev_file=dev_file,
-                                       max_word_len=args.max_word_len,
-                                       max_vocab=args.max_vocab)
-        print("loading word_vec_bin...")
-        embedding = load_word_vec(args.word_vec_bin, l1_v2idx)
-        torch.save(embedding, os.path.join(args.lmdata, args.l1_data_name, 'l1.mat.pt'))
+        l1_data_dir = os.path.join(args.lmdata, args.l1_data_name)
+        l1_file = lambda name: os.path.join(l1_data_dir, name)
+        cache = StageCache(l1_file('stage_cache.json'), force=args.rebuild)
+        corpus_file = find_corpus(l1_file('corpus.en'))
+        dev_file = find_corpus(l1_file('dev.en'))
+        cache.run('l1.vocab', [corpus_file, dev_file], {'max_word_len': args.max_word_len, 'max_vocab': args.max_vocab},
+                  [l1_file(f) for f in L1_VOCAB_FILES],
+                  lambda: build_l1_vocab(args, l1_data_dir, corpus_file, dev_file))
+        l1_v2idx = pickle.load(open(l1_file('l1.v2idx.pkl'), 'rb'))
+        cache.run('l1.vectors', [l1_file('l1.v2idx.pkl'), args.word_vec_bin], {},
+                  [l1_file('l1.mat.npy'), l1_file('l1.mat.pt')],
+                  lambda: build_l1_vectors(args, l1_data_dir, l1_v2idx))
 
         # getting nearest neighbors for l1 word embeddings and saving them
-        l1_mat = torch.load(os.path.join(args.lmdata, args.l1_data_name, 'l1.mat.pt'))
-        idx2v = pickle.load(open(os.path.join(args.lmdata, args.l1_data_name, 'l1.idx2v.pkl'), 'rb'))
-        save_nn_mat(l1_mat, idx2v, os.path.join(args.lmdata, args.l1_data_name))
+        nn_args = {'nprobe': args.nn_nprobe} if args.nn_index == 'ivf' else {'precision': args.nn_precision}
+        cache.run('l1.nn', [l1_file('l1.mat.npy'), l1_file('l1.idx2v.pkl')], dict(index=args.nn_index, **nn_args),
+                  [l1_file('l1.nn.pt'), l1_file('l1.nn.txt')],
+                  lambda: save_nn_mat(load_mat(l1_file('l1.mat.npy')),
+                                      pickle.load(open(l1_file('l1.idx2v.pkl'), 'rb')),
+                                      l1_data_dir, args.nn_index, num_workers=args.num_workers, **nn_args))
+        if args.compile_corpus:
+            for text_file in [corpus_file, dev_file]:
+                if os.path.exists(text_file):
+                    cache.run('l1.compile.' + os.path.basename(text_file), [text_file, l1_file('l1.v2idx.pkl')], {},
+                              list(compiled_corpus_files(text_file).values()),
+                              lambda: compile_corpus(text_file, l1_v2idx, text_file))
+        if args.bundle:
+            vocabs, arrays = collect_artifacts([l1_data_dir], L1_VOCABS, L1_ARRAYS)
+            write_bundle(l1_file('l1.bundle'), vocabs, arrays, {'l1_data_dir': l1_data_dir})
     else:
         print("skip_l1 preprocessing...")
 
@@ -60,12 +119,27 @@ if __name__ == '__main__':
         print("loading word_vec_bin...")
         ft_model = None #fastText.load_model(args.word_vec_bin)
         print("building...")
+        cache = StageCache(os.path.join(save_dir, 'stage_cache.json'), force=args.rebuild)
         l2_v2idx = preprocess_l2.build(l1_data_dir=os.path.join(args.lmdata, args.l1_data_name),
                                        l2_data_dir=os.path.join(args.aligned_data, args.l2_data_name),
                                        l2_save_dir=save_dir,
                                        ft_model=ft_model,
-                                       max_word_len=args.max_word_len)
+                                       max_word_len=args.max_word_len,
+                                       num_workers=args.num_workers,
+                                       cache=cache)
         l1_v2idx = pickle.load(open(os.path.join(args.lmdata, args.l1_data_name, 'l1.v2idx.pkl'), 'rb'))
+        if args.compile_corpus:
+            parallel_corpus = find_corpus(os.path.join(args.aligned_data, args.l2_data_name, 'parallel_corpus'))
+            cache.run('l2.compile', [parallel_corpus, os.path.join(args.lmdata, args.l1_data_name, 'l1.v2idx.pkl'),
+                                     os.path.join(save_dir, 'l2.v2idx.pkl')], {},
+                      list(compiled_corpus_files(os.path.join(save_dir, 'parallel_corpus')).values()),
+                      lambda: compile_corpus(parallel_corpus, l1_v2idx, os.path.join(save_dir, 'parallel_corpus'),
+                                             l2_v2idx=l2_v2idx))
+        if args.bundle:
+            l1_data_dir = os.path.join(args.lmdata, args.l1_data_name)
+            vocabs, arrays = collect_artifacts([l1_data_dir, save_dir], L1_VOCABS + L2_VOCABS, L1_ARRAYS + L2_ARRAYS)
+            write_bundle(os.path.join(save_dir, 'l1.l2.bundle'), vocabs, arrays,
+                         {'l1_data_dir': l1_data_dir, 'l2_data_dir': save_dir})
         #ed_mat = torch.zeros(len(l2_v2idx), len(l1_v2idx))
         #i = 0
         #for l2_v, l2_idx in l2_v2idx.items():
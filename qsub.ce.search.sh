@@ -70,16 +70,16 @@ python $PROJECT_DIR/search_ce.py \
   --parallel_corpus ${L2_DATA}/parallel_corpus \
   --v2i ${L1_DATA}/l1.v2idx.pkl \
   --l1_cgram2i $L1_DATA/l1.c1gram2idx.pkl,$L1_DATA/l1.c2gram2idx.pkl,$L1_DATA/l1.c3gram2idx.pkl,$L1_DATA/l1.c4gram2idx.pkl \
-  --l1_v2cgramspell $L1_DATA/l1.vidx2c1gram_spelling.pkl,$L1_DATA/l1.vidx2c2gram_spelling.pkl,$L1_DATA/l1.vidx2c3gram_spelling.pkl,$L1_DATA/l1.vidx2c4gram_spelling.pkl \
+  --l1_v2cgramspell $L1_DATA/l1.vidx2c1gram_spelling.npy,$L1_DATA/l1.vidx2c2gram_spelling.npy,$L1_DATA/l1.vidx2c3gram_spelling.npy,$L1_DATA/l1.vidx2c4gram_spelling.npy \
   --gv2i ${L2_DATA}/${L1_DATA_NAME}/l2.v2idx.pkl \
   --l2_cgram2i ${L2_DATA}/${L1_DATA_NAME}/l2.c1gram2idx.pkl,${L2_DATA}/${L1_DATA_NAME}/l2.c2gram2idx.pkl,${L2_DATA}/${L1_DATA_NAME}/l2.c3gram2idx.pkl,${L2_DATA}/${L1_DATA_NAME}/l2.c4gram2idx.pkl \
-  --l2_v2cgramspell ${L2_DATA}/${L1_DATA_NAME}/l2.vidx2c1gram_spelling.pkl,${L2_DATA}/${L1_DATA_NAME}/l2.vidx2c2gram_spelling.pkl,${L2_DATA}/${L1_DATA_NAME}/l2.vidx2c3gram_spelling.pkl,${L2_DATA}/${L1_DATA_NAME}/l2.vidx2c4gram_spelling.pkl \
-  --l2_v2cgramspell_by_l1 ${L2_DATA}/${L1_DATA_NAME}/l2.vidx2c1gram_by_l1_spelling.pkl,${L2_DATA}/${L1_DATA_NAME}/l2.vidx2c2gram_by_l1_spelling.pkl,${L2_DATA}/${L1_DATA_NAME}/l2.vidx2c3gram_by_l1_spelling.pkl,${L2_DATA}/${L1_DATA_NAME}/l2.vidx2c4gram_by_l1_spelling.pkl \
+  --l2_v2cgramspell ${L2_DATA}/${L1_DATA_NAME}/l2.vidx2c1gram_spelling.npy,${L2_DATA}/${L1_DATA_NAME}/l2.vidx2c2gram_spelling.npy,${L2_DATA}/${L1_DATA_NAME}/l2.vidx2c3gram_spelling.npy,${L2_DATA}/${L1_DATA_NAME}/l2.vidx2c4gram_spelling.npy \
+  --l2_v2cgramspell_by_l1 ${L2_DATA}/${L1_DATA_NAME}/l2.vidx2c1gram_by_l1_spelling.npy,${L2_DATA}/${L1_DATA_NAME}/l2.vidx2c2gram_by_l1_spelling.npy,${L2_DATA}/${L1_DATA_NAME}/l2.vidx2c3gram_by_l1_spelling.npy,${L2_DATA}/${L1_DATA_NAME}/l2.vidx2c4gram_by_l1_spelling.npy \
   --cloze_model $TRAINED_MODEL \
   --key ${L2_DATA}/${L1_DATA_NAME}/l1.l2.key.pkl \
   --key_wt ${L2_DATA}/${L1_DATA_NAME}/l2.key.wt.pkl \
   --use_key_wt $IDF \
-  --per_line_key ${L2_DATA}/${L1_DATA_NAME}/per_line.l1.l2.key.pkl \
+  --per_line_key ${L2_DATA}/${L1_DATA_NAME}/per_line.l1.l2.key.offsets.npy \
   --use_per_line_key $USE_PER_LINE_KEY \
   --beam_size $BEAM_SIZE \
   --swap_limit $SWAP_LIMIT \
@@ -53,9 +53,9 @@ python $PROJECT_DIR/train_ce.py \
   --loss_at $LOSS_AT \
   --epochs $EPOCHS \
   --v2i $L1_DATA/l1.v2idx.pkl \
-  --vmat $L1_DATA/l1.mat.pt \
+  --vmat $L1_DATA/l1.mat.npy \
   --cgram2i $L1_DATA/l1.c1gram2idx.pkl,$L1_DATA/l1.c2gram2idx.pkl,$L1_DATA/l1.c3gram2idx.pkl,$L1_DATA/l1.c4gram2idx.pkl \
-  --v2cgramspell $L1_DATA/l1.vidx2c1gram_spelling.pkl,$L1_DATA/l1.vidx2c2gram_spelling.pkl,$L1_DATA/l1.vidx2c3gram_spelling.pkl,$L1_DATA/l1.vidx2c4gram_spelling.pkl \
+  --v2cgramspell $L1_DATA/l1.vidx2c1gram_spelling.npy,$L1_DATA/l1.vidx2c2gram_spelling.npy,$L1_DATA/l1.vidx2c3gram_spelling.npy,$L1_DATA/l1.vidx2c4gram_spelling.npy \
   --seed $SEED \
   --use_early_stop $USE_EARLY_STOP \
   --context_encoder $CONTEXT_ENCODER \
@@ -62,7 +62,7 @@ python $PROJECT_DIR/search_mse.py \
   --key ${L2_DATA}/${L1_DATA_NAME}/l1.l2.key.pkl \
   --key_wt ${L2_DATA}/${L1_DATA_NAME}/l2.key.wt.pkl \
   --use_key_wt 1 \
-  --per_line_key ${L2_DATA}/${L1_DATA_NAME}/per_line.l1.l2.key.pkl \
+  --per_line_key ${L2_DATA}/${L1_DATA_NAME}/per_line.l1.l2.key.offsets.npy \
   --use_per_line_key $USE_PER_LINE_KEY \
   --beam_size $BEAM_SIZE \
   --swap_limit $SWAP_LIMIT \
@@ -45,7 +45,7 @@ python $PROJECT_DIR/train_mse.py \
   --loss_at $LOSS_AT \
   --epochs $EPOCHS \
   --v2i $L1_DATA/l1.v2idx.pkl \
-  --vmat $L1_DATA/l1.mat.pt \
+  --vmat $L1_DATA/l1.mat.npy \
   --nn_mat $L1_DATA/l1.nn.pt \
   --v2spell $L1_DATA/l1.vidx2spelling.pkl \
   --c2i $L1_DATA/l1.c2idx.pkl \
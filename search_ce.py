@@ -10,14 +10,16 @@ import random
 
 from src.models.ce_model import CE_CLOZE
 from src.models.ce_model import L2_CE_CLOZE
-from src.models.ce_model import spell2mat
+from src.models.ce_model import load_spelling_mat
 from src.models.ce_model import TiedEncoderDecoder, CharTiedEncoderDecoder, CGramTiedEncoderDecoder
 from src.models.ce_model import make_l2_tied_encoder_decoder
 from src.models.model_untils import make_wl_encoder
 import time
 
 from src.utils.utils import ParallelTextDataset
+from src.utils.utils import MMapParallelTextDataset
 from src.utils.utils import SPECIAL_TOKENS
+from src.utils.bundle import ArtifactBundle
 
 from search_mse import beam_search_per_sentence, make_start_state, nearest_neighbors
 
@@ -38,6 +40,9 @@ if __name__ == '__main__':
     opt = argparse.ArgumentParser(description="write program description here")
     # insert options here
     opt.add_argument('--parallel_corpus', action='store', dest='parallel_corpus', required=True)
+    opt.add_argument('--corpus_format', action='store', dest='corpus_format', default='text',
+                     choices=['text', 'mmap'],
+                     help='mmap expects --parallel_corpus to be a prefix written by compile_corpus.py')
     opt.add_argument('--v2i', action='store', dest='v2i', required=True,
                      help='vocab to index pickle obj')
     opt.add_argument('--l1_v2cgramspell', action='store', dest='l1_v2cgramspell', required=True,
@@ -63,6 +68,13 @@ if __name__ == '__main__':
     opt.add_argument('--zero_reg', action='store', dest='zero_reg', required=True, type=float)
     opt.add_argument('--reg_type', action='store', dest='reg_type', required=True, type=str, choices=['mse', 'huber', 'l1'])
     opt.add_argument('--per_line_key', action='store', dest='per_line_key', required=True)
+    opt.add_argument('--bundle', action='store', dest='bundle', required=False, default=None,
+                     help='artifact bundle from preprocess.py --bundle, the files named by the vocab/key/matrix flags are read from it')
+    opt.add_argument('--precision', action='store', dest='precision', default='fp32',
+                     choices=['fp32', 'bf16'],
+                     help='bf16 runs the cloze model forward under autocast, weights and updates stay fp32')
+    opt.add_argument('--adaptive_softmax', action='store', dest='adaptive_softmax', default=0, type=int, choices=[0, 1],
+                     help='score l1 words in learn_step with the adaptive softmax the cloze model was trained with (train_ce.py --adaptive_softmax)')
     opt.add_argument('--stochastic', action='store', dest='stochastic', default=0, type=int, choices=[0, 1])
     opt.add_argument('--beam_size', action='store', dest='beam_size', default=10, type=int)
     opt.add_argument('--swap_limit', action='store', dest='swap_limit', default=0.3, type=float)
@@ -114,22 +126,32 @@ if __name__ == '__main__':
         search_output_json = None
         search_output_latex = None
 
-    v2i = pickle.load(open(options.v2i, 'rb'))
-    i2v = dict((v, k) for k, v in v2i.items())
-    #c2i = pickle.load(open(options.c2i, 'rb'))
-    #i2c = {v: k for k, v in c2i.items()}
-    gv2i = pickle.load(open(options.gv2i, 'rb')) if options.gv2i is not None else None
-    i2gv = dict((v, k) for k, v in gv2i.items())
-    #gc2i = pickle.load(open(options.gc2i, 'rb'))
-    #i2gc = {v: k for k, v in gc2i.items()}
-    l1_key, l2_key = zip(*pickle.load(open(options.key, 'rb')))
-    l2_key_wt = pickle.load(open(options.key_wt, 'rb'))
-    l2_key_wt = torch.FloatTensor(l2_key_wt)
+    bundle = ArtifactBundle(options.bundle) if options.bundle is not None else None
+    if bundle is not None:
+        v2i, i2v = bundle.vocab(options.v2i)
+        gv2i, i2gv = bundle.vocab(options.gv2i)
+        l1_key, l2_key = bundle.key(options.key)
+        l2_key_wt = bundle.array(options.key_wt).clone()
+    else:
+        v2i = pickle.load(open(options.v2i, 'rb'))
+        i2v = dict((v, k) for k, v in v2i.items())
+        #c2i = pickle.load(open(options.c2i, 'rb'))
+        #i2c = {v: k for k, v in c2i.items()}
+        gv2i = pickle.load(open(options.gv2i, 'rb')) if options.gv2i is not None else None
+        i2gv = dict((v, k) for k, v in gv2i.items())
+        #gc2i = pickle.load(open(options.gc2i, 'rb'))
+        #i2gc = {v: k for k, v in gc2i.items()}
+        l1_key, l2_key = zip(*pickle.load(open(options.key, 'rb')))
+        l2_key_wt = pickle.load(open(options.key_wt, 'rb'))
+        l2_key_wt = torch.FloatTensor(l2_key_wt)
+        l2_key = torch.LongTensor(list(l2_key))
+        l1_key = torch.LongTensor(list(l1_key))
     if options.use_key_wt == 0:
         l2_key_wt.fill_(1.0)
-    l2_key = torch.LongTensor(list(l2_key))
-    l1_key = torch.LongTensor(list(l1_key))
-    dataset = ParallelTextDataset(options.parallel_corpus, v2i, gv2i)
+    if options.corpus_format == 'mmap':
+        dataset = MMapParallelTextDataset(options.parallel_corpus)
+    else:
+        dataset = ParallelTextDataset(options.parallel_corpus, v2i, gv2i)
     v_max_vocab = len(v2i)
     g_max_vocab = len(gv2i)
     #load cgrams
@@ -137,15 +159,17 @@ if __name__ == '__main__':
     l1_cgram2i_list = []
     l1_i2cgram_list = []
     for cgram_file in l1_cgram_files:
-        cngram2i = pickle.load(open(cgram_file, 'rb'))
-        i2cngram = {v: k for k, v in cngram2i.items()}
+        if bundle is not None:
+            cngram2i, i2cngram = bundle.vocab(cgram_file)
+        else:
+            cngram2i = pickle.load(open(cgram_file, 'rb'))
+            i2cngram = {v: k for k, v in cngram2i.items()}
         l1_cgram2i_list.append(cngram2i)
         l1_i2cgram_list.append(i2cngram)
     l1_v2cgramspell_files = options.l1_v2cgramspell.split(',')
     l1_cgram_spelling_mat_list = []
     for v2cgramspell_file in l1_v2cgramspell_files:
-        f = pickle.load(open(v2cgramspell_file, 'rb'))
-        m = spell2mat(f)
+        m = bundle.array(v2cgramspell_file) if bundle is not None else load_spelling_mat(v2cgramspell_file)
         assert len(v2i) == m.shape[0]
         l1_cgram_spelling_mat_list.append(m)
 
@@ -153,27 +177,30 @@ if __name__ == '__main__':
     l2_cgram2i_list = []
     l2_i2cgram_list = []
     for cgram_file in l2_cgram_files:
-        cngram2i = pickle.load(open(cgram_file, 'rb'))
-        i2cngram = {v: k for k, v in cngram2i.items()}
+        if bundle is not None:
+            cngram2i, i2cngram = bundle.vocab(cgram_file)
+        else:
+            cngram2i = pickle.load(open(cgram_file, 'rb'))
+            i2cngram = {v: k for k, v in cngram2i.items()}
         l2_cgram2i_list.append(cngram2i)
         l2_i2cgram_list.append(i2cngram)
     l2_v2cgramspell_files = options.l2_v2cgramspell.split(',')
     l2_cgram_spelling_mat_list = []
     for v2cgramspell_file in l2_v2cgramspell_files:
-        f = pickle.load(open(v2cgramspell_file, 'rb'))
-        m = spell2mat(f)
+        m = bundle.array(v2cgramspell_file) if bundle is not None else load_spelling_mat(v2cgramspell_file)
         assert len(gv2i) == m.shape[0]
         l2_cgram_spelling_mat_list.append(m)
     l2_v2cgramspell_by_l1_files = options.l2_v2cgramspell_by_l1.split(',')
     l2_cgram_by_l1_spelling_mat_list = []
     for v2cgramspell_file in l2_v2cgramspell_by_l1_files:
-        f = pickle.load(open(v2cgramspell_file, 'rb'))
-        m = spell2mat(f)
+        m = bundle.array(v2cgramspell_file) if bundle is not None else load_spelling_mat(v2cgramspell_file)
         assert len(gv2i) == m.shape[0]
         l2_cgram_by_l1_spelling_mat_list.append(m)
 
     l1_cloze_model = torch.load(options.cloze_model, map_location=lambda storage, loc: storage)
     l1_tied_encoder_decoder = l1_cloze_model.tied_encoder_decoder
+    assert options.adaptive_softmax == 0 or getattr(l1_cloze_model, 'adaptive_softmax', None) is not None, \
+        "--adaptive_softmax 1 needs a cloze model trained with an adaptive softmax"
     l1_tied_encoder_decoder.param_type = 'l1'
     l1_tied_encoder_decoder.mode = 'l2'
     min_cgram = l1_tied_encoder_decoder.min_cgram #int(options.pool_type.split(':')[0])
@@ -209,9 +236,11 @@ if __name__ == '__main__':
                               zero_regularization=options.zero_reg,
                               regularization_type=options.reg_type,
                               learning_steps=options.iters,
-                              max_grad_norm=options.grad_norm)
+                              max_grad_norm=options.grad_norm,
+                              adaptive_softmax=l1_cloze_model.adaptive_softmax if options.adaptive_softmax == 1 else None)
     if options.gpuid > -1:
         cloze_model.init_cuda()
+    cloze_model.set_precision(options.precision)
     cloze_model.init_key()
     cloze_model.train()
     print(cloze_model)
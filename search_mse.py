@@ -31,7 +31,11 @@ from src.rewards import batch_cosine_sim
 from src.rewards import get_nearest_neighbors
 
 from src.utils.utils import ParallelTextDataset
+from src.utils.utils import MMapParallelTextDataset
 from src.utils.utils import SPECIAL_TOKENS
+from src.utils.utils import load_mat
+from src.utils.utils import PerLineKeys
+from src.utils.bundle import ArtifactBundle
 
 
 def prep_swap(macaronic_config):
@@ -158,15 +162,10 @@ def apply_swap(macaronic_config, model, weights, previous_seen_l2, **kwargs):
 
 
 def make_start_state(v2idx, gv2idx, idx2v, idx2gv, init_weights, model, dl, **kwargs):
-    pkl_list = pickle.load(open(kwargs['per_line_key'], 'rb'))
-    per_line_key = []
-    for pkl in pkl_list:
-        if len(pkl) > 0:
-            l1_k, l2_k = zip(*pkl)
-        else:
-            l1_k = (0,)
-            l2_k = (0,)
-        per_line_key.append((torch.LongTensor(list(l1_k)), torch.LongTensor(list(l2_k))))
+    if kwargs.get('bundle') is not None:
+        per_line_key = ArtifactBundle(kwargs['bundle']).per_line_keys(kwargs['per_line_key'])
+    else:
+        per_line_key = PerLineKeys(kwargs['per_line_key'])
 
     macaronic_sentences = []
     for sent_idx, sent in enumerate(dl):
@@ -178,13 +177,14 @@ def make_start_state(v2idx, gv2idx, idx2v, idx2gv, init_weights, model, dl, **kw
                          l1_data[0, idx].item() != v2idx[SPECIAL_TOKENS.UNK])][1:-1])
         l1_tokens = [SPECIAL_TOKENS.BOS] + l1_text_data[0].strip().split() + [SPECIAL_TOKENS.EOS] # [i2v[i.item()] for i in l1_data[0, :]]
         l2_tokens = [SPECIAL_TOKENS.BOS] + l2_text_data[0].strip().split() + [SPECIAL_TOKENS.EOS] # [i2gv[i.item()] for i in l2_data[0, :]]
+        line_l1_key, line_l2_key = per_line_key[sent_idx]
         ms = MacaronicSentence(l1_tokens, l2_tokens,
                                l1_data, l2_data,
                                swapped, not_swapped, swappable,
                                set([]), [],
                                kwargs['swap_limit'],
-                               per_line_key[sent_idx][0],
-                               per_line_key[sent_idx][1])
+                               line_l1_key,
+                               line_l2_key)
         macaronic_sentences.append(ms)
         if len(macaronic_sentences) > kwargs['max_sentences']:
             break
@@ -299,6 +299,9 @@ if __name__ == '__main__':
     opt = argparse.ArgumentParser(description="write program description here")
     # insert options here
     opt.add_argument('--parallel_corpus', action='store', dest='parallel_corpus', required=True)
+    opt.add_argument('--corpus_format', action='store', dest='corpus_format', default='text',
+                     choices=['text', 'mmap'],
+                     help='mmap expects --parallel_corpus to be a prefix written by compile_corpus.py')
     opt.add_argument('--v2i', action='store', dest='v2i', required=True,
                      help='vocab to index pickle obj')
     opt.add_argument('--v2spell', action='store', dest='v2spell', required=False, default=None,
@@ -318,6 +321,11 @@ if __name__ == '__main__':
     opt.add_argument('--key_wt', action='store', dest='key_wt', required=True)
     opt.add_argument('--use_key_wt', action='store', dest='use_key_wt', required=True, type=int, choices=[0, 1])
     opt.add_argument('--per_line_key', action='store', dest='per_line_key', required=True)
+    opt.add_argument('--bundle', action='store', dest='bundle', required=False, default=None,
+                     help='artifact bundle from preprocess.py --bundle, the files named by the vocab/key/matrix flags are read from it')
+    opt.add_argument('--precision', action='store', dest='precision', default='fp32',
+                     choices=['fp32', 'bf16'],
+                     help='bf16 runs the cloze model forward under autocast, weights and updates stay fp32')
     opt.add_argument('--stochastic', action='store', dest='stochastic', default=0, type=int, choices=[0, 1])
     opt.add_argument('--beam_size', action='store', dest='beam_size', default=10, type=int)
     opt.add_argument('--swap_limit', action='store', dest='swap_limit', default=0.3, type=float)
@@ -359,18 +367,28 @@ if __name__ == '__main__':
         search_output_json = None
         search_output_latex = None
 
-    v2i = pickle.load(open(options.v2i, 'rb'))
-    i2v = dict((v, k) for k, v in v2i.items())
-    gv2i = pickle.load(open(options.gv2i, 'rb')) if options.gv2i is not None else None
-    i2gv = dict((v, k) for k, v in gv2i.items())
-    l1_key, l2_key = zip(*pickle.load(open(options.key, 'rb')))
-    l2_key = torch.LongTensor(list(l2_key))
-    l1_key = torch.LongTensor(list(l1_key))
-    l2_key_wt = pickle.load(open(options.key_wt, 'rb'))
-    l2_key_wt = torch.FloatTensor(l2_key_wt)
+    bundle = ArtifactBundle(options.bundle) if options.bundle is not None else None
+    if bundle is not None:
+        v2i, i2v = bundle.vocab(options.v2i)
+        gv2i, i2gv = bundle.vocab(options.gv2i)
+        l1_key, l2_key = bundle.key(options.key)
+        l2_key_wt = bundle.array(options.key_wt).clone()
+    else:
+        v2i = pickle.load(open(options.v2i, 'rb'))
+        i2v = dict((v, k) for k, v in v2i.items())
+        gv2i = pickle.load(open(options.gv2i, 'rb')) if options.gv2i is not None else None
+        i2gv = dict((v, k) for k, v in gv2i.items())
+        l1_key, l2_key = zip(*pickle.load(open(options.key, 'rb')))
+        l2_key = torch.LongTensor(list(l2_key))
+        l1_key = torch.LongTensor(list(l1_key))
+        l2_key_wt = pickle.load(open(options.key_wt, 'rb'))
+        l2_key_wt = torch.FloatTensor(l2_key_wt)
     if options.use_key_wt == 0:
         l2_key_wt.fill_(1.0)
-    dataset = ParallelTextDataset(options.parallel_corpus, v2i, gv2i)
+    if options.corpus_format == 'mmap':
+        dataset = MMapParallelTextDataset(options.parallel_corpus)
+    else:
+        dataset = ParallelTextDataset(options.parallel_corpus, v2i, gv2i)
     v_max_vocab = len(v2i)
     g_max_vocab = len(gv2i)
     l1_cloze_model = torch.load(options.cloze_model, map_location=lambda storage, loc: storage)
@@ -381,7 +399,10 @@ if __name__ == '__main__':
         l2_encoder.weight.data[:] = 0.0
     else:
         print('using l2_init_weights from ' + options.l2_init_weights)
-        l2_init_weights = torch.load(options.l2_init_weights)
+        if bundle is not None and options.l2_init_weights in bundle:
+            l2_init_weights = bundle.array(options.l2_init_weights)
+        else:
+            l2_init_weights = load_mat(options.l2_init_weights)
         l2_encoder = make_wl_encoder(None, None, l2_init_weights)
     cloze_model = L2_MSE_CLOZE(encoder=l1_cloze_model.encoder,
                                context_encoder=l1_cloze_model.context_encoder,
@@ -397,6 +418,7 @@ if __name__ == '__main__':
                                l2_key_wt=l2_key_wt)
     if options.gpuid > -1:
         cloze_model.init_cuda()
+    cloze_model.set_precision(options.precision)
     cloze_model.init_key()
     cloze_model.eval()
     print(cloze_model)
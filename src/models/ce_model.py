@@ -7,10 +7,17 @@ from collections import OrderedDict
 
 from src.models.model_untils import BiRNNConextEncoder
 from src.models.model_untils import SelfAttentionalContextEncoder
+from src.models.model_untils import autocast
+from src.models.model_untils import make_grad_scaler
+from src.models.model_untils import split_batch
 
 from torch.nn.utils.rnn import pack_padded_sequence as pack
 from torch.nn.utils.rnn import pad_packed_sequence as unpack
 from src.utils.utils import SPECIAL_TOKENS
+from src.utils.utils import spell2mat
+from src.utils.distributed import all_reduce_grads
+import numpy as np
+import pickle
 
 from src.rewards import score_embeddings
 from src.rewards import rank_score_embeddings
@@ -21,12 +28,11 @@ import pdb
 
 
 
-def spell2mat(v2spell):
-    spelling_mat = torch.Tensor(len(v2spell), len(v2spell[0])).fill_(0).long()
-    for k, v in v2spell.items():
-        spelling_mat[k] = torch.tensor(v)
-    spelling_mat = spelling_mat[:, :-1]
-    return spelling_mat
+def load_spelling_mat(spell_file):
+    # int32 .npy spelling arrays are mapped directly, pickled dicts go through spell2mat
+    if spell_file.endswith('.npy'):
+        return torch.from_numpy(np.load(spell_file, mmap_mode='c'))
+    return spell2mat(pickle.load(open(spell_file, 'rb')))
 
 
 def make_l2_tied_encoder_decoder(l1_tied_enc_dec,
@@ -151,6 +157,10 @@ class TiedEncoderDecoder(nn.Module):
     def embedding_dim(self,):
         return self.embedding.embedding_dim
 
+    def select_word_embeddings(self, idx):
+        # rows of the output embedding matrix for the word ids in idx
+        return self.embedding(idx)
+
     def forward(self, data, mode):
         if mode == 'input':
             return self.embedding(data)
@@ -238,8 +248,8 @@ class CGramTiedEncoderDecoder(nn.Module):
         for cg_sm, cg_vs in zip(self.l1_cgram_spelling_mats, self.l1_cgram_vocab_sizes):
             assert self.l1_word_vocab_size == cg_sm.shape[0], "spelling mat does not match word_vocab_size"
             s_emb = torch.nn.Embedding(cg_sm.shape[0], cg_sm.shape[1])
-            s_emb.weight.data = cg_sm
             s_emb.weight.requires_grad = False
+            s_emb.weight.data = cg_sm
             self.l1_cgram_spelling_embs.append(s_emb)
 
             emb = torch.nn.Embedding(cg_vs, self.word_embedding_size, padding_idx=0)
@@ -272,8 +282,8 @@ class CGramTiedEncoderDecoder(nn.Module):
             for cg_by_l1_sm in self.l2_cgram_by_l1_spelling_mats:
                 assert self.l2_word_vocab_size == cg_by_l1_sm.shape[0], "spelling mat does not match word_vocab_size"
                 s_by_l1_emb = torch.nn.Embedding(cg_by_l1_sm.shape[0], cg_by_l1_sm.shape[1])
-                s_by_l1_emb.weight.data = cg_by_l1_sm
                 s_by_l1_emb.weight.requires_grad = False
+                s_by_l1_emb.weight.data = cg_by_l1_sm
                 self.l2_cgram_by_l1_spelling_embs.append(s_by_l1_emb)
             assert len(self.l2_cgram_by_l1_spelling_embs) == len(self.l1_params)
 
@@ -281,8 +291,8 @@ class CGramTiedEncoderDecoder(nn.Module):
             for cg_sm, cg_vs in zip(self.l2_cgram_spelling_mats, self.l2_cgram_vocab_sizes):
                 assert self.l2_word_vocab_size == cg_sm.shape[0], "spelling mat does not match word_vocab_size"
                 s_emb = torch.nn.Embedding(cg_sm.shape[0], cg_sm.shape[1])
-                s_emb.weight.data = cg_sm
                 s_emb.weight.requires_grad = False
+                s_emb.weight.data = cg_sm
                 if self.use_l2_subwords:
                     self.l2_cgram_spelling_embs.append(s_emb)
 
@@ -333,6 +343,9 @@ class CGramTiedEncoderDecoder(nn.Module):
         return self.word_embedding_size
 
     def init_cache(self,):
+        # the word embedding cache (_cached_word_embeddings) fills itself on first use and follows parameter
+        # updates, this only drops what it holds (call it after writing parameters through .data)
+        self._word_emb_cache = None
         #assert self.mode == 'l2'
         #if self.param_type == 'l1':
         #    word_emb = self._compute_word_embeddings().detach()
@@ -351,26 +364,70 @@ class CGramTiedEncoderDecoder(nn.Module):
 
     def summed_subword_emb(self, data, emb_list, spelling_emb_list, pos_weighted=False, scale=1.0, mean=True):
         #mean was false by default and only used for when param_type == 2
+        # one embedding_bag per cgram order over the padded spelling rows, the position weights, the mean
+        # and scale are folded into per sample weights and pad cgrams are skipped, so no
+        # (data_dims, cgram_spelling_length, word_embedding_size) tensor is built
         assert len(emb_list) == len(spelling_emb_list)
         emb = 0
-        data_dim = data.dim()
+        flat_data = data.reshape(-1)
         for cg_emb, cg_spelling_emb in zip(emb_list, spelling_emb_list):
-            cg_spelling = cg_spelling_emb(data).long()  # (data_dims, cgram_spelling_length)
-            cg_spelling_lens = (cg_spelling != cg_emb.padding_idx).sum(data_dim)
-            sub_emb = cg_emb(cg_spelling)  # (data_dims, cgram_spelling_length, word_embedding_size)
-            if pos_weighted:
-                _r = list(range(sub_emb.shape[data_dim] - 1, -1, -1))
-                pos_wts = (torch.Tensor(_r).type_as(sub_emb) * (1.0 / (sub_emb.shape[data_dim] - 1))) ** 2
-                pos_wts = pos_wts.unsqueeze(1).unsqueeze(0).expand_as(sub_emb)
-                sub_emb = sub_emb * pos_wts
-            sub_emb = sub_emb.sum(data_dim)  # (data_dims, word_embedding_Size)
-            if mean:
-                cg_spelling_lens = cg_spelling_lens.unsqueeze(data_dim).float().expand_as(sub_emb) + 1e-2
-                sub_emb = sub_emb / cg_spelling_lens
-            emb = emb + (sub_emb * scale)
-        return emb
+            cg_spelling = cg_spelling_emb(flat_data).long()  # (num words, cgram_spelling_length)
+            wts = self._subword_bag_weights(cg_spelling, cg_emb.padding_idx, pos_weighted, scale, mean)
+            sub_emb = torch.nn.functional.embedding_bag(cg_spelling, cg_emb.weight, mode='sum',
+                                                        per_sample_weights=wts.type_as(cg_emb.weight),
+                                                        padding_idx=cg_emb.padding_idx)
+            emb = emb + sub_emb  # (num words, word_embedding_size)
+        return emb.view(*data.shape, emb.size(-1))
+
+    def _subword_bag_weights(self, cg_spelling, padding_idx, pos_weighted, scale, mean):
+        spelling_length = cg_spelling.size(1)
+        wts = torch.full((1, spelling_length), scale, device=cg_spelling.device)
+        if pos_weighted:
+            # (spelling_length - 1 - position) / (spelling_length - 1), squared
+            pos_wts = torch.arange(spelling_length - 1, -1, -1, device=cg_spelling.device).float()
+            wts = wts * (pos_wts * (1.0 / (spelling_length - 1))) ** 2
+        if mean:
+            cg_spelling_lens = (cg_spelling != padding_idx).sum(1, keepdim=True).float() + 1e-2
+            wts = wts / cg_spelling_lens
+        return wts.expand(cg_spelling.shape)
+
+    def __getstate__(self):
+        # the cached matrix can be part of an autograd graph, it is not saved or copied with the module
+        state = super().__getstate__()
+        state['_word_emb_cache'] = None
+        return state
+
+    def _drop_cache(self, token):
+        cache = getattr(self, '_word_emb_cache', None)
+        if cache is not None and cache[2] is token:
+            self._word_emb_cache = None
+
+    def _cached_word_embeddings(self, materialize=True):
+        """
+        one _compose_word_embeddings() matrix shared by input_forward, output_forward and get_word_vecs.
+        it is keyed on the parameter version counters (bumped by optimizer steps and load_state_dict) and
+        storage, param_type, train/eval and grad mode. a matrix in an autograd graph is dropped once backward
+        has gone through it. with materialize=False it is only built when no graph is needed (no_grad or
+        frozen parameters), otherwise None is returned unless it is already there
+        """
+        key = (self.param_type, self.training, torch.is_grad_enabled()) + \
+            tuple((p.data_ptr(), p._version) for p in self.parameters())
+        cache = getattr(self, '_word_emb_cache', None)
+        if cache is not None and cache[0] == key:
+            return cache[1]
+        if not materialize and torch.is_grad_enabled() and any(p.requires_grad for p in self.parameters()):
+            return None
+        word_emb = self._compose_word_embeddings()
+        token = object()
+        if word_emb.requires_grad:
+            word_emb.register_hook(lambda grad: self._drop_cache(token))
+        self._word_emb_cache = (key, word_emb, token)
+        return word_emb
 
     def _compute_word_embeddings(self,):
+        return self._cached_word_embeddings()
+
+    def _compose_word_embeddings(self,):
         if self.param_type == 'l1':
             v = torch.arange(self.l1_word_vocab_size).type_as(self.l1_word_embedding.weight.data).long()
             word_emb = self.l1_word_embedding(v)
@@ -395,6 +452,9 @@ class CGramTiedEncoderDecoder(nn.Module):
         #if self.use_cache_embedding:
         #    assert self.param_type == 'l1'
         #    return self.l1_cached_word_embedding(data)
+        cached_word_emb = self._cached_word_embeddings(materialize=False)
+        if cached_word_emb is not None:
+            return torch.nn.functional.embedding(data, cached_word_emb)
 
         if self.param_type == 'l1':
             word_emb = self.l1_word_embedding(data)  # (bsz, seq, word_embedding_size)
@@ -414,6 +474,10 @@ class CGramTiedEncoderDecoder(nn.Module):
         else:
             raise BaseException("bad param_type")
 
+    def select_word_embeddings(self, idx):
+        # rows of _compute_word_embeddings() for the word ids in idx, only those rows are composed from subwords
+        return self.input_forward(idx)
+
     def output_forward(self, data):
         #if self.use_cache_embedding:
         #    assert self.param_type == 'l1'
@@ -529,8 +593,8 @@ class CharTiedEncoderDecoder(nn.Module):
         self.char_embedding_size = char_embedding_size
         self.max_spelling_length = spelling_mat.shape[1]
         self.spelling_embedding = torch.nn.Embedding(word_vocab_size, self.max_spelling_length)
-        self.spelling_embedding.weight.data = spelling_mat
         self.spelling_embedding.weight.requires_grad = False
+        self.spelling_embedding.weight.data = spelling_mat
         self.char_embedding = torch.nn.Embedding(char_vocab_size, char_embedding_size)
         self.num_lang_bits = num_lang_bits
         self.param_type = ''
@@ -678,6 +742,10 @@ class CharTiedEncoderDecoder(nn.Module):
             word_emb = self.dropout(word_emb)
         return word_emb
 
+    def select_word_embeddings(self, idx):
+        # rows of _compute_word_embeddings() for the word ids in idx, only those spellings go through seq
+        return self.input_forward(idx.unsqueeze(0)).squeeze(0)
+
     def output_forward(self, data):
         if self.use_cache_embedding:
             return self.cached_word_embedding_decoder(data)
@@ -727,6 +795,92 @@ class CharTiedEncoderDecoder(nn.Module):
         return True
 
 
+class TiedAdaptiveSoftmax(nn.Module):
+    """
+    frequency clustered (adaptive) softmax over the words of a tied encoder/decoder. the head holds the
+    cutoffs[0] most frequent words and one logit per tail cluster, tail cluster i holds the words ranked
+    cutoffs[i-1]..cutoffs[i] (the last one runs to the end of the vocab). word scores are dot products with
+    the tied word embeddings, only the cluster logits have their own weights.
+    a tail cluster is scored only for the tokens whose target (or greedy prediction) falls in it.
+    special_idxs (pad, bos, eos, unk) have no unigram prob but bos/eos are targets in every sentence,
+    they are put at the front of the head so they never pull in a tail cluster
+    """
+    def __init__(self, unigram_prob, vocab_size, cutoffs, embedding_size, special_idxs=()):
+        super().__init__()
+        probs = torch.zeros(vocab_size)
+        for v_idx, prob in unigram_prob.items():
+            probs[v_idx] = prob
+        order = torch.sort(probs, descending=True, stable=True)[1]
+        is_special = torch.zeros(vocab_size, dtype=torch.bool)
+        is_special[list(special_idxs)] = True
+        order = torch.cat([order[is_special[order]], order[~is_special[order]]])
+        self.cutoffs = [c for c in cutoffs if 0 < c < vocab_size] + [vocab_size]
+        self.num_clusters = len(self.cutoffs) - 1
+        word2cluster = torch.zeros(vocab_size).long()
+        word2pos = torch.zeros(vocab_size).long()
+        start = 0
+        for c, end in enumerate(self.cutoffs):
+            word2cluster[order[start:end]] = c
+            word2pos[order[start:end]] = torch.arange(end - start)
+            start = end
+        self.register_buffer('order', order)
+        self.register_buffer('word2cluster', word2cluster)
+        self.register_buffer('word2pos', word2pos)
+        self.cluster_logits = nn.Linear(embedding_size, self.num_clusters)
+
+    def cluster_words(self, c):
+        start = 0 if c == 0 else self.cutoffs[c - 1]
+        return self.order[start:self.cutoffs[c]]
+
+    def forward(self, hidden, target, tied_encoder_decoder, extra_emb=None, get_pred=True):
+        """
+        hidden (N, embedding_size) and target (N,) without pad tokens. extra_emb (X, embedding_size) are
+        candidates outside the vocab of tied_encoder_decoder that join the head, target ids vocab_size + x refer to them.
+        returns the summed negative log likelihood and the greedy predictions (same id space as target)
+        """
+        vocab_size = self.word2cluster.size(0)
+        head_size = self.cutoffs[0]
+        head_emb = tied_encoder_decoder.select_word_embeddings(self.cluster_words(0))
+        num_extra = 0
+        if extra_emb is not None:
+            num_extra = extra_emb.size(0)
+            head_emb = torch.cat([head_emb, extra_emb.type_as(head_emb)], dim=0)
+        head_logits = torch.cat([torch.matmul(hidden, head_emb.transpose(0, 1)),
+                                 self.cluster_logits(hidden).type_as(hidden)], dim=1).float()
+        head_lp = torch.log_softmax(head_logits, dim=1)
+        in_vocab = target.lt(vocab_size)
+        target_v = target.masked_fill(~in_vocab, 0)
+        target_cluster = self.word2cluster[target_v].masked_fill(~in_vocab, 0)
+        head_target = torch.where(target_cluster.eq(0), self.word2pos[target_v],
+                                  head_size + num_extra + target_cluster - 1)
+        head_target = torch.where(in_vocab, head_target, head_size + target - vocab_size)
+        nll = -head_lp.gather(1, head_target.unsqueeze(1)).squeeze(1)
+        pred = None
+        if get_pred:
+            head_pred = head_lp.argmax(dim=1)
+            pred = torch.where(head_pred.lt(head_size), self.order[head_pred.clamp(max=head_size - 1)],
+                               vocab_size + head_pred - head_size)
+            pred_cluster = (head_pred - head_size - num_extra + 1).clamp(min=0)
+        for c in range(1, self.num_clusters + 1):
+            rows = target_cluster.eq(c)
+            if get_pred:
+                rows = rows | pred_cluster.eq(c)
+            rows = rows.nonzero().squeeze(1)
+            if rows.numel() == 0:
+                continue
+            words = self.cluster_words(c)
+            tail_emb = tied_encoder_decoder.select_word_embeddings(words)
+            tail_lp = torch.log_softmax(torch.matmul(hidden[rows], tail_emb.transpose(0, 1)).float(), dim=1)
+            is_target = target_cluster[rows].eq(c)
+            tail_target = self.word2pos[target_v[rows]].masked_fill(~is_target, 0)
+            tail_nll = -tail_lp.gather(1, tail_target.unsqueeze(1)).squeeze(1)
+            nll = nll.index_add(0, rows, tail_nll.masked_fill(~is_target, 0.))
+            if get_pred:
+                is_pred = pred_cluster[rows].eq(c)
+                pred[rows[is_pred]] = words[tail_lp[is_pred].argmax(dim=1)]
+        return nll.sum(), pred
+
+
 class ContextEncoder(nn.Module):
     def __init__(self,):
         super().__init__()
@@ -901,11 +1055,54 @@ class CE_CLOZE(nn.Module):
         #self.init_cuda()
         self.init_param_freeze()
         self.init_optimizer('Adam')
+        self.set_precision('fp32')
+        self.set_sampled_softmax(None, 0)
+        self.adaptive_softmax = None
 
     def init_cuda(self,):
         self.context_encoder.init_cuda()
         self.tied_encoder_decoder.init_cuda()
         self = self.cuda()
+        if getattr(self, 'sampling_probs', None) is not None:
+            self.sampling_probs = self.sampling_probs.cuda()
+        return True
+
+    def set_adaptive_softmax(self, unigram_prob, cutoffs):
+        """
+        replaces the full softmax (for training and eval) with a TiedAdaptiveSoftmax whose clusters come from
+        unigram_prob ({word idx: prob}, l1.vidx2unigram_prob.pkl). the cluster logits are new parameters so the
+        optimizer is rebuilt, call it before training starts (and before a checkpoint is loaded)
+        """
+        assert getattr(self, 'num_sampled', 0) == 0, "adaptive softmax and sampled softmax are exclusive"
+        special_idxs = [self.l1_dict[st] for st in [SPECIAL_TOKENS.PAD, SPECIAL_TOKENS.BOS, SPECIAL_TOKENS.EOS,
+                                                    SPECIAL_TOKENS.UNK] if st in self.l1_dict]
+        self.adaptive_softmax = TiedAdaptiveSoftmax(unigram_prob, len(self.l1_dict), cutoffs,
+                                                    self.tied_encoder_decoder.embedding_dim(), special_idxs)
+        if self.is_cuda():
+            self.adaptive_softmax.cuda()
+        self.init_optimizer('Adam')
+        return True
+
+    def set_sampled_softmax(self, unigram_prob, num_sampled):
+        """
+        with num_sampled > 0 training scores each token against its gold word and num_sampled negatives
+        drawn (shared by the whole batch) from unigram_prob ({word idx: prob}, l1.vidx2unigram_prob.pkl).
+        eval (model.eval()) always uses the full softmax
+        """
+        assert num_sampled == 0 or getattr(self, 'adaptive_softmax', None) is None, \
+            "adaptive softmax and sampled softmax are exclusive"
+        self.num_sampled = num_sampled
+        if num_sampled == 0:
+            self.sampling_probs = None
+            return True
+        probs = torch.zeros(len(self.l1_dict))
+        for v_idx, prob in unigram_prob.items():
+            probs[v_idx] = prob
+        probs[self.l1_dict[SPECIAL_TOKENS.PAD]] = 0.
+        assert probs.sum().item() > 0, "unigram_prob has no mass"
+        self.sampling_probs = probs / probs.sum()
+        if self.is_cuda():
+            self.sampling_probs = self.sampling_probs.cuda()
         return True
 
     def init_param_freeze(self,):
@@ -969,10 +1166,19 @@ class CE_CLOZE(nn.Module):
         return acc
 
     def get_loss(self, pred, target):
-        loss = self.loss(pred, target)
+        loss = self.loss(pred.float(), target)  # the loss is computed in fp32 whatever the forward precision
         return loss
 
+    def set_precision(self, precision):
+        self.precision = precision
+        self.grad_scaler = make_grad_scaler(precision, self.is_cuda())
+        return True
+
     def forward(self, batch, get_acc=True):
+        with autocast(getattr(self, 'precision', 'fp32'), self.is_cuda()):
+            return self._forward(batch, get_acc)
+
+    def _forward(self, batch, get_acc=True):
         lengths, l1_data, _, ind = batch
         l1_idxs = ind.eq(1).long()
         l2_idxs = ind.eq(2).long()
@@ -983,6 +1189,14 @@ class CE_CLOZE(nn.Module):
                 ind[l1_data.eq(self.l1_dict[st])] = 0
         l1_encoded = self.tied_encoder_decoder(l1_data, mode='input')
         hidden = self.context_encoder(l1_encoded, lengths, forward_mode='L1')
+        if self.training and getattr(self, 'num_sampled', 0) > 0:
+            return self.sampled_loss(hidden, l1_data, get_acc)
+        if getattr(self, 'adaptive_softmax', None) is not None:
+            keep = l1_data.ne(self.l1_dict[SPECIAL_TOKENS.PAD])
+            loss, pred = self.adaptive_softmax(hidden[keep], l1_data[keep], self.tied_encoder_decoder, get_pred=get_acc)
+            # over all positions (pads included) like the full softmax below, so dev acc compares across modes
+            acc = float(pred.eq(l1_data[keep]).sum().item()) / float(l1_data.numel()) if get_acc else 0.0
+            return loss, acc
         out = self.tied_encoder_decoder(hidden, mode='output')
         if self.loss_at == 'all':
             out_l = out.view(-1, out.size(-1))
@@ -997,17 +1211,55 @@ class CE_CLOZE(nn.Module):
             acc = 0.0
         return loss, acc
 
-    def train_step(self, batch):
-        _l, _a = self(batch, True)
-        _l.backward()
+    def sampled_loss(self, hidden, l1_data, get_acc=True):
+        """
+        sampled softmax over [gold, negatives] for every non-pad token. the negatives are scored
+        minus log(num_sampled * q) (logQ correction) so the sum over them estimates the full partition
+        function, negatives that are the gold word of a token are removed for that token.
+        only the embeddings of the gold and sampled words are computed. acc is over the sampled candidates
+        """
+        hidden = hidden.reshape(-1, hidden.size(-1))
+        target = l1_data.reshape(-1)
+        keep = target.ne(self.l1_dict[SPECIAL_TOKENS.PAD])
+        hidden = hidden[keep]
+        target = target[keep]
+        neg = torch.multinomial(self.sampling_probs, self.num_sampled, replacement=True)
+        cand, cand_inv = torch.unique(torch.cat([target, neg]), return_inverse=True)
+        cand_emb = self.tied_encoder_decoder.select_word_embeddings(cand)  # (num cand, word_embedding_size)
+        scores = torch.matmul(hidden, cand_emb.transpose(0, 1)).float()  # (num tokens, num cand)
+        gold_logit = scores.gather(1, cand_inv[:target.size(0)].unsqueeze(1))
+        neg_logit = scores[:, cand_inv[target.size(0):]] - torch.log(self.num_sampled * self.sampling_probs[neg])
+        neg_logit = neg_logit.masked_fill(neg.unsqueeze(0).eq(target.unsqueeze(1)), float('-inf'))
+        logits = torch.cat([gold_logit, neg_logit], dim=1)
+        loss = -torch.log_softmax(logits, dim=1)[:, 0].sum()
+        if get_acc:
+            acc = float(logits.argmax(dim=1).eq(0).sum().item()) / float(max(1, target.size(0)))
+        else:
+            acc = 0.0
+        return loss, acc
+
+    def train_step(self, batch, max_tokens=None):
+        # with max_tokens the batch is run as micro-batches whose gradients add up before the one step,
+        # the losses are sums over tokens so this is the same update with a bounded activation footprint
+        self.optimizer.zero_grad()
+        _l, _a, _n = 0.0, 0.0, 0
+        for micro_batch in split_batch(batch, max_tokens):
+            _ml, _ma = self(micro_batch, True)
+            self.grad_scaler.scale(_ml).backward()
+            _l += _ml.item()
+            _a += _ma * micro_batch[1].numel()
+            _n += micro_batch[1].numel()
+        _a = _a / _n
+        all_reduce_grads(self.parameters())
+        self.grad_scaler.unscale_(self.optimizer)
         grad_norm = torch.nn.utils.clip_grad_norm_(filter(lambda p: p.requires_grad, self.parameters()),
                                                    self.max_grad_norm)
         if math.isnan(grad_norm):
             print('skipping update grad_norm is nan!')
         else:
-            self.optimizer.step()
-        loss = _l.item()
-        return loss, grad_norm, _a
+            self.grad_scaler.step(self.optimizer)
+        self.grad_scaler.update()
+        return _l, grad_norm, _a
 
     def save_model(self, path):
         torch.save(self, path)
@@ -1031,9 +1283,12 @@ class L2_CE_CLOZE(nn.Module):
                  regularization_type,
                  learning_steps=3,
                  step_size=0.1,
-                 max_grad_norm=5.0):
+                 max_grad_norm=5.0,
+                 adaptive_softmax=None):
         super().__init__()
         self.context_encoder = context_encoder
+        # the (frozen) TiedAdaptiveSoftmax of an l1 model trained with one, scores l1 words cluster by cluster
+        self.adaptive_softmax = adaptive_softmax
         self.l1_tied_encoder_decoder = l1_tied_encoder_decoder
         self.l2_tied_encoder_decoder = l2_tied_encoder_decoder
         assert self.l2_tied_encoder_decoder.embedding_dim() == self.l1_tied_encoder_decoder.embedding_dim()
@@ -1058,6 +1313,14 @@ class L2_CE_CLOZE(nn.Module):
         #self.optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, self.parameters()))
         self.max_grad_norm = max_grad_norm
         self.init_optimizer()
+        self.precision = 'fp32'
+
+    def set_precision(self, precision):
+        # only the forward runs in precision, the learn_step regularizers and updates stay fp32
+        if precision == 'fp16':
+            raise ValueError('fp16 is not supported for L2_CE_CLOZE, learn_step has no loss scaling, use bf16')
+        self.precision = precision
+        return True
 
     def init_optimizer(self,):
         self.optimizer = torch.optim.SGD(filter(lambda p: p.requires_grad, self.parameters()), lr=0.1)
@@ -1099,6 +1362,10 @@ class L2_CE_CLOZE(nn.Module):
         return True
 
     def forward(self, batch):
+        with autocast(self.precision, self.is_cuda()):
+            return self._forward(batch)
+
+    def _forward(self, batch):
         lengths, l1_data, l2_data, ind, _ = batch
         l1_idxs = ind.eq(1).long()
         l2_idxs = ind.eq(2).long()
@@ -1115,15 +1382,34 @@ class L2_CE_CLOZE(nn.Module):
         j_data = l1_data.clone()
         j_data[l2_idxs == 1] = l2_data[l2_idxs == 1] + self.l1_tied_encoder_decoder.vocab_size()
         hidden = self.context_encoder(mixed_encoded, lengths, forward_mode='L2')
+        if getattr(self, 'adaptive_softmax', None) is not None:
+            return self.adaptive_loss(hidden, l2_data, l2_idxs, j_data)
         out_l1 = self.l1_tied_encoder_decoder(hidden, mode='output')
         out_l2 = self.l2_tied_encoder_decoder(hidden, mode='output')
         l2_mask = torch.ones(out_l2.size(2)).type_as(l2_data)
         l2_mask[l2_data[0, l2_idxs[0, :] == 1]] = 0
         out_l2[:, :, l2_mask == 1] = float('-inf')
-        out = torch.cat([out_l1, out_l2], dim=2)
+        out = torch.cat([out_l1, out_l2], dim=2).float()
         loss = self.loss(out.view(-1, out.size(2)), j_data.view(-1))
         return loss, l2_mask
 
+    def adaptive_loss(self, hidden, l2_data, l2_idxs, j_data):
+        # same loss as the full l1 + l2 softmax in _forward: the l2 words of the sentence (the only l2 words
+        # not masked there) join the head of the adaptive softmax, l1 tail clusters are scored only when needed
+        l2_words = torch.unique(l2_data[0, l2_idxs[0, :] == 1])
+        l2_mask = torch.ones(self.l2_tied_encoder_decoder.vocab_size()).type_as(l2_data)
+        l2_mask[l2_words] = 0
+        l1_vocab_size = self.l1_tied_encoder_decoder.vocab_size()
+        keep = j_data.ne(self.l1_dict[SPECIAL_TOKENS.PAD])
+        target = j_data[keep]
+        is_l2 = target.ge(l1_vocab_size)
+        # l2 targets point at their row of l2_words (sorted by torch.unique)
+        target[is_l2] = l1_vocab_size + torch.searchsorted(l2_words, target[is_l2] - l1_vocab_size)
+        l2_emb = self.l2_tied_encoder_decoder.select_word_embeddings(l2_words) if l2_words.numel() > 0 else None
+        loss, _ = self.adaptive_softmax(hidden[keep], target, self.l1_tied_encoder_decoder,
+                                        extra_emb=l2_emb, get_pred=False)
+        return loss, l2_mask
+
     def regularized_step(self, l2_cpy):
         raise BaseException("not using this...")
         self.l2_tied_encoder_decoder.regularized_step(l2_cpy)
@@ -18,6 +18,42 @@ from .transformer_encoder_layer import TransformerEncoderLayer
 import pickle
 import pdb
 
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def autocast(precision, use_cuda):
+    # parameters (and the optimizer state) stay fp32, autocast runs matmuls/linear/rnn ops in precision
+    if precision == 'fp16' and not use_cuda:
+        raise ValueError("fp16 autocast needs a gpu (cpu lstm kernels have no fp16 path), use bf16 on cpu")
+    return torch.autocast(device_type='cuda' if use_cuda else 'cpu', dtype=PRECISIONS[precision],
+                          enabled=precision != 'fp32')
+
+
+def make_grad_scaler(precision, use_cuda):
+    # only fp16 gradients underflow and need loss scaling, bf16 has the fp32 exponent range
+    return torch.amp.GradScaler('cuda' if use_cuda else 'cpu', enabled=precision == 'fp16')
+
+
+def split_batch(batch, max_tokens):
+    """
+    splits a batch (lengths, then (batch, seq) tensors or None) whose lengths are sorted longest first
+    into consecutive micro-batches of at most max_tokens (rows * longest row) each, trimmed to their
+    longest row. a single row longer than max_tokens still makes its own micro-batch
+    """
+    lengths = batch[0]
+    if max_tokens is None or len(lengths) * max(lengths) <= max_tokens:
+        return [batch]
+    micro_batches = []
+    i = 0
+    while i < len(lengths):
+        j = min(len(lengths), i + max(1, max_tokens // lengths[i]))
+        width = max(lengths[i:j])
+        micro_batches.append((lengths[i:j],) + tuple(t[i:j, :width].contiguous() if t is not None else None
+                                                     for t in batch[1:]))
+        i = j
+    return micro_batches
+
+
 def get_unsort_idx(sort_idx):
     unsort_idx = torch.zeros_like(sort_idx).long().scatter_(0, sort_idx, torch.arange(sort_idx.size(0)).long())
     return unsort_idx
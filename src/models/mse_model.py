@@ -6,10 +6,14 @@ import torch.nn as nn
 
 from src.models.model_untils import BiRNNConextEncoder
 from src.models.model_untils import SelfAttentionalContextEncoder
+from src.models.model_untils import autocast
+from src.models.model_untils import make_grad_scaler
+from src.models.model_untils import split_batch
 
 from torch.nn.utils.rnn import pack_padded_sequence as pack
 from torch.nn.utils.rnn import pad_packed_sequence as unpack
 from src.utils.utils import SPECIAL_TOKENS
+from src.utils.distributed import all_reduce_grads
 
 from src.rewards import score_embeddings
 from src.rewards import rank_score_embeddings
@@ -114,6 +118,7 @@ class MSE_CLOZE(nn.Module):
         #self.init_cuda()
         self.init_param_freeze()
         self.init_optimizer('Adam')
+        self.set_precision('fp32')
         self.word_mask_prob = 0.1
         probs = torch.tensor([1.0 - self.word_mask_prob, self.word_mask_prob])
         self.word_mask = torch.distributions.Categorical(probs=probs)
@@ -227,6 +232,7 @@ class MSE_CLOZE(nn.Module):
         return acc
 
     def get_loss(self, pred, target):
+        pred = pred.float()  # the loss is computed in fp32 whatever the forward precision
         if self.loss_type.startswith('cs'):
             loss = self.loss(pred, target, torch.ones(target.shape[0]).type_as(target))
             if self.loss_type.endswith('margin'):
@@ -243,7 +249,16 @@ class MSE_CLOZE(nn.Module):
             loss = self.loss(pred, target)
         return loss
 
+    def set_precision(self, precision):
+        self.precision = precision
+        self.grad_scaler = make_grad_scaler(precision, self.is_cuda())
+        return True
+
     def forward(self, batch, get_acc=True):
+        with autocast(getattr(self, 'precision', 'fp32'), self.is_cuda()):
+            return self._forward(batch, get_acc)
+
+    def _forward(self, batch, get_acc=True):
         lengths, l1_data, _, ind, ignore_this_word_mask = batch
         l1_idxs = ind.eq(1).long()
         l2_idxs = ind.eq(2).long()
@@ -286,17 +301,24 @@ class MSE_CLOZE(nn.Module):
             acc = 0.0
         return loss, acc
 
-    def do_backprop(self, batch):
-        _l, _a = self(batch, False)
-        _l.backward()
+    def do_backprop(self, batch, max_tokens=None):
+        # gradients of the max_tokens micro-batches accumulate, then one step (see split_batch)
+        self.optimizer.zero_grad()
+        _l = 0.0
+        for micro_batch in split_batch(batch, max_tokens):
+            _ml, _a = self(micro_batch, False)
+            self.grad_scaler.scale(_ml).backward()
+            _l += _ml.item()
+        all_reduce_grads(self.parameters())
+        self.grad_scaler.unscale_(self.optimizer)
         grad_norm = torch.nn.utils.clip_grad_norm_(filter(lambda p: p.requires_grad, self.parameters()),
                                                    self.max_grad_norm)
         if math.isnan(grad_norm):
             print('skipping update grad_norm is nan!')
         else:
-            self.optimizer.step()
-        loss = _l.item()
-        return loss, grad_norm, _a
+            self.grad_scaler.step(self.optimizer)
+        self.grad_scaler.update()
+        return _l, grad_norm, _a
 
     def save_model(self, path):
         torch.save(self, path)
@@ -341,6 +363,13 @@ class L2_MSE_CLOZE(nn.Module):
         self.init_key()
         self.init_param_freeze()
         self.l2_exposure = {}
+        self.precision = 'fp32'
+
+    def set_precision(self, precision):
+        if precision == 'fp16':
+            raise ValueError('fp16 is not supported for L2_MSE_CLOZE, learn_step has no loss scaling, use bf16')
+        self.precision = precision
+        return True
 
     def init_key(self,):
         if self.l1_key is not None:
@@ -427,6 +456,10 @@ class L2_MSE_CLOZE(nn.Module):
         pass
 
     def forward(self, batch):
+        with autocast(self.precision, self.is_cuda()):
+            return self._forward(batch)
+
+    def _forward(self, batch):
         lengths, l1_data, l2_data, ind, _ = batch
         l1_idxs = ind.eq(1).long()
         l2_idxs = ind.eq(2).long()
@@ -454,7 +487,7 @@ class L2_MSE_CLOZE(nn.Module):
             else:
                 hidden = torch.cat((mixed_encoded, hidden), dim=2)
             #out = self.tanh(self.highway_ff(hidden))
-            out = self.highway_ff(hidden)
+            out = self.highway_ff(hidden).float()
             #diff = abs((out - out_prev).mean().item()) if out_prev is not None else 1.0
             mixed_encoded[l2_idxs == 1, :] = out[l2_idxs == 1, :]  # replace all l2_idxs with predictions...
             #print(it, diff)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import pickle
+from array import array
+import numpy as np
+from src.utils.utils import SPECIAL_TOKENS
+from src.utils.utils import compiled_corpus_files
+from src.utils.utils import compression_of
+from src.utils.utils import open_corpus
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--corpus', type=str, required=True,
+                        help="text corpus (one sentence per line, optionally l1 ||| l2), may be gzip/bz2/xz compressed")
+    parser.add_argument('--v2i', type=str, required=True, help='l1 vocab to index pickle obj')
+    parser.add_argument('--gv2i', type=str, required=False, default=None,
+                        help='l2 vocab to index pickle obj, only for parallel corpora')
+    parser.add_argument('--save_prefix', type=str, required=False, default=None,
+                        help='prefix for the compiled files (defaults to the corpus path)')
+    parser.add_argument('--lower_text', type=int, choices=[0, 1], default=1)
+    return parser.parse_args()
+
+
+def to_ids(line, v2idx, lower_text):
+    unk = v2idx[SPECIAL_TOKENS.UNK]
+    tokens = [SPECIAL_TOKENS.BOS] + line.split() + [SPECIAL_TOKENS.EOS]
+    if lower_text:
+        return [v2idx.get(i.lower(), unk) for i in tokens]
+    else:
+        return [v2idx.get(i, unk) for i in tokens]
+
+
+def compile_corpus(corpus_file, v2idx, save_prefix, l2_v2idx=None, lower_text=True):
+    files = compiled_corpus_files(save_prefix)
+    parallel = l2_v2idx is not None
+    index = array('q')
+    num_tokens = 0
+    byte_offset = 0
+    l1_out = open(files['l1'], 'wb')
+    l2_out = open(files['l2'], 'wb') if parallel else None
+    with open_corpus(corpus_file, 'rb') as f:
+        for raw_line in f:
+            line_offset = byte_offset
+            byte_offset += len(raw_line)
+            line = raw_line.decode('utf-8')
+            if line[0] == '#':
+                continue
+            lines = line.strip().split('|||')
+            l1_ids = to_ids(lines[0], v2idx, lower_text)
+            array('i', l1_ids).tofile(l1_out)
+            if parallel:
+                l2_ids = to_ids(lines[1], l2_v2idx, lower_text)
+                assert len(l2_ids) == len(l1_ids), "l1 and l2 lengths differ at byte " + str(line_offset)
+                array('i', l2_ids).tofile(l2_out)
+            index.extend([num_tokens, len(l1_ids), line_offset])
+            num_tokens += len(l1_ids)
+    l1_out.close()
+    if parallel:
+        l2_out.close()
+    np.save(files['idx'], np.frombuffer(index, dtype=np.int64).reshape(-1, 3))
+    with open(files['meta'], 'w', encoding='utf-8') as f:
+        json.dump({'source': corpus_file, 'compressed': compression_of(corpus_file) is not None,
+                   'parallel': parallel, 'lower_text': lower_text,
+                   'num_sents': len(index) // 3, 'num_tokens': num_tokens}, f)
+    print('compiled', corpus_file, len(index) // 3, 'sentences', num_tokens, 'tokens')
+    return save_prefix
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    v2idx = pickle.load(open(args.v2i, 'rb'))
+    l2_v2idx = pickle.load(open(args.gv2i, 'rb')) if args.gv2i is not None else None
+    compile_corpus(args.corpus, v2idx,
+                   args.save_prefix if args.save_prefix is not None else args.corpus,
+                   l2_v2idx=l2_v2idx,
+                   lower_text=args.lower_text == 1)
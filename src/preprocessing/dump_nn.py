@@ -1,35 +1,136 @@
 #!/usr/bin/env python
 import torch
+import hashlib
+import json
+import numpy as np
 import pickle
-from src.rewards import get_nearest_neighbors_simple
-import sys
+import queue
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from src.utils.utils import load_mat
+from src.preprocessing.nn_index import NN_INDEXES
+from src.preprocessing.nn_index import measure_recall
+import argparse
 import os
 
 
-def save_nn_mat(vmat, idx2v, data_dir):
-    r = 5000
-    nn_list = []
-    nn_txt = open(os.path.join(data_dir + 'l1.nn.txt'), 'w')
-    for i in range(int(vmat.shape[0] // r) + 1):
-        min_ = r * i
-        max_ = r * (i + 1)
-        max_ = vmat.shape[0] if max_ > vmat.shape[0] else max_
+def _nn_txt_writer(nn_txt_file, idx2v, chunks):
+    with open(nn_txt_file, 'w') as nn_txt:
+        while True:
+            f = chunks.get()
+            if f is None:
+                break
+            for row in range(f.shape[0]):
+                nn_txt.write(' '.join([idx2v[i_] for i_ in f[row, :].tolist()]) + '\n')
+            nn_txt.flush()
+
+
+def _put_while_alive(chunks, item, writer):
+    # a writer that died (disk full, ...) stops reading, do not block on its bounded queue forever
+    while writer.is_alive():
+        try:
+            chunks.put(item, timeout=1.0)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _mat_sha1(vmat):
+    # hashes the bytes (like StageCache hashes files), a sum would not tell permuted rows apart
+    return hashlib.sha1(vmat.detach().cpu().contiguous().numpy()).hexdigest()
+
+
+def _chunk_file(ckpt_dir, min_):
+    return os.path.join(ckpt_dir, 'chunk.{:d}.npy'.format(min_))
+
+
+def _open_checkpoints(ckpt_dir, meta):
+    # finished chunks are only reused if they were computed for the same matrix and settings
+    meta_file = os.path.join(ckpt_dir, 'meta.json')
+    if os.path.exists(meta_file):
+        with open(meta_file, 'r') as f:
+            if json.load(f) == meta:
+                return
+        shutil.rmtree(ckpt_dir)
+    os.makedirs(ckpt_dir, exist_ok=True)
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f)
+
+
+def save_nn_mat(vmat, idx2v, data_dir, index_type='exact', recall_sample=1000, num_workers=1, **index_args):
+    # every chunk in flight holds an (r x vocab) fp32 score matrix (~1.2GB for r=5000 at 60k words),
+    # r shrinks with num_workers so the concurrent chunks together stay at that size
+    r = max(1, 5000 // max(1, num_workers))
+    k = 51
+    index = NN_INDEXES[index_type](vmat, **index_args)
+    # anything but an fp32 exact scan is approximate (ivf, or a reduced precision scan + rerank)
+    if (index_type != 'exact' or index_args.get('precision', 'fp32') != 'fp32') and recall_sample > 0:
+        print('{} recall@{}: {:.4f}'.format(index_type, k, measure_recall(index, vmat, k, recall_sample)))
+    ckpt_dir = os.path.join(data_dir, 'l1.nn.chunks')
+    _open_checkpoints(ckpt_dir, {'shape': list(vmat.shape), 'dtype': str(vmat.dtype), 'sha1': _mat_sha1(vmat),
+                                 'index': index_type, 'index_args': index_args, 'k': k, 'r': r})
+    ranges = [(min_, min(min_ + r, vmat.shape[0])) for min_ in range(0, vmat.shape[0], r)]
+
+    def search_chunk(bounds):
+        min_, max_ = bounds
+        chunk_file = _chunk_file(ckpt_dir, min_)
+        if os.path.exists(chunk_file):
+            print(min_, max_, 'from checkpoint')
+            return np.load(chunk_file)
+        f = index.search(min_, max_, k)
+        np.save(chunk_file + '.tmp.npy', f)
+        os.replace(chunk_file + '.tmp.npy', chunk_file)
         print(min_, max_)
-        f = get_nearest_neighbors_simple(vmat[min_:max_], vmat, 51)
-        for row in range(f.shape[0]):
-            t = [idx2v[i_] for i_ in f[row, :].tolist()]
-            #print(' '.join(t))
-            nn_txt.write(' '.join(t) + '\n')
-        nn_txt.flush()
-        f = f[:, 1:]
-        nn_list.append(f)
-    nn_txt.close()
+        return f
+
+    nn_list = []
+    # the text dump is written by a thread so it overlaps with the search
+    chunks = queue.Queue(4)
+    writer = threading.Thread(target=_nn_txt_writer, args=(os.path.join(data_dir, 'l1.nn.txt'), idx2v, chunks))
+    writer.start()
+    try:
+        with ThreadPoolExecutor(max(1, num_workers)) as pool:
+            for f in pool.map(search_chunk, ranges):
+                f = torch.from_numpy(f).long()
+                if not _put_while_alive(chunks, f, writer):
+                    raise RuntimeError('the l1.nn.txt writer stopped')
+                nn_list.append(f[:, 1:])
+    finally:
+        sent = _put_while_alive(chunks, None, writer)
+        writer.join()
+    # the writer empties the queue up to the None unless it died on the way
+    if not sent or not chunks.empty():
+        raise RuntimeError('the l1.nn.txt writer stopped')
     nn_mat = torch.cat(nn_list, dim=0)
     torch.save(nn_mat, os.path.join(data_dir, 'l1.nn.pt'))
+    shutil.rmtree(ckpt_dir)
 
 
 if __name__ == '__main__':
-    l1_data = "/export/b07/arenduc1/macaronic-multi-agent/lmdata/" + sys.argv[1]
-    vmat = torch.load(l1_data + '/l1.mat.pt')
+    opt = argparse.ArgumentParser()
+    opt.add_argument('l1_data_name')
+    opt.add_argument('--lmdata', default="/export/b07/arenduc1/macaronic-multi-agent/lmdata/")
+    opt.add_argument('--index', dest='index_type', default='exact', choices=list(NN_INDEXES.keys()))
+    opt.add_argument('--nlist', type=int, default=None, help='ivf buckets (default 4 * sqrt(vocab))')
+    opt.add_argument('--nprobe', type=int, default=16, help='ivf buckets searched per query, trades speed for recall')
+    opt.add_argument('--recall_sample', type=int, default=1000, help='rows checked against exact search')
+    opt.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'fp16'],
+                     help='exact index: scan precision, candidates are re-ranked in fp32')
+    opt.add_argument('--rerank_factor', type=int, default=2,
+                     help='exact index with --precision bf16/fp16: rerank_factor * k scan candidates are rescored in fp32')
+    opt.add_argument('--num_workers', type=int, default=1,
+                     help='chunks searched concurrently, chunks get num_workers times smaller so peak memory stays flat')
+    args = opt.parse_args()
+    l1_data = os.path.join(args.lmdata, args.l1_data_name)
+    if os.path.exists(l1_data + '/l1.mat.npy'):
+        vmat = load_mat(l1_data + '/l1.mat.npy')
+    else:
+        vmat = torch.load(l1_data + '/l1.mat.pt')
     idx2v = pickle.load(open(l1_data + '/l1.idx2v.pkl', 'rb'))
-    save_nn_mat(vmat, idx2v, l1_data)
+    if args.index_type == 'ivf':
+        index_args = {'nlist': args.nlist, 'nprobe': args.nprobe}
+    else:
+        index_args = {'precision': args.precision, 'rerank_factor': args.rerank_factor}
+    save_nn_mat(vmat, idx2v, l1_data, args.index_type, args.recall_sample, args.num_workers, **index_args)
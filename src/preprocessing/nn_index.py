@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+import numpy as np
+import torch
+
+
+def normalize_rows(mat):
+    mat = np.asarray(mat, dtype=np.float32)
+    return mat / (np.linalg.norm(mat, axis=1, keepdims=True) + 1e-8)
+
+
+def sorted_topk(scores, k):
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+class ExactIndex(object):
+    """
+    brute force cosine top-k on a matrix normalized once up front. with precision bf16/fp16 the
+    full scan runs in reduced precision and the rerank_factor * k best candidates are rescored in fp32
+    """
+    def __init__(self, vmat, precision='fp32', rerank_factor=2):
+        self.mat = torch.from_numpy(normalize_rows(vmat.numpy() if isinstance(vmat, torch.Tensor) else vmat))
+        self.precision = precision
+        self.rerank_factor = rerank_factor
+        if precision == 'bf16':
+            self.low_mat = self.mat.to(torch.bfloat16)
+        elif precision == 'fp16':
+            self.low_mat = self.mat.half()
+        else:
+            assert precision == 'fp32'
+            self.low_mat = None
+
+    def search(self, start, end, k):
+        q = self.mat[start:end]
+        if self.low_mat is None:
+            return torch.topk(q @ self.mat.t(), k, 1, sorted=True)[1].numpy()
+        c = min(self.mat.shape[0], k * self.rerank_factor)
+        cand = torch.topk((self.low_mat[start:end] @ self.low_mat.t()).float(), c, 1, sorted=False)[1]
+        s = torch.bmm(self.mat[cand], q.unsqueeze(2)).squeeze(2)
+        top = torch.topk(s, k, 1, sorted=True)[1]
+        return torch.gather(cand, 1, top).numpy()
+
+
+class IVFIndex(object):
+    """
+    inverted file index: rows are bucketed by their closest k-means centroid (on the unit sphere),
+    a query is only scored against the rows of its nprobe closest buckets.
+    recall goes up with nprobe / nlist
+    """
+    def __init__(self, vmat, nlist=None, nprobe=16, kmeans_iters=10, kmeans_sample=100000, seed=1234):
+        self.mat = normalize_rows(vmat.numpy() if isinstance(vmat, torch.Tensor) else vmat)
+        n = self.mat.shape[0]
+        self.nlist = nlist if nlist is not None else max(1, int(4 * np.sqrt(n)))
+        self.nprobe = min(nprobe, self.nlist)
+        rng = np.random.RandomState(seed)
+        sample = self.mat[rng.choice(n, min(n, kmeans_sample), replace=False)]
+        self.centroids = sample[rng.choice(sample.shape[0], min(self.nlist, sample.shape[0]), replace=False)]
+        self.nlist = self.centroids.shape[0]
+        for _ in range(kmeans_iters):
+            assign = self.assign(sample)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assign, sample)
+            empty = np.bincount(assign, minlength=self.nlist) == 0
+            sums[empty] = self.centroids[empty]
+            self.centroids = normalize_rows(sums)
+        assign = self.assign(self.mat)
+        order = np.argsort(assign, kind='stable')
+        bounds = np.searchsorted(assign[order], np.arange(self.nlist + 1))
+        self.lists = [order[bounds[l]:bounds[l + 1]] for l in range(self.nlist)]
+
+    def assign(self, mat, chunk_size=50000):
+        return np.concatenate([np.argmax(mat[i: i + chunk_size] @ self.centroids.T, axis=1)
+                               for i in range(0, mat.shape[0], chunk_size)])
+
+    def search(self, start, end, k):
+        q = self.mat[start:end]
+        n = q.shape[0]
+        probe = np.argpartition(-(q @ self.centroids.T), self.nprobe - 1, axis=1)[:, :self.nprobe]
+        best_i = np.full((n, k), -1, dtype=np.int64)
+        best_s = np.full((n, k), -np.inf, dtype=np.float32)
+        # every probed bucket is scored once against all the queries that probe it
+        for l in np.unique(probe):
+            members = self.lists[l]
+            if len(members) == 0:
+                continue
+            qi = np.nonzero((probe == l).any(axis=1))[0]
+            s = np.concatenate([best_s[qi], q[qi] @ self.mat[members].T], axis=1)
+            i = np.concatenate([best_i[qi], np.broadcast_to(members, (len(qi), len(members)))], axis=1)
+            top, best_s[qi] = sorted_topk(s, k)
+            best_i[qi] = np.take_along_axis(i, top, axis=1)
+        short = np.nonzero((best_i < 0).any(axis=1))[0]
+        if len(short) > 0:
+            # too few candidates in the probed buckets, fall back to exact for those rows
+            best_i[short] = sorted_topk(q[short] @ self.mat.T, k)[0]
+        return best_i
+
+
+NN_INDEXES = {'exact': ExactIndex, 'ivf': IVFIndex}
+
+
+def measure_recall(index, vmat, k, sample_size=1000, seed=1234):
+    """
+    recall@k of index against exact cosine neighbors on a random sample of rows
+    """
+    mat = normalize_rows(vmat.numpy() if isinstance(vmat, torch.Tensor) else vmat)
+    rng = np.random.RandomState(seed)
+    rows = np.sort(rng.choice(mat.shape[0], min(sample_size, mat.shape[0]), replace=False))
+    hits = 0
+    for r in rows:
+        exact = sorted_topk(mat[r: r + 1] @ mat.T, k)[0][0]
+        approx = index.search(r, r + 1, k)[0]
+        hits += len(set(exact.tolist()) & set(approx.tolist()))
+    return hits / float(len(rows) * k)
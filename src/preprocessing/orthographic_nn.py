@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from multiprocessing import Pool
+import editdistance as ed
+
+
+class BKTree(object):
+    """
+    Burkhard-Keller tree over edit distance, each node is [word_idx, {distance: child_node}]
+    """
+    def __init__(self, words):
+        self.words = words
+        self.root = None
+        for w_idx in range(len(words)):
+            self.add(w_idx)
+
+    def add(self, w_idx):
+        if self.root is None:
+            self.root = [w_idx, {}]
+            return
+        node = self.root
+        while True:
+            d = ed.eval(self.words[w_idx], self.words[node[0]])
+            child = node[1].get(d, None)
+            if child is None:
+                node[1][d] = [w_idx, {}]
+                return
+            node = child
+
+    def search(self, query, radius):
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while len(stack) > 0:
+            node = stack.pop()
+            d = ed.eval(query, self.words[node[0]])
+            if d <= radius:
+                found.append((node[0], d))
+            for child_d, child in node[1].items():
+                if d - radius <= child_d <= d + radius:
+                    stack.append(child)
+        return found
+
+
+_tree = None
+_ids = None
+
+
+def _init_worker(tree, ids):
+    global _tree, _ids
+    _tree = tree
+    _ids = ids
+
+
+def closest(l2_v, threshold):
+    # ed / max(len(l2_v), len(l1_v)) <= threshold and len(l1_v) <= len(l2_v) + ed
+    # give ed <= threshold * len(l2_v) / (1 - threshold)
+    radius = int(threshold * len(l2_v) / (1.0 - threshold) + 1e-9)
+    best = None
+    for w_idx, d in _tree.search(l2_v, radius):
+        e = d / max(len(l2_v), len(_tree.words[w_idx]))
+        if e <= threshold:
+            l1_i = _ids[w_idx]
+            if best is None or e < best[0] or (e == best[0] and l1_i < best[1]):
+                best = (e, l1_i)
+    return best
+
+
+def _closest_chunk(args):
+    l2_vs, threshold = args
+    return [closest(l2_v, threshold) for l2_v in l2_vs]
+
+
+def min_ed_neighbors(l2_idx2v, l1_idx2v, max_l1_idx=10000, threshold=0.334, num_workers=1, chunk_size=256):
+    """
+    for every l2 type, the l1 type (with index < max_l1_idx) with the smallest normalized edit distance,
+    ties going to the smaller l1 index. same output as the brute force scan over l1_idx2v.
+    returns {(l2_i, l2_v): (e, (l1_i, l1_v))} for l2 types with a neighbor within threshold
+    """
+    l1_items = sorted((l1_i, l1_v) for l1_i, l1_v in l1_idx2v.items() if l1_i < max_l1_idx)
+    ids = [l1_i for l1_i, _ in l1_items]
+    tree = BKTree([l1_v for _, l1_v in l1_items])
+    l2_items = list(l2_idx2v.items())
+    l2_vs = [l2_v for _, l2_v in l2_items]
+    chunks = [(l2_vs[i: i + chunk_size], threshold) for i in range(0, len(l2_vs), chunk_size)]
+    if num_workers > 1:
+        with Pool(num_workers, initializer=_init_worker, initargs=(tree, ids)) as pool:
+            results = pool.map(_closest_chunk, chunks)
+    else:
+        _init_worker(tree, ids)
+        results = [_closest_chunk(c) for c in chunks]
+    l2_l1_min_ed = {}
+    for (l2_i, l2_v), best in zip(l2_items, [b for r in results for b in r]):
+        if best is not None:
+            e, l1_i = best
+            l2_l1_min_ed[(l2_i, l2_v)] = (e, (l1_i, l1_idx2v[l1_i]))
+    return l2_l1_min_ed
@@ -2,9 +2,18 @@
 import os
 import pickle
 import argparse
+from multiprocessing import Pool
+from multiprocessing import get_context
+import numpy as np
+from numpy.lib.format import open_memmap
 import torch
 import fastText
 from ..utils.utils import SPECIAL_TOKENS
+from ..utils.utils import compression_of
+from ..utils.utils import find_corpus
+from ..utils.utils import load_mat
+from ..utils.utils import save_spelling_mat
+from ..utils.utils import open_corpus
 from src.rewards import get_nearest_neighbors_simple
 
 
@@ -15,6 +24,8 @@ def parse_args():
     parser.add_argument('--wordvec_bin', action='store', dest='word_vec_file', required=True)
     parser.add_argument('--max_word_len', type=int, default=20, help='ignore words longer than this')
     parser.add_argument('--max_vocab', type=int, default=100000, help='only keep most frequent words')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='count the vocab over byte ranges of the corpus in this many processes')
     return parser.parse_args()
 
 
@@ -42,16 +53,80 @@ def load_word_vec(_file, voc2i):
     #    else:
     #        missing.append(v)
     #print(len(missing), 'got random vec')
-    mat = torch.FloatTensor(len(voc2i), 300).uniform_(-1.0, 1.0)
+    mat = torch.empty(len(voc2i), ft_model.get_dimension())
     for v, i in voc2i.items():
         mat[i, :] = torch.tensor(ft_model.get_word_vector(v))
     return mat
 
 
+_ft_model = None
+
+
+def _extract_rows(args):
+    mat_file, words, start = args
+    mat = np.load(mat_file, mmap_mode='r+')
+    for i, w in enumerate(words):
+        mat[start + i, :] = _ft_model.get_word_vector(w)
+    mat.flush()
+    return len(words)
+
+
+def extract_word_vecs(ft_model, words, mat_file, num_workers=1, chunk_size=2000):
+    """
+    writes ft_model.get_word_vector(words[i]) into row i of a float32 .npy at mat_file,
+    workers are forked after the model is loaded so they share it instead of reloading it
+    """
+    global _ft_model
+    _ft_model = ft_model
+    mat = open_memmap(mat_file, mode='w+', dtype=np.float32, shape=(len(words), ft_model.get_dimension()))
+    del mat
+    jobs = [(mat_file, words[i: i + chunk_size], i) for i in range(0, len(words), chunk_size)]
+    if num_workers > 1:
+        with get_context('fork').Pool(num_workers) as pool:
+            pool.map(_extract_rows, jobs)
+    else:
+        for job in jobs:
+            _extract_rows(job)
+    return mat_file
+
+
 def to_str(lst):
     return ','.join([str(i) for i in lst])
 
 
+def byte_ranges(corpus_file, num_ranges, start=0):
+    size = os.path.getsize(corpus_file)
+    bounds = [start + ((size - start) * i) // num_ranges for i in range(num_ranges + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(num_ranges) if bounds[i] < bounds[i + 1]]
+
+
+def count_range(args):
+    # a line belongs to the range its first byte falls in
+    corpus_file, start, end, spl_words, max_word_len = args
+    wc = {}
+    total_words = 0
+    with open(corpus_file, 'rb') as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            words = line.decode('utf-8').strip().split()
+            assert len(words) > 0, 'line at byte ' + str(pos) + ' is empty'
+            pos += len(line)
+            for word in words:
+                word = word.lower()
+                if word in spl_words:
+                    pass
+                elif len(word) + 2 < max_word_len:
+                    wc[word] = wc.get(word, 0) + 1
+                    total_words += 1
+    return wc, total_words
+
+
 
 
 class Preprocess(object):
@@ -62,8 +137,23 @@ class Preprocess(object):
                               SPECIAL_TOKENS.EOS,
                               SPECIAL_TOKENS.UNK])
 
+    def count_words_parallel(self, corpus_file, max_word_len, num_workers):
+        # merging the range counters in file order keeps first-occurrence order in self.wc,
+        # so the frequency sort below breaks ties exactly like the sequential loop
+        ranges = byte_ranges(corpus_file, num_workers * 8)
+        self.wc = {}
+        total_words = 0
+        with Pool(num_workers) as pool:
+            jobs = [(corpus_file, start, end, self.spl_words, max_word_len) for start, end in ranges]
+            for r_idx, (wc, r_total_words) in enumerate(pool.imap(count_range, jobs)):
+                for word, count in wc.items():
+                    self.wc[word] = self.wc.get(word, 0) + count
+                total_words += r_total_words
+                print("counted range {} of {}".format(r_idx + 1, len(ranges)))
+        return total_words
+
     def build(self, data_dir, corpus_file, dev_file,
-              max_word_len=30, max_vocab=50000):
+              max_word_len=30, max_vocab=50000, num_workers=1):
         c1gram2idx = {}
         c2gram2idx = {}
         c3gram2idx = {}
@@ -84,22 +174,25 @@ class Preprocess(object):
         line_num = 0
         self.wc = {}
         total_words = 0
-        with open(corpus_file, 'r', encoding='utf-8') as f:
-            for line in f:
-                line_num += 1
-                if not line_num % 1000:
-                    print("working on {}kth line".format(line_num // 1000))
-                words = line.strip().split()
-                assert len(words) > 0, str(line_num) + ' is empty'
-                for word in words:
-                    word = word.lower()
-                    if word in self.spl_words:
-                        pass
-                    elif len(word) + 2 < max_word_len:
-                        self.wc[word] = self.wc.get(word, 0) + 1
-                        total_words += 1
-                    else:
-                        pass
+        if num_workers > 1 and compression_of(corpus_file) is None:
+            total_words = self.count_words_parallel(corpus_file, max_word_len, num_workers)
+        else:
+            with open_corpus(corpus_file) as f:
+                for line in f:
+                    line_num += 1
+                    if not line_num % 1000:
+                        print("working on {}kth line".format(line_num // 1000))
+                    words = line.strip().split()
+                    assert len(words) > 0, str(line_num) + ' is empty'
+                    for word in words:
+                        word = word.lower()
+                        if word in self.spl_words:
+                            pass
+                        elif len(word) + 2 < max_word_len:
+                            self.wc[word] = self.wc.get(word, 0) + 1
+                            total_words += 1
+                        else:
+                            pass
         print("")
         print("total word types", len(self.wc))
         self.vocab = [SPECIAL_TOKENS.PAD, SPECIAL_TOKENS.BOS, SPECIAL_TOKENS.EOS, SPECIAL_TOKENS.UNK] + \
@@ -179,10 +272,10 @@ class Preprocess(object):
         print('v2idx size', len(v2idx))
         assert len(idx2v) == len(v2idx) == len(vidx2c1gram_spelling)
         pickle.dump(v2idx, open(os.path.join(data_dir, 'l1.v2idx.pkl'), 'wb'))
-        pickle.dump(vidx2c1gram_spelling, open(os.path.join(data_dir, 'l1.vidx2c1gram_spelling.pkl'), 'wb'))
-        pickle.dump(vidx2c2gram_spelling, open(os.path.join(data_dir, 'l1.vidx2c2gram_spelling.pkl'), 'wb'))
-        pickle.dump(vidx2c3gram_spelling, open(os.path.join(data_dir, 'l1.vidx2c3gram_spelling.pkl'), 'wb'))
-        pickle.dump(vidx2c4gram_spelling, open(os.path.join(data_dir, 'l1.vidx2c4gram_spelling.pkl'), 'wb'))
+        save_spelling_mat(vidx2c1gram_spelling, os.path.join(data_dir, 'l1.vidx2c1gram_spelling'))
+        save_spelling_mat(vidx2c2gram_spelling, os.path.join(data_dir, 'l1.vidx2c2gram_spelling'))
+        save_spelling_mat(vidx2c3gram_spelling, os.path.join(data_dir, 'l1.vidx2c3gram_spelling'))
+        save_spelling_mat(vidx2c4gram_spelling, os.path.join(data_dir, 'l1.vidx2c4gram_spelling'))
         pickle.dump(vidx2unigram_prob, open(os.path.join(data_dir, 'l1.vidx2unigram_prob.pkl'), 'wb'))
         print('char vocab size', len(c1gram2idx), len(idx2c1gram))
         assert len(idx2c1gram) == len(c1gram2idx)
@@ -206,12 +299,15 @@ class Preprocess(object):
 if __name__ == '__main__':
     args = parse_args()
     preprocess = Preprocess()
-    corpus_file = os.path.join(args.data_dir, 'corpus.en')
-    dev_file = os.path.join(args.data_dir, 'dev.en')
+    corpus_file = find_corpus(os.path.join(args.data_dir, 'corpus.en'))
+    dev_file = find_corpus(os.path.join(args.data_dir, 'dev.en'))
     v2idx = preprocess.build(data_dir=args.data_dir,
                              corpus_file=corpus_file,
                              dev_file=dev_file,
                              max_word_len=args.max_word_len,
-                             max_vocab=args.max_vocab)
-    embedding = load_word_vec(args.word_vec_file, v2idx)
+                             max_vocab=args.max_vocab,
+                             num_workers=args.num_workers)
+    extract_word_vecs(fastText.load_model(args.word_vec_file), sorted(v2idx, key=v2idx.get),
+                      os.path.join(args.data_dir, 'l1.mat.npy'), num_workers=args.num_workers)
+    embedding = load_mat(os.path.join(args.data_dir, 'l1.mat.npy'))
     torch.save(embedding, os.path.join(args.data_dir, 'l1.mat.pt'))
@@ -4,8 +4,20 @@ import os
 import pickle
 import argparse
 import fastText
+from multiprocessing import Pool
+import numpy as np
 import torch
 from src.utils.utils import SPECIAL_TOKENS
+from src.utils.utils import find_corpus
+from src.utils.utils import open_corpus
+from src.utils.utils import load_mat
+from src.utils.utils import save_spelling_mat
+from src.utils.utils import save_line_keys
+from src.utils.utils import compression_of
+from src.preprocessing.preprocess_l1_corpus import byte_ranges
+from src.preprocessing.preprocess_l1_corpus import extract_word_vecs
+from src.preprocessing.orthographic_nn import min_ed_neighbors
+from src.preprocessing.stage_cache import StageCache
 
 import editdistance as ed
 import math
@@ -21,6 +33,8 @@ def parse_args():
                         help="l2 save dir")
     parser.add_argument('--max_word_len', type=int, default=20, help='cut off words longer than this')
     parser.add_argument('--wordvec_bin', action='store', dest='word_vec_file', required=True)
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='processes for the per line key extraction and the edit distance search')
     return parser.parse_args()
 
 
@@ -28,6 +42,77 @@ def to_str(lst):
     return ','.join([str(i) for i in lst])
 
 
+_key_vocab = None
+
+
+def _init_key_worker(key_vocab):
+    global _key_vocab
+    _key_vocab = key_vocab
+
+
+def line_key(line):
+    # sorted (l1, l2) index pairs of the aligned, in-vocabulary, non-special tokens of a parallel line
+    l1_v2idx, l2_v2idx, spl_words = _key_vocab
+    l1_line, l2_line = line.split('|||')
+    key = set()
+    for l1_w, l2_w in zip(l1_line.strip().split(), l2_line.strip().split()):
+        l2_w = l2_w.lower()
+        l1_w = l1_w.lower()
+        if l1_w in l1_v2idx and l2_w in l2_v2idx and l1_w not in spl_words and l2_w not in spl_words:
+            key.add((l1_v2idx[l1_w], l2_v2idx[l2_w]))
+    return sorted(key)
+
+
+def key_range(args):
+    # same line ownership rule as preprocess_l1_corpus.count_range
+    corpus_file, start, end = args
+    line_lens = []
+    pairs = []
+    with open(corpus_file, 'rb') as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            key = line_key(line.decode('utf-8'))
+            line_lens.append(len(key))
+            pairs.extend(key)
+    return np.array(line_lens, dtype=np.int64), np.array(pairs, dtype=np.int32).reshape(-1, 2)
+
+
+def extract_line_keys(corpus_file, l1_v2idx, l2_v2idx, spl_words, num_workers=1, start=0):
+    """
+    per line keys of the parallel corpus as (line_lens, pairs), pairs is an (N, 2) int32 array of
+    the concatenated sorted per line keys of the lines starting at or after byte start.
+    uncompressed corpora are split into byte ranges that are processed in parallel and
+    concatenated in file order
+    """
+    _init_key_worker((l1_v2idx, l2_v2idx, spl_words))
+    if compression_of(corpus_file) is None:
+        ranges = [(corpus_file, r_start, r_end)
+                  for r_start, r_end in byte_ranges(corpus_file, num_workers * 4 if num_workers > 1 else 1, start)]
+        if num_workers > 1:
+            with Pool(num_workers) as pool:
+                results = pool.map(key_range, ranges)
+        else:
+            results = [key_range(r) for r in ranges]
+        return np.concatenate([np.zeros(0, dtype=np.int64)] + [r[0] for r in results]), \
+            np.concatenate([np.zeros((0, 2), dtype=np.int32)] + [r[1] for r in results])
+    assert start == 0, "compressed corpora can only be read from the start"
+    line_lens = []
+    pairs = []
+    with open_corpus(corpus_file) as f:
+        for line in f:
+            key = line_key(line)
+            line_lens.append(len(key))
+            pairs.extend(key)
+    return np.array(line_lens, dtype=np.int64), np.array(pairs, dtype=np.int32).reshape(-1, 2)
+
+
 class Preprocess(object):
     def __init__(self):
         self.spl_words = set([SPECIAL_TOKENS.PAD,
@@ -35,76 +120,132 @@ class Preprocess(object):
                               SPECIAL_TOKENS.EOS,
                               SPECIAL_TOKENS.UNK])
 
-    def build(self, l1_data_dir, l2_data_dir, l2_save_dir, ft_model, max_word_len):
-        #l1_vocab = pickle.load(open(os.path.join(l1_data_dir, 'l1.vocab.pkl'), 'rb'))
-        l1_idx2v = pickle.load(open(os.path.join(l1_data_dir, 'l1.idx2v.pkl'), 'rb'))
-        l1_v2idx = pickle.load(open(os.path.join(l1_data_dir, 'l1.v2idx.pkl'), 'rb'))
-        l1_mat = torch.load(l1_data_dir + '/l1.mat.pt')
-        #l1_vidx2c1gram_spelling = pickle.load(open(os.path.join(l1_data_dir, 'l1.vidx2c1gram_spelling.pkl'), 'rb'))
-        #l1_vidx2unigram_prob = pickle.load(open(os.path.join(l1_data_dir, 'l1.vidx2unigram_prob.pkl'), 'rb'))
-        #l1_idx2c1gram = pickle.load(open(os.path.join(l1_data_dir, 'l1.idx2c1gram.pkl'), 'rb'))
-        l1_c1gram2idx = pickle.load(open(os.path.join(l1_data_dir, 'l1.c1gram2idx.pkl'), 'rb'))
-        l1_c2gram2idx = pickle.load(open(os.path.join(l1_data_dir, 'l1.c2gram2idx.pkl'), 'rb'))
-        l1_c3gram2idx = pickle.load(open(os.path.join(l1_data_dir, 'l1.c3gram2idx.pkl'), 'rb'))
-        l1_c4gram2idx = pickle.load(open(os.path.join(l1_data_dir, 'l1.c4gram2idx.pkl'), 'rb'))
-
-        l2_v2idx = {SPECIAL_TOKENS.PAD: 0, SPECIAL_TOKENS.BOS: 1, SPECIAL_TOKENS.EOS: 2, SPECIAL_TOKENS.UNK: 3}
-        l2_idx2v = {0: SPECIAL_TOKENS.PAD, 1: SPECIAL_TOKENS.BOS, 2: SPECIAL_TOKENS.EOS, 3: SPECIAL_TOKENS.UNK}
-        l2_vidx2count = {0: 0, 1: 0, 2: 0, 3: 0}
-        l2_vidx2line_nums = {0: set([]), 1: set([]), 2: set([]), 3: set([])}
-        full_data_key = set([])
-        line_keys = []
-        print('loaded l1 data...')
-        l2_line_idx = 0
-        l2_line_term_count = {}
-        with open(os.path.join(l2_data_dir, 'parallel_corpus'), 'r', encoding='utf-8') as f:
-            for line in f:
-                print(line)
+    def count_stats(self, corpus_file, stats=None, start=0):
+        """
+        streaming pass over the lines of corpus_file starting at byte start, collecting the l2 vocab,
+        term counts and document frequencies (number of lines a type occurs in). stats from an
+        earlier pass over the first start bytes are continued, so a grown corpus only reads its new lines
+        """
+        if stats is None:
+            stats = {'v2idx': {SPECIAL_TOKENS.PAD: 0, SPECIAL_TOKENS.BOS: 1, SPECIAL_TOKENS.EOS: 2, SPECIAL_TOKENS.UNK: 3},
+                     'idx2v': {0: SPECIAL_TOKENS.PAD, 1: SPECIAL_TOKENS.BOS, 2: SPECIAL_TOKENS.EOS, 3: SPECIAL_TOKENS.UNK},
+                     'count': {0: 0, 1: 0, 2: 0, 3: 0},
+                     'df': {0: 0, 1: 0, 2: 0, 3: 0},
+                     'num_lines': 0,
+                     'offset': 0,
+                     'tail_newline': True}
+        l2_v2idx = stats['v2idx']
+        l2_idx2v = stats['idx2v']
+        l2_vidx2count = stats['count']
+        l2_vidx2line_nums = stats['df']
+        # a type is counted once per line by remembering the last line it was seen on,
+        # line numbers only grow so this does not need to survive between passes
+        l2_vidx2last_line = {}
+        l2_line_idx = stats['num_lines']
+        offset = stats['offset']
+        with open_corpus(corpus_file, 'rb') as f:
+            if start > 0:
+                f.seek(start)
+            for raw_line in f:
+                offset += len(raw_line)
+                stats['tail_newline'] = raw_line.endswith(b'\n')
                 l2_line_idx += 1
-                line_key = set()
-                l1_line, l2_line = line.split('|||')
+                if not l2_line_idx % 100000:
+                    print("working on {}kth line".format(l2_line_idx // 1000))
+                l1_line, l2_line = raw_line.decode('utf-8').split('|||')
                 l1_line_txt = l1_line.strip().split()
                 l2_line_txt = l2_line.strip().split()
                 assert len(l1_line_txt) == len(l2_line_txt)
-                for l1_w, l2_w in zip(l1_line_txt, l2_line_txt):
+                for l2_w in l2_line_txt:
                     l2_w = l2_w.lower()
-                    l1_w = l1_w.lower()
                     if l2_w != SPECIAL_TOKENS.NULL:
                         l2_w_idx = l2_v2idx.get(l2_w, len(l2_v2idx))
                         l2_v2idx[l2_w] = l2_w_idx
                         l2_idx2v[l2_w_idx] = l2_w
                         l2_vidx2count[l2_w_idx] = l2_vidx2count.get(l2_w_idx, 0) + 1
-                        l2_vidx2line_nums[l2_w_idx] = l2_vidx2line_nums.get(l2_w_idx, set([])).union(set([l2_line_idx]))
-                        l2_line_term_count[l2_line_idx, l2_w_idx] = l2_line_term_count.get((l2_line_idx, l2_w_idx), 0) + 1
-
-                    if l1_w in l1_v2idx and l2_w in l2_v2idx and \
-                        l1_w not in [SPECIAL_TOKENS.PAD, SPECIAL_TOKENS.BOS, SPECIAL_TOKENS.EOS, SPECIAL_TOKENS.UNK] and \
-                            l2_w not in [SPECIAL_TOKENS.PAD, SPECIAL_TOKENS.BOS, SPECIAL_TOKENS.EOS, SPECIAL_TOKENS.UNK]:
-                        full_data_key.add((l1_v2idx[l1_w], l2_v2idx[l2_w]))
-                        line_key.add((l1_v2idx[l1_w], l2_v2idx[l2_w]))
-                        print(l1_w, l2_w, l1_v2idx[l1_w], l2_v2idx[l2_w])
-                #assert len(line_key) > 0, "this line has issues" + str(line)
-                line_keys.append(list(sorted(line_key)))
-        full_data_key = list(sorted(full_data_key))
-        assert len(l2_v2idx) == len(l2_idx2v)
-        pickle.dump(l2_v2idx, open(os.path.join(l2_save_dir, 'l2.v2idx.pkl'), 'wb'))
-        pickle.dump(l2_idx2v, open(os.path.join(l2_save_dir, 'l2.idx2v.pkl'), 'wb'))
-        l2_max_count = max(l2_vidx2count.values())
-        l2_vidx2tf = {}
-        for l2_vidx, l2_vidx_c in l2_vidx2count.items():
-            l2_vidx2tf[l2_vidx] = float(l2_vidx_c) / float(l2_max_count)
-        for l2_vidx, l2_d in l2_vidx2line_nums.items():
-            l2_vidx2line_nums[l2_vidx] = len(l2_d)
+                        if l2_vidx2last_line.get(l2_w_idx, 0) != l2_line_idx:
+                            l2_vidx2last_line[l2_w_idx] = l2_line_idx
+                            l2_vidx2line_nums[l2_w_idx] = l2_vidx2line_nums.get(l2_w_idx, 0) + 1
+        stats['num_lines'] = l2_line_idx
+        stats['offset'] = offset
+        return stats
+
+    def grown_from(self, corpus_file, offset, prefix_sha1, cache):
+        # true if corpus_file still starts with the offset bytes that hashed to prefix_sha1
+        return offset > 0 and compression_of(corpus_file) is None and \
+            os.path.getsize(corpus_file) >= offset and cache.prefix_hash(corpus_file, offset) == prefix_sha1
+
+    def build_stats(self, corpus_file, l2_save_dir, cache):
+        stats_file = os.path.join(l2_save_dir, 'l2.stats.pkl')
+        stats = pickle.load(open(stats_file, 'rb')) if os.path.exists(stats_file) else None
+        if stats is not None and stats['tail_newline'] and \
+                self.grown_from(corpus_file, stats['offset'], stats['prefix_sha1'], cache):
+            print('parallel corpus grew, counting lines after line', stats['num_lines'])
+            stats = self.count_stats(corpus_file, stats, stats['offset'])
+        else:
+            stats = self.count_stats(corpus_file)
+        stats['prefix_sha1'] = cache.file_hash(corpus_file) if compression_of(corpus_file) is None else None
+        assert len(stats['v2idx']) == len(stats['idx2v'])
+        pickle.dump(stats, open(stats_file, 'wb'))
+        pickle.dump(stats['v2idx'], open(os.path.join(l2_save_dir, 'l2.v2idx.pkl'), 'wb'))
+        pickle.dump(stats['idx2v'], open(os.path.join(l2_save_dir, 'l2.idx2v.pkl'), 'wb'))
+
+    def build_keys(self, corpus_file, l1_data_dir, l2_save_dir, l1_mat, num_workers, cache):
+        l1_idx2v = pickle.load(open(os.path.join(l1_data_dir, 'l1.idx2v.pkl'), 'rb'))
+        l1_v2idx = pickle.load(open(os.path.join(l1_data_dir, 'l1.v2idx.pkl'), 'rb'))
+        stats = pickle.load(open(os.path.join(l2_save_dir, 'l2.stats.pkl'), 'rb'))
+        l2_v2idx = stats['v2idx']
+        l2_idx2v = stats['idx2v']
+        key_prefix = os.path.join(l2_save_dir, 'per_line.l1.l2.key')
+        l1_v2idx_sha1 = cache.file_hash(os.path.join(l1_data_dir, 'l1.v2idx.pkl'))
+        prev = cache.info('l2.keys')
+        # l2 indices are assigned in first-seen order, so keys of lines already processed stay valid
+        # as long as the l1 vocab is the same and the corpus only had lines appended
+        if prev.get('l1_v2idx') == l1_v2idx_sha1 and os.path.exists(key_prefix + '.offsets.npy') and \
+                self.grown_from(corpus_file, prev.get('offset', 0), prev.get('prefix_sha1'), cache):
+            print('extracting per line keys after line', prev['num_lines'])
+            offsets = np.load(key_prefix + '.offsets.npy')
+            assert len(offsets) == prev['num_lines'] + 1
+            new_lens, new_pairs = extract_line_keys(corpus_file, l1_v2idx, l2_v2idx, self.spl_words, num_workers,
+                                                    start=prev['offset'])
+            line_lens = np.concatenate([np.diff(offsets), new_lens])
+            line_key_pairs = np.concatenate([np.load(key_prefix + '.pairs.npy'), new_pairs])
+        else:
+            line_lens, line_key_pairs = extract_line_keys(corpus_file, l1_v2idx, l2_v2idx, self.spl_words, num_workers)
+        assert len(line_lens) == stats['num_lines']
+        full_data_key = [tuple(p) for p in np.unique(line_key_pairs, axis=0).tolist()]
         l2_vidx2idf = {}
-        for l2_vidx, l2_dlen in l2_vidx2line_nums.items():
+        for l2_vidx, l2_dlen in stats['df'].items():
             if l2_dlen == 0:
                 l2_vidx2idf[l2_vidx] = 0.0
             else:
-                l2_vidx2idf[l2_vidx] = math.log(float(l2_line_idx) / (float(l2_dlen))) + 1.0
+                l2_vidx2idf[l2_vidx] = math.log(float(stats['num_lines']) / (float(l2_dlen))) + 1.0
 
         l2_key_wt = []
         for l1k, l2k in full_data_key:
             l2_key_wt.append(l2_vidx2idf[l2k])
+        pickle.dump(full_data_key, open(os.path.join(l2_save_dir, 'l1.l2.key.pkl'), 'wb'))
+        pickle.dump(l2_key_wt, open(os.path.join(l2_save_dir, 'l2.key.wt.pkl'), 'wb'))
+        save_line_keys(line_lens, line_key_pairs, key_prefix)
+
+        mat_key = torch.FloatTensor(len(l2_idx2v), 300).fill_(0.0)
+        mat_key[[0, 1, 2, 3], :] = l1_mat[[0, 1, 2, 3], :]
+        txt_key = open(os.path.join(l2_save_dir, 'full_data_key.txt'), 'w', encoding='utf-8')
+        for l1idx, l2idx in full_data_key:
+            txt = str(l1idx) + ' ' + l1_idx2v[l1idx] + ' ' + ' ' + str(l2idx) + ' ' + l2_idx2v[l2idx] + '\n'
+            txt_key.write(txt)
+            mat_key[l2idx, :] = l1_mat[l1idx, :]
+        txt_key.close()
+        torch.save(mat_key, l2_save_dir + '/l2_key.mat.pt')
+        return {'offset': stats['offset'], 'num_lines': stats['num_lines'],
+                'prefix_sha1': stats['prefix_sha1'], 'l1_v2idx': l1_v2idx_sha1}
+
+    def build_spellings(self, l1_data_dir, l2_save_dir):
+        l1_c1gram2idx = pickle.load(open(os.path.join(l1_data_dir, 'l1.c1gram2idx.pkl'), 'rb'))
+        l1_c2gram2idx = pickle.load(open(os.path.join(l1_data_dir, 'l1.c2gram2idx.pkl'), 'rb'))
+        l1_c3gram2idx = pickle.load(open(os.path.join(l1_data_dir, 'l1.c3gram2idx.pkl'), 'rb'))
+        l1_c4gram2idx = pickle.load(open(os.path.join(l1_data_dir, 'l1.c4gram2idx.pkl'), 'rb'))
+        l2_v2idx = pickle.load(open(os.path.join(l2_save_dir, 'l2.v2idx.pkl'), 'rb'))
         l2_c1gram2idx = {}
         l2_c2gram2idx = {}
         l2_c3gram2idx = {}
@@ -124,7 +265,6 @@ class Preprocess(object):
         max_vl4_by_l1 = 0
         vocab_info_by_l1 = []
         for l2_v, l2_idx in l2_v2idx.items():
-            print('spelling', l2_v, l2_idx)
             if l2_v not in [SPECIAL_TOKENS.PAD, SPECIAL_TOKENS.NULL, SPECIAL_TOKENS.BOS, SPECIAL_TOKENS.EOS, SPECIAL_TOKENS.UNK]:
                 l2_c1grams = [SPECIAL_TOKENS.BOW] + [c for c in l2_v] + [SPECIAL_TOKENS.EOW]
                 l2_c2grams = [''.join(z) for z in zip(*[l2_c1grams[i:] for i in range(2)])]
@@ -193,10 +333,11 @@ class Preprocess(object):
             padder4 = [0] * (max_vl4 - c4l)
             l2_vidx2c4gram_spelling[l2_idx] = cs4 + padder4 + [c4l]
 
-        pickle.dump(l2_vidx2c1gram_spelling, open(os.path.join(l2_save_dir, 'l2.vidx2c1gram_spelling.pkl'), 'wb'))
-        pickle.dump(l2_vidx2c2gram_spelling, open(os.path.join(l2_save_dir, 'l2.vidx2c2gram_spelling.pkl'), 'wb'))
-        pickle.dump(l2_vidx2c3gram_spelling, open(os.path.join(l2_save_dir, 'l2.vidx2c3gram_spelling.pkl'), 'wb'))
-        pickle.dump(l2_vidx2c4gram_spelling, open(os.path.join(l2_save_dir, 'l2.vidx2c4gram_spelling.pkl'), 'wb'))
+
+        save_spelling_mat(l2_vidx2c1gram_spelling, os.path.join(l2_save_dir, 'l2.vidx2c1gram_spelling'))
+        save_spelling_mat(l2_vidx2c2gram_spelling, os.path.join(l2_save_dir, 'l2.vidx2c2gram_spelling'))
+        save_spelling_mat(l2_vidx2c3gram_spelling, os.path.join(l2_save_dir, 'l2.vidx2c3gram_spelling'))
+        save_spelling_mat(l2_vidx2c4gram_spelling, os.path.join(l2_save_dir, 'l2.vidx2c4gram_spelling'))
 
         l2_vidx2c1gram_by_l1_spelling = {}
         l2_vidx2c2gram_by_l1_spelling = {}
@@ -216,10 +357,11 @@ class Preprocess(object):
             padder4 = [0] * (max_vl4_by_l1 - c4l)
             l2_vidx2c4gram_by_l1_spelling[l2_idx] = cs4_by_l1 + padder4 + [c4l]
 
-        pickle.dump(l2_vidx2c1gram_by_l1_spelling, open(os.path.join(l2_save_dir, 'l2.vidx2c1gram_by_l1_spelling.pkl'), 'wb'))
-        pickle.dump(l2_vidx2c2gram_by_l1_spelling, open(os.path.join(l2_save_dir, 'l2.vidx2c2gram_by_l1_spelling.pkl'), 'wb'))
-        pickle.dump(l2_vidx2c3gram_by_l1_spelling, open(os.path.join(l2_save_dir, 'l2.vidx2c3gram_by_l1_spelling.pkl'), 'wb'))
-        pickle.dump(l2_vidx2c4gram_by_l1_spelling, open(os.path.join(l2_save_dir, 'l2.vidx2c4gram_by_l1_spelling.pkl'), 'wb'))
+
+        save_spelling_mat(l2_vidx2c1gram_by_l1_spelling, os.path.join(l2_save_dir, 'l2.vidx2c1gram_by_l1_spelling'))
+        save_spelling_mat(l2_vidx2c2gram_by_l1_spelling, os.path.join(l2_save_dir, 'l2.vidx2c2gram_by_l1_spelling'))
+        save_spelling_mat(l2_vidx2c3gram_by_l1_spelling, os.path.join(l2_save_dir, 'l2.vidx2c3gram_by_l1_spelling'))
+        save_spelling_mat(l2_vidx2c4gram_by_l1_spelling, os.path.join(l2_save_dir, 'l2.vidx2c4gram_by_l1_spelling'))
 
         l2_idx2c = {i: c for c, i in l2_c1gram2idx.items()}
         pickle.dump(l2_c1gram2idx, open(os.path.join(l2_save_dir, 'l2.c2idx.pkl'), 'wb'))
@@ -246,27 +388,12 @@ class Preprocess(object):
         pickle.dump(l2_idx2c4gram, open(os.path.join(l2_save_dir, 'l2.idx2c4gram.pkl'), 'wb'))
         pickle.dump(l2_c4gram2idx, open(os.path.join(l2_save_dir, 'l2.c4gram2idx.pkl'), 'wb'))
 
-        if ft_model is not None:
-            mat = torch.FloatTensor(len(l2_idx2v), 300).uniform_(-1.0, 1.0)
-            for i, v in l2_idx2v.items():
-                if i < 4:
-                    mat[i, :] = l1_mat[i, :]  # special symbols have the same embedding
-                else:
-                    v_vec = ft_model.get_word_vector(v)
-                    mat[i, :] = torch.tensor(v_vec)
-            torch.save(mat, l2_save_dir + '/l2.mat.pt')
-        else:
-            print('not creating l2.mat.pt')
-        l2_l1_min_ed = {}
-        for l2_i, l2_v in l2_idx2v.items():
-            print(l2_i, len(l2_idx2v))
-            for l1_i, l1_v in l1_idx2v.items():
-                if l1_i < 10000:
-                    e = ed.eval(l1_v, l2_v) / max(len(l2_v), len(l1_v))
-                    if e <= 0.334:
-                        prev_e = l2_l1_min_ed.get((l2_i, l2_v), (1.0, None, None))
-                        if prev_e[0] > e:
-                            l2_l1_min_ed[(l2_i, l2_v)] = (e, (l1_i, l1_v))
+    def build_ed(self, l1_data_dir, l2_save_dir, l1_mat, num_workers):
+        l1_idx2v = pickle.load(open(os.path.join(l1_data_dir, 'l1.idx2v.pkl'), 'rb'))
+        l2_idx2v = pickle.load(open(os.path.join(l2_save_dir, 'l2.idx2v.pkl'), 'rb'))
+        print('searching orthographic neighbors...')
+        l2_l1_min_ed = min_ed_neighbors(l2_idx2v, l1_idx2v, max_l1_idx=10000, threshold=0.334,
+                                        num_workers=num_workers)
         mat_ed = torch.FloatTensor(len(l2_idx2v), 300).fill_(0.0)
         for k, v in l2_l1_min_ed.items():
             l2_i, l2_v = k
@@ -275,23 +402,51 @@ class Preprocess(object):
             print(l2_v, 'closest', l1_v)
         mat_ed[[0, 1, 2, 3], :] = l1_mat[[0, 1, 2, 3], :]
         torch.save(mat_ed, l2_save_dir + '/l2_ed.mat.pt')
-        pickle.dump(full_data_key, open(os.path.join(l2_save_dir, 'l1.l2.key.pkl'), 'wb'))
-        pickle.dump(l2_key_wt, open(os.path.join(l2_save_dir, 'l2.key.wt.pkl'), 'wb'))
-        pickle.dump(line_keys, open(os.path.join(l2_save_dir, 'per_line.l1.l2.key.pkl'), 'wb'))
 
-        mat_key = torch.FloatTensor(len(l2_idx2v), 300).fill_(0.0)
-        mat_key[[0, 1, 2, 3], :] = l1_mat[[0, 1, 2, 3], :]
-        txt_key = open(os.path.join(l2_save_dir, 'full_data_key.txt'), 'w', encoding='utf-8')
-        for l1idx, l2idx in full_data_key:
-            txt = str(l1idx) + ' ' + l1_idx2v[l1idx] + ' ' + ' ' + str(l2idx) + ' ' + l2_idx2v[l2idx] + '\n'
-            txt_key.write(txt)
-            mat_key[l2idx, :] = l1_mat[l1idx, :]
-        txt_key.close()
-        torch.save(mat_key, l2_save_dir + '/l2_key.mat.pt')
+    def build(self, l1_data_dir, l2_data_dir, l2_save_dir, ft_model, max_word_len, num_workers=1, cache=None):
+        """
+        runs the l2 stages (stats, keys, spellings, vectors, l2_ed), each one is skipped when
+        its inputs are unchanged since it last ran (see StageCache)
+        """
+        if cache is None:
+            cache = StageCache(os.path.join(l2_save_dir, 'stage_cache.json'))
+        l1_file = lambda name: os.path.join(l1_data_dir, name)
+        l2_file = lambda name: os.path.join(l2_save_dir, name)
+        l1_mat_file = l1_file('l1.mat.npy') if os.path.exists(l1_file('l1.mat.npy')) else l1_file('l1.mat.pt')
+        l1_mat = load_mat(l1_mat_file)
+        corpus_file = find_corpus(os.path.join(l2_data_dir, 'parallel_corpus'))
+        print('loaded l1 data...')
+
+        cache.run('l2.stats', [corpus_file], {},
+                  [l2_file('l2.stats.pkl'), l2_file('l2.v2idx.pkl'), l2_file('l2.idx2v.pkl')],
+                  lambda: self.build_stats(corpus_file, l2_save_dir, cache))
+        cache.run('l2.keys', [corpus_file, l2_file('l2.stats.pkl'), l1_file('l1.v2idx.pkl'), l1_file('l1.idx2v.pkl'),
+                              l1_mat_file], {},
+                  [l2_file('l1.l2.key.pkl'), l2_file('l2.key.wt.pkl'), l2_file('per_line.l1.l2.key.offsets.npy'),
+                   l2_file('per_line.l1.l2.key.pairs.npy'), l2_file('l2_key.mat.pt')],
+                  lambda: self.build_keys(corpus_file, l1_data_dir, l2_save_dir, l1_mat, num_workers, cache))
+        cache.run('l2.spellings', [l2_file('l2.v2idx.pkl')] + [l1_file('l1.c{}gram2idx.pkl'.format(n)) for n in range(1, 5)], {},
+                  [l2_file('l2.vidx2c{}gram_spelling.npy'.format(n)) for n in range(1, 5)] +
+                  [l2_file('l2.vidx2c{}gram_by_l1_spelling.npy'.format(n)) for n in range(1, 5)] +
+                  [l2_file('l2.c{}gram2idx.pkl'.format(n)) for n in range(1, 5)],
+                  lambda: self.build_spellings(l1_data_dir, l2_save_dir))
+        if ft_model is not None:
+            l2_idx2v = pickle.load(open(l2_file('l2.idx2v.pkl'), 'rb'))
+            extract_word_vecs(ft_model, [l2_idx2v[i] for i in range(len(l2_idx2v))],
+                              l2_save_dir + '/l2.mat.npy', num_workers=num_workers)
+            mat = np.load(l2_save_dir + '/l2.mat.npy', mmap_mode='r+')
+            mat[:4, :] = l1_mat[:4, :].numpy()  # special symbols have the same embedding
+            mat.flush()
+            torch.save(torch.from_numpy(np.array(mat)), l2_save_dir + '/l2.mat.pt')
+        else:
+            print('not creating l2.mat.pt')
+        cache.run('l2_ed', [l2_file('l2.idx2v.pkl'), l1_file('l1.idx2v.pkl'), l1_mat_file],
+                  {'max_l1_idx': 10000, 'threshold': 0.334}, [l2_file('l2_ed.mat.pt')],
+                  lambda: self.build_ed(l1_data_dir, l2_save_dir, l1_mat, num_workers))
         info = open(os.path.join(l2_save_dir, 'INFO.FILE'), 'w')
         info.write("the l2*pkl files and l1.l2.key.pkl file was created using the l1 vocabulary from:" + l1_data_dir)
         info.close()
-        return l2_v2idx
+        return pickle.load(open(l2_file('l2.v2idx.pkl'), 'rb'))
 
 
 if __name__ == '__main__':
@@ -302,4 +457,5 @@ if __name__ == '__main__':
                      l2_data_dir=args.l2_data_dir,
                      l2_save_dir=args.l2_save_dir,
                      ft_model=ft_model,
-                     max_word_len=args.max_word_len)
+                     max_word_len=args.max_word_len,
+                     num_workers=args.num_workers)
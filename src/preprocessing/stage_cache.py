@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+
+
+def _sha1_file(file_name, nbytes=None, chunk_size=1 << 22):
+    h = hashlib.sha1()
+    left = nbytes
+    with open(file_name, 'rb') as f:
+        while left is None or left > 0:
+            buf = f.read(chunk_size if left is None else min(chunk_size, left))
+            if not buf:
+                break
+            h.update(buf)
+            if left is not None:
+                left -= len(buf)
+    return h.hexdigest()
+
+
+class StageCache(object):
+    """
+    content-hash cache for preprocessing stages, stored as json in cache_file.
+    a stage is fresh when the hashes of its input files and its params match what was
+    recorded when it last finished and its output files are still there unmodified.
+    file hashes are remembered by (size, mtime) so unchanged inputs are not re-read on every run
+    """
+    def __init__(self, cache_file, force=False):
+        self.cache_file = cache_file
+        self.force = force
+        if os.path.exists(cache_file):
+            with open(cache_file, 'r') as f:
+                state = json.load(f)
+        else:
+            state = {}
+        self.stages = state.get('stages', {})
+        self.hashes = state.get('hashes', {})
+
+    def save(self,):
+        tmp_file = self.cache_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'stages': self.stages, 'hashes': self.hashes}, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.cache_file)
+
+    def file_hash(self, file_name):
+        if not os.path.exists(file_name):
+            return None
+        st = os.stat(file_name)
+        path = os.path.abspath(file_name)
+        known = self.hashes.get(path, None)
+        if known is not None and known['size'] == st.st_size and known['mtime'] == st.st_mtime_ns:
+            return known['sha1']
+        digest = _sha1_file(file_name)
+        self.hashes[path] = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha1': digest}
+        return digest
+
+    def prefix_hash(self, file_name, nbytes):
+        return _sha1_file(file_name, nbytes)
+
+    def key(self, inputs, params):
+        h = hashlib.sha1()
+        for file_name in inputs:
+            h.update(os.path.basename(file_name).encode('utf-8'))
+            h.update(str(self.file_hash(file_name)).encode('utf-8'))
+        h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+        return h.hexdigest()
+
+    def fresh(self, stage, inputs, params, outputs):
+        done = self.stages.get(stage, None)
+        if self.force or done is None or done['key'] != self.key(inputs, params):
+            return False
+        return all(self.file_hash(f) == done['outputs'].get(os.path.basename(f), None) for f in outputs)
+
+    def record(self, stage, inputs, params, outputs, **info):
+        self.stages[stage] = {'key': self.key(inputs, params),
+                              'outputs': {os.path.basename(f): self.file_hash(f) for f in outputs},
+                              'info': info}
+        self.save()
+
+    def info(self, stage):
+        # extra values stored by the last record of stage (used for incremental updates)
+        done = self.stages.get(stage, None)
+        return done['info'] if done is not None else {}
+
+    def run(self, stage, inputs, params, outputs, fn):
+        """
+        calls fn() unless stage is fresh, then records it. if fn returns a dict it is kept as the stage info
+        """
+        if self.fresh(stage, inputs, params, outputs):
+            print('stage', stage, 'is up to date, skipping')
+            return False
+        print('running stage', stage)
+        info = fn()
+        self.record(stage, inputs, params, outputs, **(info if isinstance(info, dict) else {}))
+        return True
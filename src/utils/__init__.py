@@ -3,11 +3,25 @@ __author__ = 'arenduchintala'
 from .utils import SPECIAL_TOKENS
 from .utils import TEXT_EFFECT
 from .utils import LazyTextBatcher
+from .utils import IndexedTextBatcher
+from .utils import ShardedTextBatcher
+from .utils import TokenBudgetBatchSampler
+from .utils import TokenCollator
 from .utils import TextDataset
 from .utils import ParallelTextDataset
+from .utils import MMapTextDataset
+from .utils import MMapParallelTextDataset
+from .utils import BatchPrefetcher
 
 __all__ = ['SPECIAL_TOKENS',
            'TEXT_EFFECT',
            'LazyTextBatcher',
+           'IndexedTextBatcher',
+           'ShardedTextBatcher',
+           'TokenBudgetBatchSampler',
+           'TokenCollator',
            'TextDataset',
-           'ParallelTextDataset']
+           'ParallelTextDataset',
+           'MMapTextDataset',
+           'MMapParallelTextDataset',
+           'BatchPrefetcher']
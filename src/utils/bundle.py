@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'arenduchintala'
+import json
+import os
+import pickle
+import struct
+import numpy as np
+import torch
+from .utils import PerLineKeys
+from .utils import spell2mat
+
+BUNDLE_MAGIC = b'MACBNDL\x00'
+BUNDLE_VERSION = 1
+_PREAMBLE = struct.Struct('<8sII')  # magic, version, header length
+_ALIGN = 64
+
+L1_VOCABS = ['l1.v2idx'] + ['l1.c{}gram2idx'.format(n) for n in range(1, 5)]
+L1_ARRAYS = ['l1.mat'] + ['l1.vidx2c{}gram_spelling'.format(n) for n in range(1, 5)]
+L2_VOCABS = ['l2.v2idx'] + ['l2.c{}gram2idx'.format(n) for n in range(1, 5)]
+L2_ARRAYS = ['l1.l2.key', 'l2.key.wt', 'per_line.l1.l2.key.offsets', 'per_line.l1.l2.key.pairs',
+             'l2.mat', 'l2_ed.mat', 'l2_key.mat'] + \
+            ['l2.vidx2c{}gram_spelling'.format(n) for n in range(1, 5)] + \
+            ['l2.vidx2c{}gram_by_l1_spelling'.format(n) for n in range(1, 5)]
+
+
+def artifact_name(file_name):
+    # artifacts are looked up by the name of the file they were bundled from, l1.v2idx.pkl -> l1.v2idx
+    name = os.path.basename(file_name)
+    for ext in ['.pkl', '.pt', '.npy']:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def _aligned(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def write_bundle(bundle_file, vocabs, arrays, meta=None):
+    """
+    writes vocabs ({name: v2idx}) and arrays ({name: ndarray}) into a single file:
+    a fixed preamble, a json header with dtype/shape/offset of every entry, then the
+    entries themselves, each aligned so it can be memory-mapped in place
+    """
+    blobs = []
+    header = {'version': BUNDLE_VERSION, 'meta': meta if meta is not None else {}, 'vocabs': {}, 'arrays': {}}
+    offset = 0
+    for name, v2idx in vocabs.items():
+        words = sorted(v2idx, key=v2idx.get)
+        assert [v2idx[w] for w in words] == list(range(len(words))), name + " indices are not 0..n-1"
+        assert all('\n' not in w for w in words), name + " has an entry with a newline"
+        blob = '\n'.join(words).encode('utf-8')
+        header['vocabs'][name] = {'offset': offset, 'nbytes': len(blob), 'size': len(words)}
+        blobs.append((offset, blob))
+        offset = _aligned(offset + len(blob))
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        assert arr.dtype != object, name + " is not a numeric array"
+        header['arrays'][name] = {'offset': offset, 'dtype': arr.dtype.str, 'shape': list(arr.shape)}
+        blobs.append((offset, arr))
+        offset = _aligned(offset + arr.nbytes)
+    header = json.dumps(header).encode('utf-8')
+    data_start = _aligned(_PREAMBLE.size + len(header))
+    tmp_file = bundle_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(_PREAMBLE.pack(BUNDLE_MAGIC, BUNDLE_VERSION, len(header)))
+        f.write(header)
+        for blob_offset, blob in blobs:
+            f.seek(data_start + blob_offset)
+            f.write(blob.tobytes() if isinstance(blob, np.ndarray) else blob)
+        f.truncate(data_start + offset)
+    os.replace(tmp_file, bundle_file)
+    return bundle_file
+
+
+def _load_artifact(data_dir, name):
+    for ext in ['.npy', '.pt', '.pkl']:
+        file_name = os.path.join(data_dir, name + ext)
+        if not os.path.exists(file_name):
+            continue
+        if ext == '.npy':
+            return np.load(file_name, mmap_mode='r')
+        elif ext == '.pt':
+            return torch.load(file_name).numpy()
+        else:
+            obj = pickle.load(open(file_name, 'rb'))
+            if isinstance(obj, dict):
+                # spellings pickled before the .npy format ({vidx: padded cgram ids + length})
+                return spell2mat(obj).numpy().astype(np.int32)
+            return np.asarray(obj)
+    return None
+
+
+def collect_artifacts(data_dirs, vocab_names, array_names):
+    """
+    reads the named preprocessing outputs from data_dirs (.npy preferred over .pt over .pkl),
+    names that are not found in any of the dirs are skipped
+    """
+    vocabs = {}
+    arrays = {}
+    for data_dir in data_dirs:
+        for name in vocab_names:
+            file_name = os.path.join(data_dir, name + '.pkl')
+            if name not in vocabs and os.path.exists(file_name):
+                vocabs[name] = pickle.load(open(file_name, 'rb'))
+        for name in array_names:
+            if name not in arrays:
+                arr = _load_artifact(data_dir, name)
+                if arr is not None:
+                    arrays[name] = arr
+    # key pairs and keys weights come from pickled python lists, store them compactly
+    if 'l1.l2.key' in arrays:
+        arrays['l1.l2.key'] = arrays['l1.l2.key'].astype(np.int32).reshape(-1, 2)
+    if 'l2.key.wt' in arrays:
+        arrays['l2.key.wt'] = arrays['l2.key.wt'].astype(np.float32)
+    return vocabs, arrays
+
+
+class ArtifactBundle(object):
+    """
+    read side of write_bundle. only the header is read up front, arrays are memory-mapped
+    (copy-on-write) the first time they are asked for and vocabs are decoded on demand
+    """
+    def __init__(self, bundle_file):
+        self.bundle_file = bundle_file
+        with open(bundle_file, 'rb') as f:
+            magic, version, header_len = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+            if magic != BUNDLE_MAGIC:
+                raise ValueError(bundle_file + " is not an artifact bundle")
+            if version != BUNDLE_VERSION:
+                raise ValueError("{} has bundle version {}, expected {}".format(bundle_file, version, BUNDLE_VERSION))
+            header = json.loads(f.read(header_len).decode('utf-8'))
+        self.data_start = _aligned(_PREAMBLE.size + header_len)
+        self.meta = header['meta']
+        self.vocab_entries = header['vocabs']
+        self.array_entries = header['arrays']
+        self.arrays = {}
+
+    def __contains__(self, file_name):
+        name = artifact_name(file_name)
+        return name in self.array_entries or name in self.vocab_entries
+
+    def words(self, file_name):
+        entry = self.vocab_entries[artifact_name(file_name)]
+        with open(self.bundle_file, 'rb') as f:
+            f.seek(self.data_start + entry['offset'])
+            blob = f.read(entry['nbytes']).decode('utf-8')
+        return blob.split('\n') if entry['size'] > 0 else []
+
+    def vocab(self, file_name):
+        # (v2idx, idx2v), both built from the one string table
+        words = self.words(file_name)
+        return {w: i for i, w in enumerate(words)}, dict(enumerate(words))
+
+    def array(self, file_name):
+        name = artifact_name(file_name)
+        if name not in self.arrays:
+            entry = self.array_entries[name]
+            dtype = np.dtype(entry['dtype'])
+            shape = tuple(entry['shape'])
+            if int(np.prod(shape)) == 0:
+                arr = np.empty(shape, dtype=dtype)
+            else:
+                arr = np.memmap(self.bundle_file, dtype=dtype, mode='c',
+                                offset=self.data_start + entry['offset'], shape=shape)
+            self.arrays[name] = torch.from_numpy(arr)
+        return self.arrays[name]
+
+    def key(self, file_name):
+        # (l1_key, l2_key) LongTensors from an (N, 2) key pair array
+        pairs = self.array(file_name).long()
+        return pairs[:, 0].contiguous(), pairs[:, 1].contiguous()
+
+    def per_line_keys(self, file_name):
+        name = artifact_name(file_name)
+        for ext in ['.offsets', '.pairs']:
+            if name.endswith(ext):
+                name = name[:-len(ext)]
+        return PerLineKeys.from_arrays(self.array(name + '.offsets').numpy(), self.array(name + '.pairs').numpy())
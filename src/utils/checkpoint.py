@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'arenduchintala'
+import copy
+import os
+import random
+import threading
+import numpy as np
+import torch
+from .distributed import all_gather_object
+from .distributed import get_rank
+
+CHECKPOINT_VERSION = 1
+
+
+def rng_state():
+    state = {'python': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state:
+        torch.cuda.set_rng_state_all(state['cuda'])
+    return True
+
+
+def snapshot_module(module):
+    """
+    a copy of module (optimizer and grad scaler attributes included) that training will not touch,
+    parameters that do not train are shared with module instead of copied
+    """
+    memo = {id(p): p for p in module.parameters() if not p.requires_grad}
+    return copy.deepcopy(module, memo)
+
+
+class AsyncWriter(object):
+    """
+    torch.save + fsync + rename on a background thread. submit waits for the write before it to
+    finish, so at most one write is in flight; the object handed over must not change while it is
+    written (see snapshot_module). errors of a write are raised by the next submit or wait
+    """
+    def __init__(self,):
+        self.thread = None
+        self.error = None
+
+    def _write(self, obj, file_name):
+        try:
+            tmp_file = file_name + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                torch.save(obj, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, file_name)
+        except BaseException as e:
+            self.error = e
+
+    def wait(self,):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        return True
+
+    def submit(self, obj, file_name):
+        self.wait()
+        # not a daemon, the interpreter finishes the write before exiting
+        self.thread = threading.Thread(target=self._write, args=(obj, file_name))
+        self.thread.start()
+        return True
+
+
+def save_checkpoint(checkpoint_file, model, epoch, batch_idx, epoch_rng=None, writer=None, **loop_state):
+    """
+    resumable training state: model/optimizer/grad scaler state dicts, the rng states of every rank
+    and the position in the data (epoch and number of batches done in it). epoch_rng is the python/numpy
+    rng at the start of the epoch, the batch plan is replayed from it on resume. loop_state holds whatever
+    the training loop accumulates (losses so far, early stopping history, ...).
+    called on every rank (the rng states are gathered), only rank 0 writes, in the background if a writer is given
+    """
+    rngs = all_gather_object(rng_state())
+    if get_rank() != 0:
+        return False
+    if writer is not None:
+        model = snapshot_module(model)
+        loop_state = copy.deepcopy(loop_state)
+    checkpoint = {'version': CHECKPOINT_VERSION,
+                  'model': model.state_dict(),
+                  'optimizer': model.optimizer.state_dict(),
+                  'grad_scaler': model.grad_scaler.state_dict(),
+                  'rng': rngs,
+                  'epoch': epoch,
+                  'batch_idx': batch_idx,
+                  'epoch_rng': epoch_rng,
+                  'loop_state': loop_state}
+    if writer is not None:
+        return writer.submit(checkpoint, checkpoint_file)
+    tmp_file = checkpoint_file + '.tmp'
+    torch.save(checkpoint, tmp_file)
+    os.replace(tmp_file, checkpoint_file)
+    return True
+
+
+def load_checkpoint(checkpoint_file, model, rank=0):
+    """
+    restores model/optimizer/grad scaler state in place and the rng states of this rank.
+    call it right before the training loop (after everything that draws random numbers at startup)
+    and returns the checkpoint for the position and loop state
+    """
+    checkpoint = torch.load(checkpoint_file, map_location=lambda storage, loc: storage, weights_only=False)
+    if checkpoint['version'] != CHECKPOINT_VERSION:
+        raise ValueError("{} has checkpoint version {}, expected {}".format(checkpoint_file, checkpoint['version'],
+                                                                            CHECKPOINT_VERSION))
+    if len(checkpoint['rng']) <= rank:
+        raise ValueError("{} was written by {} rank(s)".format(checkpoint_file, len(checkpoint['rng'])))
+    model.load_state_dict(checkpoint['model'])
+    model.optimizer.load_state_dict(checkpoint['optimizer'])
+    model.grad_scaler.load_state_dict(checkpoint['grad_scaler'])
+    set_rng_state(checkpoint['rng'][rank])
+    if checkpoint['epoch_rng'] is not None:
+        # part way through an epoch, the python/numpy rng restart from where they were when the epoch began
+        # (the BatchPrefetcher batch plan has its own rng seeded from (seed, epoch) and replays by itself)
+        random.setstate(checkpoint['epoch_rng']['python'])
+        np.random.set_state(checkpoint['epoch_rng']['numpy'])
+    return checkpoint
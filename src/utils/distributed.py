@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'arenduchintala'
+import os
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors
+from torch._utils import _unflatten_dense_tensors
+
+
+def init_distributed():
+    """
+    joins the gloo process group described by the torchrun env vars (RANK, WORLD_SIZE, MASTER_ADDR, ...)
+    and splits the host cores between the local ranks. returns (rank, world_size), (0, 1) outside torchrun
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1
+    dist.init_process_group(backend='gloo')
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def broadcast_params(module, src=0):
+    # ranks build their models from the same seed, this makes sure they also start from the same weights
+    if not is_distributed():
+        return False
+    for p in module.state_dict().values():
+        if p.is_floating_point():
+            dist.broadcast(p, src)
+    return True
+
+
+def all_reduce_grads(params):
+    """
+    sums the gradients of params over all ranks with one all-reduce of a flat buffer.
+    the losses are summed over tokens, so the summed gradient is the gradient of the whole batch.
+    params without a gradient on this rank contribute zeros so every rank reduces the same buffer
+    """
+    if not is_distributed():
+        return False
+    params = [p for p in params if p.requires_grad]
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+    grads = [p.grad for p in params]
+    flat = _flatten_dense_tensors(grads)
+    dist.all_reduce(flat)
+    for g, reduced in zip(grads, _unflatten_dense_tensors(flat, grads)):
+        g.copy_(reduced)
+    return True
+
+
+def all_reduce_sum(values):
+    # sums a list of python numbers over all ranks (losses, counts, ...)
+    if not is_distributed():
+        return list(values)
+    t = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(t)
+    return t.tolist()
+
+
+def all_gather_object(obj):
+    # [obj of rank 0, obj of rank 1, ...]
+    if not is_distributed():
+        return [obj]
+    objs = [None] * dist.get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
+
+
+def format_throughput(epoch, sents_per_sec, world_size, baseline=None):
+    """
+    the end of epoch throughput line. baseline is the sentences/s of a 1-rank run of the same job,
+    with it the scaling efficiency S_N / (N * S_1) is reported as well (1.0 = linear scaling)
+    """
+    line = 'e{:d} {:.1f} sentences/s over {:d} rank(s)'.format(epoch, sents_per_sec, world_size)
+    if baseline is not None and baseline > 0:
+        line += ', speedup {:.2f}x efficiency {:.2f} vs {:.1f} sentences/s on 1 rank'.format(
+            sents_per_sec / baseline, sents_per_sec / (world_size * baseline), baseline)
+    return line
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
@@ -1,8 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 __author__ = 'arenduchintala'
+import bz2
+import glob
+import gzip
+import io
+import json
+import lzma
+import mmap
+import os
+import pickle
+import queue
 import random
+import shutil
+import subprocess
+import threading
+import numpy as np
 import torch
+import torch.multiprocessing as mp
+from array import array
 
 
 class SPECIAL_TOKENS:
@@ -30,6 +46,186 @@ class TEXT_EFFECT:
     END = '\033[0m'
 
 
+COMPRESSED_EXTS = {'.gz': (['pigz', 'gzip'], gzip.open),
+                   '.bz2': (['lbzip2', 'pbzip2', 'bzip2'], bz2.open),
+                   '.xz': (['xz'], lzma.open)}
+COMPRESSED_MAGIC = [(b'\x1f\x8b', '.gz'), (b'BZh', '.bz2'), (b'\xfd7zXZ\x00', '.xz')]
+
+
+def compression_of(file_name):
+    ext = os.path.splitext(file_name)[1]
+    if ext in COMPRESSED_EXTS:
+        return ext
+    with open(file_name, 'rb') as f:
+        head = f.read(6)
+    for magic, ext in COMPRESSED_MAGIC:
+        if head.startswith(magic):
+            return ext
+    return None
+
+
+def find_corpus(file_name):
+    if os.path.exists(file_name):
+        return file_name
+    for ext in COMPRESSED_EXTS:
+        if os.path.exists(file_name + ext):
+            return file_name + ext
+    return file_name
+
+
+class _DecompressedStream(io.RawIOBase):
+    """
+    raw reader over a decompressor running next to the consumer, either an external
+    (possibly multi-threaded) tool in a subprocess or a python decompressor in a thread
+    """
+    def __init__(self, file_name, ext, chunk_size=1 << 20):
+        tools, py_open = COMPRESSED_EXTS[ext]
+        tool = next((shutil.which(t) for t in tools if shutil.which(t) is not None), None)
+        self.proc = None
+        self.thread = None
+        if tool is not None:
+            cmd = [tool, '-dc'] + (['-T0'] if ext == '.xz' else []) + [file_name]
+            self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=chunk_size)
+            self.pipe = self.proc.stdout
+        else:
+            r, w = os.pipe()
+            self.pipe = os.fdopen(r, 'rb', buffering=0)
+            self.thread = threading.Thread(target=self._pump, args=(py_open, file_name, w, chunk_size),
+                                           daemon=True)
+            self.thread.start()
+
+    @staticmethod
+    def _pump(py_open, file_name, w, chunk_size):
+        # zlib/bz2/lzma release the GIL while decompressing, so this overlaps with tokenization
+        with os.fdopen(w, 'wb') as out, py_open(file_name, 'rb') as f:
+            try:
+                shutil.copyfileobj(f, out, chunk_size)
+            except BrokenPipeError:
+                pass
+
+    def readable(self,):
+        return True
+
+    def readinto(self, b):
+        return self.pipe.readinto(b)
+
+    def close(self,):
+        if not self.closed:
+            self.pipe.close()
+            if self.proc is not None:
+                if self.proc.poll() is None:
+                    self.proc.kill()
+                self.proc.wait()
+            if self.thread is not None:
+                self.thread.join()
+        super().close()
+
+
+def open_corpus(file_name, mode='r', encoding='utf-8'):
+    """
+    drop-in for open(file_name, mode) on corpora that may be gzip/bz2/xz compressed,
+    decompresses on the fly without writing a temporary copy
+    """
+    assert mode in ['r', 'rt', 'rb']
+    ext = compression_of(file_name)
+    if ext is None:
+        if mode == 'rb':
+            return open(file_name, 'rb')
+        return open(file_name, 'r', encoding=encoding)
+    stream = io.BufferedReader(_DecompressedStream(file_name, ext), buffer_size=1 << 20)
+    if mode == 'rb':
+        return stream
+    return io.TextIOWrapper(stream, encoding=encoding)
+
+
+def load_mat(mat_file):
+    # .npy matrices are mapped copy-on-write instead of deserialized into memory
+    if mat_file.endswith('.npy'):
+        return torch.from_numpy(np.load(mat_file, mmap_mode='c'))
+    return torch.load(mat_file)
+
+
+def spell2mat(v2spell):
+    spelling_mat = torch.Tensor(len(v2spell), len(v2spell[0])).fill_(0).long()
+    for k, v in v2spell.items():
+        spelling_mat[k] = torch.tensor(v)
+    spelling_mat = spelling_mat[:, :-1]
+    return spelling_mat
+
+
+def save_spelling_mat(vidx2spelling, file_prefix):
+    # rows of vidx2spelling are padded cgram ids followed by the spelling length, the length is dropped
+    # (the models count the non-pad ids) as spell2mat does for the pickled dicts
+    arr = np.array([vidx2spelling[i] for i in range(len(vidx2spelling))], dtype=np.int32)
+    np.save(file_prefix + '.npy', arr[:, :-1])
+
+
+def save_line_keys(line_lens, pairs, file_prefix):
+    # CSR layout: the (l1, l2) key pairs of line i are pairs[offsets[i]:offsets[i + 1]]
+    offsets = np.zeros(len(line_lens) + 1, dtype=np.int64)
+    np.cumsum(line_lens, out=offsets[1:])
+    np.save(file_prefix + '.offsets.npy', offsets)
+    np.save(file_prefix + '.pairs.npy', np.asarray(pairs, dtype=np.int32).reshape(-1, 2))
+
+
+class PerLineKeys(object):
+    """
+    per line (l1, l2) key pairs, indexed by line number. reads the CSR .offsets.npy / .pairs.npy
+    files written by save_line_keys (memory-mapped) or the older pickled list of pair lists.
+    a line is only turned into tensors when it is looked up
+    """
+    def __init__(self, key_file):
+        if key_file.endswith('.pkl'):
+            line_keys = pickle.load(open(key_file, 'rb'))
+            self.offsets = np.zeros(len(line_keys) + 1, dtype=np.int64)
+            np.cumsum([len(k) for k in line_keys], out=self.offsets[1:])
+            self.pairs = np.array([p for k in line_keys for p in k], dtype=np.int32).reshape(-1, 2)
+        else:
+            for ext in ['.offsets.npy', '.pairs.npy']:
+                if key_file.endswith(ext):
+                    key_file = key_file[:-len(ext)]
+            self.offsets = np.load(key_file + '.offsets.npy', mmap_mode='r')
+            self.pairs = np.load(key_file + '.pairs.npy', mmap_mode='r')
+
+    @classmethod
+    def from_arrays(cls, offsets, pairs):
+        per_line_keys = cls.__new__(cls)
+        per_line_keys.offsets = offsets
+        per_line_keys.pairs = pairs
+        return per_line_keys
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, line_idx):
+        start, end = self.offsets[line_idx], self.offsets[line_idx + 1]
+        if start == end:
+            return torch.LongTensor([0]), torch.LongTensor([0])
+        pairs = torch.from_numpy(self.pairs[start:end].astype(np.int64))
+        return pairs[:, 0].contiguous(), pairs[:, 1].contiguous()
+
+
+def parse_line(line):
+    lines = line.strip().split('|||')
+    l1_line = lines[0]
+    if len(lines) == 2:
+        l2_line = lines[1]
+    else:
+        l2_line = None
+    len_line = len(l1_line.split())
+    return len_line, l1_line, l2_line
+
+
+def make_random_mask(data, lengths, mask_val, pad_idx, generator=None):
+    drop_num = int(lengths[-1] * mask_val)
+    mask = data.eq(pad_idx)
+    if drop_num > 0:
+        drop_samples_col = torch.multinomial(torch.ones(data.shape[0], lengths[-1]), drop_num, generator=generator)
+        drop_samples_row = torch.arange(data.shape[0]).unsqueeze(1).expand_as(drop_samples_col)
+        mask[drop_samples_row, drop_samples_col] = 1
+    return mask
+
+
 class LazyTextBatcher(object):
     def __init__(self,
                  file_name,
@@ -46,20 +242,13 @@ class LazyTextBatcher(object):
         self.min_batch_size = min_batch_size
         self.min_batch_by_num_token = min_batch_by_num_tokens
 
-    def max_batch_iter(self,):
-        with open(self.file_name, 'r', encoding='utf-8') as f:
+    def max_batch_iter(self, rng=random):
+        with open_corpus(self.file_name) as f:
             max_batch = []
             for line in f:
                 if line[0] == '#':
                     continue
-                lines = line.strip().split('|||')
-                l1_line = lines[0]
-                if len(lines) == 2:
-                    l2_line = lines[1]
-                else:
-                    l2_line = None
-                len_line = len(l1_line.split())
-                max_batch.append((len_line, l1_line, l2_line))
+                max_batch.append(parse_line(line))
                 if len(max_batch) >= self.max_batch_size:
                     copy_max_batch = max_batch
                     max_batch = []
@@ -74,25 +263,316 @@ class LazyTextBatcher(object):
                     yield max_batch
 
     def __iter__(self,):
-        for max_batch in self.max_batch_iter():
-            if self.min_batch_by_num_token:
-                lengths, _, _ = zip(*max_batch)
-                lengths_span = [(self.min_batch_size // (_i + 2)) for _i in lengths]
-                min_batches = []
-                i = 0
-                while i < len(lengths):
-                    mb = max_batch[i: lengths_span[i] + i]
-                    i = lengths_span[i] + i
-                    min_batches.append(mb)
-            else:
-                num_min_batches = len(max_batch) // self.min_batch_size
-                min_batches = [max_batch[i * self.min_batch_size: (i+1) * self.min_batch_size]
-                               for i in range(num_min_batches)]
-            if self.shuffle:
-                random.shuffle(min_batches)
-            for min_batch in min_batches:
+        return self.batch_plan()
+
+    def batch_plan(self, rng=random):
+        # rng (random or a random.Random) is used for every shuffle, BatchPrefetcher passes its own
+        for max_batch in self.max_batch_iter(rng):
+            for min_batch in self.split_max_batch(max_batch, rng):
                 yield min_batch
 
+    def split_max_batch(self, max_batch, rng=random):
+        if self.min_batch_by_num_token:
+            lengths, _, _ = zip(*max_batch)
+            lengths_span = [(self.min_batch_size // (_i + 2)) for _i in lengths]
+            min_batches = []
+            i = 0
+            while i < len(lengths):
+                mb = max_batch[i: lengths_span[i] + i]
+                i = lengths_span[i] + i
+                min_batches.append(mb)
+        else:
+            num_min_batches = len(max_batch) // self.min_batch_size
+            min_batches = [max_batch[i * self.min_batch_size: (i+1) * self.min_batch_size]
+                           for i in range(num_min_batches)]
+        if self.shuffle:
+            rng.shuffle(min_batches)
+        for min_batch in min_batches:
+            yield min_batch
+
+
+def resolve_shards(corpus):
+    if os.path.isdir(corpus):
+        shards = [os.path.join(corpus, f) for f in os.listdir(corpus)
+                  if not f.startswith('.') and os.path.isfile(os.path.join(corpus, f))]
+    else:
+        shards = glob.glob(corpus)
+    shards = [f for f in shards if not f.endswith('.lenidx.npy')]  # length index caches live next to the shards
+    assert len(shards) > 0, "no shards found for " + corpus
+    return sorted(shards)
+
+
+def is_sharded(corpus):
+    return os.path.isdir(corpus) or glob.has_magic(corpus)
+
+
+def _shard_reader(shard_files, out_q, chunk_size):
+    # chunks go out as (l1 token counts, raw lines joined into one bytes blob): decompression, decoding
+    # and counting happen here, the consumer gets two flat buffers that pickle as a memcpy
+    lines = []
+    lengths = array('q')
+    for shard_file in shard_files:
+        with open_corpus(shard_file, 'rb') as f:
+            for raw_line in f:
+                if raw_line[:1] == b'#':
+                    continue
+                if not raw_line.endswith(b'\n'):
+                    raw_line = raw_line + b'\n'
+                lines.append(raw_line)
+                lengths.append(len(raw_line.decode('utf-8').strip().split('|||')[0].split()))
+                if len(lines) >= chunk_size:
+                    out_q.put((np.frombuffer(lengths, dtype=np.int64), b''.join(lines)))
+                    lines = []
+                    lengths = array('q')
+    if len(lines) > 0:
+        out_q.put((np.frombuffer(lengths, dtype=np.int64), b''.join(lines)))
+    out_q.put(None)
+
+
+class ShardedTextBatcher(LazyTextBatcher):
+    """
+    streams shards that can not be length indexed (compressed) through num_readers reader processes,
+    max batches are sorted by l1 length only and lines are decoded once they are placed in a batch
+    """
+    def __init__(self,
+                 corpus,
+                 shuffle,
+                 sort_by_len,
+                 min_batch_size,
+                 num_readers=4,
+                 chunk_size=1000,
+                 queue_depth=16,
+                 min_batch_by_num_tokens=True,
+                 max_batch_size=100000):
+        super().__init__(corpus, shuffle, sort_by_len, min_batch_size, min_batch_by_num_tokens, max_batch_size)
+        self.shard_files = resolve_shards(corpus)
+        self.num_readers = max(1, min(num_readers, len(self.shard_files)))
+        self.chunk_size = chunk_size
+        self.queue_depth = queue_depth
+
+    def max_batch_iter(self, rng=random):
+        shard_files = list(self.shard_files)
+        if self.shuffle:
+            rng.shuffle(shard_files)
+        queues = [mp.Queue(self.queue_depth) for _ in range(self.num_readers)]
+        readers = [mp.Process(target=_shard_reader,
+                              args=(shard_files[r::self.num_readers], queues[r], self.chunk_size),
+                              daemon=True)
+                   for r in range(self.num_readers)]
+        for r in readers:
+            r.start()
+        try:
+            # round-robin over the readers' chunks: the interleaving only depends on the
+            # (seeded) shard order, not on which reader happens to be faster
+            active = list(range(self.num_readers))
+            chunks = []
+            num_lines = 0
+            while len(active) > 0:
+                for r in list(active):
+                    chunk = queues[r].get()
+                    if chunk is None:
+                        active.remove(r)
+                        continue
+                    chunks.append(chunk)
+                    num_lines += chunk[0].shape[0]
+                    if num_lines >= self.max_batch_size:
+                        yield self._finish_max_batch(chunks, rng)
+                        chunks = []
+                        num_lines = 0
+            if num_lines > 0:
+                yield self._finish_max_batch(chunks, rng)
+        finally:
+            for r in readers:
+                if r.is_alive():
+                    r.terminate()
+                r.join()
+
+    def _finish_max_batch(self, chunks, rng=random):
+        lengths = np.concatenate([c[0] for c in chunks])
+        lines = [line for c in chunks for line in c[1].split(b'\n')[:-1]]
+        if self.sort_by_len:
+            order = np.argsort(-lengths, kind='stable')  # longest first, file order among equal lengths
+        else:
+            order = list(range(len(lines)))
+            if self.shuffle:
+                rng.shuffle(order)
+        return [parse_line(lines[i].decode('utf-8')) for i in order]
+
+
+def build_length_index(file_name):
+    # (num_lines, 2) int64: byte offset of each non-comment line and its l1 token count.
+    # cached next to the corpus and rebuilt only when the corpus is newer than the cache.
+    index_file = file_name + '.lenidx.npy'
+    if os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(file_name):
+        return np.load(index_file)
+    index = array('q')
+    byte_offset = 0
+    with open(file_name, 'rb') as f:
+        for raw_line in f:
+            if raw_line[:1] != b'#':
+                line = raw_line.decode('utf-8')
+                index.extend([byte_offset, len(line.strip().split('|||')[0].split())])
+            byte_offset += len(raw_line)
+    index = np.frombuffer(index, dtype=np.int64).reshape(-1, 2)
+    try:
+        np.save(index_file, index)
+    except OSError:
+        print('could not cache length index at', index_file)
+    return index
+
+
+class TokenBudgetBatchSampler(object):
+    def __init__(self, lengths, min_batch_size, shuffle, sort_by_len=True):
+        # lengths include bos/eos. batches are cut once, from a single length-descending order,
+        # with min_batch_size // (longest length) sentences each; epochs only shuffle batch order.
+        self.shuffle = shuffle
+        lengths = np.asarray(lengths)
+        order = np.arange(lengths.shape[0])
+        if shuffle:
+            order = np.random.RandomState(random.randint(0, 2 ** 31 - 1)).permutation(lengths.shape[0])
+        if sort_by_len:
+            order = order[np.argsort(-lengths[order], kind='stable')]
+        self.batches = []
+        i = 0
+        while i < order.shape[0]:
+            span = max(1, min_batch_size // int(lengths[order[i]]))
+            self.batches.append(order[i: i + span])
+            i = i + span
+
+    def __len__(self,):
+        return len(self.batches)
+
+    def __iter__(self,):
+        return self.batch_plan()
+
+    def batch_plan(self, rng=random):
+        batch_order = list(range(len(self.batches)))
+        if self.shuffle:
+            rng.shuffle(batch_order)
+        for b in batch_order:
+            yield self.batches[b]
+
+
+class IndexedTextBatcher(object):
+    def __init__(self, file_name, shuffle, sort_by_len, min_batch_size):
+        self.file_name = file_name
+        self.index = build_length_index(file_name)
+        self.sampler = TokenBudgetBatchSampler(self.index[:, 1] + 2, min_batch_size, shuffle, sort_by_len)
+        self._source = None
+
+    def __len__(self,):
+        return len(self.sampler)
+
+    def read_line(self, row):
+        if self._source is None:
+            with open(self.file_name, 'rb') as f:
+                self._source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start = int(self.index[row, 0])
+        end = self._source.find(b'\n', start)
+        return self._source[start: end if end > -1 else len(self._source)].decode('utf-8')
+
+    def __getstate__(self,):
+        # mmap handles can not be pickled, reopen lazily in the receiving process
+        state = self.__dict__.copy()
+        state['_source'] = None
+        return state
+
+    def __iter__(self,):
+        return self.batch_plan()
+
+    def batch_plan(self, rng=random):
+        for rows in self.sampler.batch_plan(rng):
+            min_batch = []
+            for row in rows:
+                lines = self.read_line(row).strip().split('|||')
+                l2_line = lines[1] if len(lines) == 2 else None
+                min_batch.append((int(self.index[row, 1]), lines[0], l2_line))
+            yield min_batch
+
+
+class ShardedIndexedTextBatcher(IndexedTextBatcher):
+    """
+    IndexedTextBatcher over uncompressed shards: the per shard length indexes (cached next to each shard,
+    built by num_readers processes that only send back the (num_lines, 2) int arrays) are concatenated
+    and cut into batches by one TokenBudgetBatchSampler, lines are read back from their shard's mmap
+    """
+    def __init__(self, corpus, shuffle, sort_by_len, min_batch_size, num_readers=4):
+        self.shard_files = resolve_shards(corpus)
+        num_readers = max(1, min(num_readers, len(self.shard_files)))
+        if num_readers > 1:
+            with mp.Pool(num_readers) as pool:
+                indexes = pool.map(build_length_index, self.shard_files)
+        else:
+            indexes = [build_length_index(shard_file) for shard_file in self.shard_files]
+        self.index = np.concatenate(indexes)
+        self.shard_of_row = np.repeat(np.arange(len(indexes)), [i.shape[0] for i in indexes])
+        self.sampler = TokenBudgetBatchSampler(self.index[:, 1] + 2, min_batch_size, shuffle, sort_by_len)
+        self._sources = {}
+
+    def read_line(self, row):
+        shard = int(self.shard_of_row[row])
+        if shard not in self._sources:
+            with open(self.shard_files[shard], 'rb') as f:
+                self._sources[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        source = self._sources[shard]
+        start = int(self.index[row, 0])
+        end = source.find(b'\n', start)
+        return source[start: end if end > -1 else len(source)].decode('utf-8')
+
+    def __getstate__(self,):
+        state = self.__dict__.copy()
+        state['_sources'] = {}
+        return state
+
+
+class TokenCollator(object):
+    """
+    maps whitespace tokenized lines to a padded (batch x max_len) id tensor,
+    string->id lookups are interned across batches and padding is done in one numpy array
+    """
+    def __init__(self, v2idx, lower_text=True, pin_memory=False, max_cache_size=2000000):
+        self.v2idx = v2idx
+        self.lower_text = lower_text
+        self.pin_memory = pin_memory
+        self.max_cache_size = max_cache_size
+        self.unk = v2idx[SPECIAL_TOKENS.UNK]
+        self.bos = v2idx[SPECIAL_TOKENS.BOS]
+        self.eos = v2idx[SPECIAL_TOKENS.EOS]
+        self.cache = {}
+
+    def __getstate__(self,):
+        state = self.__dict__.copy()
+        state['cache'] = {}
+        return state
+
+    def token_id(self, token):
+        if len(self.cache) >= self.max_cache_size:
+            self.cache.clear()
+        _id = self.v2idx.get(token.lower() if self.lower_text else token, self.unk)
+        self.cache[token] = _id
+        return _id
+
+    def __call__(self, lines):
+        cache = self.cache
+        token_id = self.token_id
+        flat = []
+        lengths = []
+        for line in lines:
+            tokens = line.split()
+            flat.append(self.bos)
+            flat.extend([cache[t] if t in cache else token_id(t) for t in tokens])
+            flat.append(self.eos)
+            lengths.append(len(tokens) + 2)
+        np_lengths = np.array(lengths, dtype=np.int64)
+        if self.pin_memory:
+            torch_data = torch.zeros(len(lengths), int(np_lengths.max()), dtype=torch.long, pin_memory=True)
+            out = torch_data.numpy()
+        else:
+            out = np.zeros((len(lengths), int(np_lengths.max())), dtype=np.int64)
+            torch_data = torch.from_numpy(out)
+        out[np.arange(out.shape[1])[None, :] < np_lengths[:, None]] = flat
+        return lengths, torch_data
+
 
 class TextDataset(object):
     def __init__(self,
@@ -101,14 +581,33 @@ class TextDataset(object):
                  shuffle,
                  sort_by_len,
                  min_batch_size,
-                 lower_text=True):
+                 lower_text=True,
+                 length_index=False,
+                 num_readers=4,
+                 pin_memory=False):
         if min_batch_size > 1:
             assert sort_by_len
         self.v2idx = v2idx
         assert self.v2idx[SPECIAL_TOKENS.PAD] == 0
         self.lower_text = lower_text
-        self.lazy_batcher = LazyTextBatcher(corpus_file, shuffle, sort_by_len, min_batch_size)
-        self.num_batches = 0
+        self.collator = TokenCollator(v2idx, lower_text, pin_memory)
+        if is_sharded(corpus_file) and length_index and \
+                all(compression_of(f) is None for f in resolve_shards(corpus_file)):
+            self.lazy_batcher = ShardedIndexedTextBatcher(corpus_file, shuffle, sort_by_len, min_batch_size,
+                                                          num_readers=num_readers)
+            self.num_batches = len(self.lazy_batcher)
+        elif is_sharded(corpus_file):
+            if length_index:
+                print('warning: length index needs uncompressed shards,', corpus_file, 'is streamed instead')
+            self.lazy_batcher = ShardedTextBatcher(corpus_file, shuffle, sort_by_len, min_batch_size,
+                                                   num_readers=num_readers)
+            self.num_batches = 0
+        elif length_index and compression_of(corpus_file) is None:  # the index needs seekable text
+            self.lazy_batcher = IndexedTextBatcher(corpus_file, shuffle, sort_by_len, min_batch_size)
+            self.num_batches = len(self.lazy_batcher)
+        else:
+            self.lazy_batcher = LazyTextBatcher(corpus_file, shuffle, sort_by_len, min_batch_size)
+            self.num_batches = 0
         self.p = 0.0
         # for _ in self.lazy_batcher:
         #    self.num_batches += 1
@@ -116,21 +615,19 @@ class TextDataset(object):
     def set_mask_rate(self, p):
         self.p = p
 
+    def batch_plan(self, rng=random):
+        for min_batch in self.lazy_batcher.batch_plan(rng):
+            yield min_batch
+
+    def collate(self, min_batch):
+        lengths, l1_text_data, l2_text_data = zip(*min_batch)
+        l1_text_data = list(l1_text_data)
+        lengths, torch_data = self.collator(l1_text_data)
+        return lengths, torch_data, l1_text_data
+
     def __iter__(self,):
-        for min_batch in self.lazy_batcher:
-            lengths, l1_text_data, l2_text_data = zip(*min_batch)
-            l1_text_data = list(l1_text_data)
-            lengths = [i + 2 for i in lengths]
-            torch_data = torch.zeros(len(l1_text_data), lengths[0]).long()
-            for _idx, l in enumerate(lengths): # range(len(lengths)):
-                if self.lower_text:
-                    _tmp = [self.v2idx.get(i.lower(), self.v2idx[SPECIAL_TOKENS.UNK]) for i in
-                            [SPECIAL_TOKENS.BOS] + l1_text_data[_idx].split() + [SPECIAL_TOKENS.EOS]]
-                else:
-                    _tmp = [self.v2idx.get(i, self.v2idx[SPECIAL_TOKENS.UNK]) for i in
-                            [SPECIAL_TOKENS.BOS] + l1_text_data[_idx].split() + [SPECIAL_TOKENS.EOS]]
-                torch_data[_idx, :lengths[_idx]] = torch.LongTensor(_tmp)
-            yield lengths, torch_data, l1_text_data
+        for min_batch in self.batch_plan():
+            yield self.collate(min_batch)
 
 
 class ParallelTextDataset(object):
@@ -144,29 +641,298 @@ class ParallelTextDataset(object):
         assert self.l1_v2idx[SPECIAL_TOKENS.PAD] == 0
         assert self.l2_v2idx[SPECIAL_TOKENS.PAD] == 0
         self.lower_text = lower_text
+        self.l1_collator = TokenCollator(l1_v2idx, lower_text)
+        self.l2_collator = TokenCollator(l2_v2idx, lower_text)
         self.lazy_batcher = LazyTextBatcher(corpus_file, False, False, 1, min_batch_by_num_tokens=False)
 
     def __iter__(self,):
         for min_batch in self.lazy_batcher:
             lengths, l1_text_data, l2_text_data = zip(*min_batch)
-            lengths = [i + 2 for i in lengths]
             l1_text_data = list(l1_text_data)
             l2_text_data = list(l2_text_data)
-            l1_torch_data = torch.zeros(len(l1_text_data), lengths[0]).long()
-            l2_torch_data = torch.zeros(len(l2_text_data), lengths[0]).long()
-            for _idx, l in enumerate(lengths):  # range(len(lengths)):
-                if self.lower_text:
-                    _tmp = [self.l1_v2idx.get(i.lower(), self.l1_v2idx[SPECIAL_TOKENS.UNK]) for i in
-                            [SPECIAL_TOKENS.BOS] + l1_text_data[_idx].split() + [SPECIAL_TOKENS.EOS]]
-                else:
-                    _tmp = [self.l1_v2idx.get(i, self.l1_v2idx[SPECIAL_TOKENS.UNK]) for i in
-                            [SPECIAL_TOKENS.BOS] + l1_text_data[_idx].split() + [SPECIAL_TOKENS.EOS]]
-                l1_torch_data[_idx, :lengths[_idx]] = torch.LongTensor(_tmp)
-                if self.lower_text:
-                    _tmp = [self.l2_v2idx.get(i.lower(), self.l2_v2idx[SPECIAL_TOKENS.UNK]) for i in
-                            [SPECIAL_TOKENS.BOS] + l2_text_data[_idx].split() + [SPECIAL_TOKENS.EOS]]
-                else:
-                    _tmp = [self.l2_v2idx.get(i, self.l2_v2idx[SPECIAL_TOKENS.UNK]) for i in
-                            [SPECIAL_TOKENS.BOS] + l2_text_data[_idx].split() + [SPECIAL_TOKENS.EOS]]
-                l2_torch_data[_idx, :lengths[_idx]] = torch.LongTensor(_tmp)
+            lengths, l1_torch_data = self.l1_collator(l1_text_data)
+            l2_lengths, l2_torch_data = self.l2_collator(l2_text_data)
+            assert lengths == l2_lengths
+            yield lengths, l1_torch_data, l2_torch_data, l1_text_data, l2_text_data
+
+
+def compiled_corpus_files(prefix):
+    # token ids are raw int32, the index is (num_sents, 3) int64: (token offset, length incl. bos/eos, byte offset in source)
+    return {'l1': prefix + '.l1.bin',
+            'l2': prefix + '.l2.bin',
+            'idx': prefix + '.idx.npy',
+            'meta': prefix + '.meta.json'}
+
+
+class CompiledCorpus(object):
+    def __init__(self, prefix):
+        files = compiled_corpus_files(prefix)
+        with open(files['meta'], 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.index = np.load(files['idx'], mmap_mode='r')
+        self.l1_ids = np.memmap(files['l1'], dtype=np.int32, mode='r') if self.index.shape[0] > 0 else None
+        if self.meta['parallel'] and self.index.shape[0] > 0:
+            self.l2_ids = np.memmap(files['l2'], dtype=np.int32, mode='r')
+        else:
+            self.l2_ids = None
+        self.lengths = np.asarray(self.index[:, 1])
+        self._source = None
+
+    def __len__(self,):
+        return self.index.shape[0]
+
+    def __getstate__(self,):
+        state = self.__dict__.copy()
+        state['_source'] = None
+        return state
+
+    def gather(self, ids, rows):
+        offsets = self.index[rows, 0]
+        lengths = self.lengths[rows]
+        pos = np.arange(lengths.max())
+        mask = pos[None, :] < lengths[:, None]
+        out = np.zeros(mask.shape, dtype=np.int64)
+        out[mask] = ids[(offsets[:, None] + pos[None, :])[mask]]
+        return torch.from_numpy(out)
+
+    def text(self, rows):
+        assert not self.meta.get('compressed', False), "random access text needs an uncompressed source"
+        if self._source is None:
+            with open(self.meta['source'], 'rb') as f:
+                self._source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        l1_text, l2_text = [], []
+        for r in rows:
+            start = int(self.index[r, 2])
+            end = self._source.find(b'\n', start)
+            line = self._source[start: end if end > -1 else len(self._source)].decode('utf-8')
+            lines = line.strip().split('|||')
+            l1_text.append(lines[0])
+            l2_text.append(lines[1] if len(lines) == 2 else None)
+        return l1_text, l2_text
+
+
+class MMapTextDataset(object):
+    def __init__(self,
+                 corpus_prefix,
+                 shuffle,
+                 sort_by_len,
+                 min_batch_size,
+                 return_text=False):
+        if min_batch_size > 1:
+            assert sort_by_len
+        self.corpus = CompiledCorpus(corpus_prefix)
+        self.return_text = return_text
+        self.sampler = TokenBudgetBatchSampler(self.corpus.lengths, min_batch_size, shuffle, sort_by_len)
+        self.num_batches = len(self.sampler)
+        self.p = 0.0
+
+    def set_mask_rate(self, p):
+        self.p = p
+
+    def batch_plan(self, rng=random):
+        for min_batch in self.sampler.batch_plan(rng):
+            yield min_batch
+
+    def collate(self, rows):
+        lengths = self.corpus.lengths[rows].tolist()
+        torch_data = self.corpus.gather(self.corpus.l1_ids, rows)
+        l1_text_data = self.corpus.text(rows)[0] if self.return_text else [None] * len(lengths)
+        return lengths, torch_data, l1_text_data
+
+    def __iter__(self,):
+        for rows in self.batch_plan():
+            yield self.collate(rows)
+
+
+class MMapParallelTextDataset(object):
+    def __init__(self, corpus_prefix):
+        self.corpus = CompiledCorpus(corpus_prefix)
+        assert self.corpus.meta['parallel']
+
+    def source_text(self,):
+        # compressed sources cannot be seeked into, stream them alongside the rows instead
+        with open_corpus(self.corpus.meta['source']) as f:
+            for line in f:
+                if line[0] == '#':
+                    continue
+                l1_line, l2_line = line.strip().split('|||')
+                yield [l1_line], [l2_line]
+
+    def __iter__(self,):
+        source_text = self.source_text() if self.corpus.meta.get('compressed', False) else None
+        for r in range(len(self.corpus)):
+            rows = np.array([r])
+            lengths = self.corpus.lengths[rows].tolist()
+            l1_torch_data = self.corpus.gather(self.corpus.l1_ids, rows)
+            l2_torch_data = self.corpus.gather(self.corpus.l2_ids, rows)
+            if source_text is not None:
+                l1_text_data, l2_text_data = next(source_text)
+            else:
+                l1_text_data, l2_text_data = self.corpus.text(rows)
             yield lengths, l1_torch_data, l2_torch_data, l1_text_data, l2_text_data
+
+
+def prepare_batch(dataset, spec, batch_seed, mask_val, pad_idx):
+    lengths, data, text_data = dataset.collate(spec)
+    ind = data.ne(pad_idx).long()
+    if mask_val is not None:
+        # seeded per batch so the masks do not depend on which worker built the batch
+        generator = torch.Generator()
+        generator.manual_seed(batch_seed)
+        mask = make_random_mask(data, lengths, mask_val, pad_idx, generator)
+    else:
+        mask = None
+    return lengths, data, text_data, ind, mask
+
+
+def _prefetch_worker(dataset, in_q, out_q, done, mask_val, pad_idx):
+    torch.set_num_threads(1)
+    while True:
+        item = in_q.get()
+        if item is None:
+            out_q.put(None)
+            # tensors are passed as shared memory handles owned by this process,
+            # stay alive until the consumer has unpickled every batch
+            done.wait()
+            break
+        batch_seed, spec = item
+        out_q.put(prepare_batch(dataset, spec, batch_seed, mask_val, pad_idx))
+
+
+def _put_unless_stopped(q, item, stop):
+    # a blocking put that gives up once stop is set, so a consumer that went away can not hang the producer
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _drain(q):
+    try:
+        while True:
+            q.get_nowait()
+    except queue.Empty:
+        pass
+
+
+class BatchPrefetcher(object):
+    def __init__(self, dataset, num_workers, queue_depth, seed, mask_val=None, pad_idx=0, rank=0, world_size=1):
+        # batch i is always built by worker i % num_workers and read back in order,
+        # so the stream is identical for any num_workers given the same seed.
+        self.dataset = dataset
+        self.num_workers = num_workers
+        self.queue_depth = queue_depth
+        self.seed = seed
+        self.mask_val = mask_val
+        self.pad_idx = pad_idx
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self.skip = 0
+        self._running = None
+
+    def batch_seed(self, batch_idx):
+        return self.seed + 1000003 * self.epoch + batch_idx
+
+    def plan_rng(self,):
+        # the batch plan shuffles with its own rng seeded from (seed, epoch): it does not share the global
+        # random with the training loop, so the plan does not depend on thread timing and replays on resume
+        return random.Random(self.seed + 1000003 * self.epoch)
+
+    def batch_plan(self, skip=0, rng=random):
+        # with world_size > 1 every rank walks the same seeded plan and keeps a strided share of each batch,
+        # so all ranks take the same number of steps and together see the full batch.
+        # batches with fewer sentences than ranks are dropped on every rank.
+        # the first skip batches are planned (so the rng moves as usual) but not built
+        batch_idx = 0
+        for spec in self.dataset.batch_plan(rng):
+            if self.world_size > 1:
+                if len(spec) < self.world_size:
+                    continue
+                spec = spec[self.rank::self.world_size]
+            if batch_idx >= skip:
+                yield batch_idx, spec
+            batch_idx += 1
+
+    def _feed(self, in_qs, skip, rng, stop):
+        plan = self.batch_plan(skip, rng)
+        try:
+            for i, (batch_idx, spec) in enumerate(plan):
+                if not _put_unless_stopped(in_qs[i % self.num_workers], (self.batch_seed(batch_idx), spec), stop):
+                    return
+            for in_q in in_qs:
+                _put_unless_stopped(in_q, None, stop)
+        finally:
+            plan.close()  # shuts down the shard readers of a plan left part way
+
+    def __iter__(self,):
+        # set skip before iterating to resume an epoch part way, it only applies to that epoch
+        self.epoch += 1
+        skip, self.skip = self.skip, 0
+        rng = self.plan_rng()
+        if self.num_workers == 0:
+            for batch_idx, spec in self.batch_plan(skip, rng):
+                yield prepare_batch(self.dataset, spec, self.batch_seed(batch_idx), self.mask_val, self.pad_idx)
+            return
+        self.close()
+        in_qs = [mp.Queue(self.queue_depth) for _ in range(self.num_workers)]
+        out_qs = [mp.Queue(self.queue_depth) for _ in range(self.num_workers)]
+        done = mp.Event()
+        stop = threading.Event()
+        workers = [mp.Process(target=_prefetch_worker,
+                              args=(self.dataset, in_qs[w], out_qs[w], done, self.mask_val, self.pad_idx),
+                              daemon=True)
+                   for w in range(self.num_workers)]
+        for w in workers:
+            w.start()
+        # the batch plan (file reading, sorting, shuffling) stays in this process, in a feeder thread
+        feeder = threading.Thread(target=self._feed, args=(in_qs, skip, rng, stop), daemon=True)
+        self._running = (feeder, stop, done, workers, in_qs, out_qs)
+        feeder.start()
+        try:
+            batch_idx = 0
+            while True:
+                item = out_qs[batch_idx % self.num_workers].get()
+                if item is None:
+                    break
+                yield item
+                batch_idx += 1
+        finally:
+            self.close()
+
+    def close(self,):
+        """
+        stops the feeder thread and the workers of the current epoch. runs when the epoch ends and when the
+        training loop leaves it early (exception, early stop), calling it again is a no-op
+        """
+        if self._running is None:
+            return False
+        feeder, stop, done, workers, in_qs, out_qs = self._running
+        self._running = None
+        stop.set()
+        for in_q in in_qs:
+            _drain(in_q)  # frees a feeder blocked on a full queue
+        feeder.join()
+        done.set()
+        for in_q in in_qs:
+            _drain(in_q)
+            try:
+                in_q.put_nowait(None)
+            except queue.Full:
+                pass
+        for w in workers:
+            w.join(timeout=1.0)
+            if w.is_alive():
+                w.terminate()
+            w.join()
+        for q in in_qs + out_qs:
+            q.cancel_join_thread()  # a terminated worker may leave unread items, do not wait on them at exit
+            q.close()
+        return True
+
+    def __del__(self,):
+        if getattr(self, '_running', None) is not None:
+            self.close()
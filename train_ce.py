@@ -9,9 +9,21 @@ import time
 import torch
 from src.utils.utils import SPECIAL_TOKENS
 from src.utils.utils import TextDataset
+from src.utils.utils import MMapTextDataset
+from src.utils.utils import BatchPrefetcher
+from src.utils.utils import load_mat
+from src.utils.bundle import ArtifactBundle
+from src.utils.distributed import init_distributed
+from src.utils.distributed import broadcast_params
+from src.utils.distributed import all_reduce_sum
+from src.utils.distributed import format_throughput
+from src.utils.checkpoint import save_checkpoint
+from src.utils.checkpoint import load_checkpoint
+from src.utils.checkpoint import snapshot_module
+from src.utils.checkpoint import AsyncWriter
 
 from src.models.ce_model import CE_CLOZE
-from src.models.ce_model import spell2mat
+from src.models.ce_model import load_spelling_mat
 from src.models.ce_model import TiedEncoderDecoder, CharTiedEncoderDecoder, CGramTiedEncoderDecoder
 from src.models.ce_model import ClozeContextEncoder, ClozeMaskContextEncoder, LMContextEncoder
 from src.models.model_untils import make_context_encoder
@@ -26,6 +38,8 @@ def do_dev_batch(model, dev_data, nsc, prev_dev_acc_mu):
     model.eval()
     print('num_updates', num_updates)
     for batch_idx, batch in enumerate(dev_data):
+        if batch_idx % world_size != rank:
+            continue
         l, data, text_data = batch
         ind = torch.ones_like(data).long()
         if model.is_cuda():
@@ -38,14 +52,18 @@ def do_dev_batch(model, dev_data, nsc, prev_dev_acc_mu):
             del _loss
         dev_losses.append(loss)
         dev_accs.append(acc)
-    dev_acc_mu = np.mean(dev_accs)
-    dev_losses_mu = np.mean(dev_losses)
+    # averaged over all ranks so that every rank saves/stops on the same numbers
+    sums = all_reduce_sum([sum(dev_accs), sum(dev_losses), len(dev_losses)])
+    dev_acc_mu = sums[0] / sums[2]
+    dev_losses_mu = sums[1] / sums[2]
     print("AveDevLoss:{:7.6f} AveDecAcc:{:.3f}\r".format(dev_losses_mu, dev_acc_mu))
     save_name = 'best'
     if options.save_folder is not None:
         if dev_acc_mu > prev_dev_acc_mu:
             print('saving model...', dev_acc_mu, 'greater than', prev_dev_acc_mu)
-            model.save_model(os.path.join(options.save_folder, save_name + '.model'))
+            if rank == 0:
+                checkpoint_writer.submit(snapshot_module(model),
+                                         os.path.join(options.save_folder, save_name + '.model'))
             prev_dev_acc_mu = dev_acc_mu
             nsc = 0
         else:
@@ -64,6 +82,13 @@ if __name__ == '__main__':
                      help='folder to save the model after every epoch')
     opt.add_argument('--train_corpus', action='store', dest='train_corpus', required=True)
     opt.add_argument('--dev_corpus', action='store', dest='dev_corpus', required=False, default=None)
+    opt.add_argument('--corpus_format', action='store', dest='corpus_format', default='text',
+                     choices=['text', 'mmap'],
+                     help='mmap expects --train_corpus/--dev_corpus to be prefixes written by compile_corpus.py')
+    opt.add_argument('--length_index', action='store', dest='length_index', default=1, type=int, choices=[0, 1],
+                     help='batch text corpora from a cached length index instead of sorting 100k-line windows')
+    opt.add_argument('--num_readers', action='store', dest='num_readers', default=4, type=int,
+                     help='parallel reader processes when --train_corpus is a shard directory or glob')
     opt.add_argument('--v2i', action='store', dest='v2i', required=True,
                      help='vocab to index pickle obj')
     opt.add_argument('--v2cgramspell', action='store', dest='v2cgramspell', required=True,
@@ -77,6 +102,8 @@ if __name__ == '__main__':
     opt.add_argument('--model_size', action='store',
                      type=int, dest='model_size', default=100)
     opt.add_argument('--batch_size', action='store', type=int, dest='batch_size', default=20)
+    opt.add_argument('--max_tokens', action='store', type=int, dest='max_tokens', default=None,
+                     help='backprop each batch in micro-batches of at most this many (padded) tokens, one update per batch')
     opt.add_argument('--loss_at', action='store', type=str,
                      choices=['all', 'noise'], required=True)
     opt.add_argument('--gpuid', action='store', type=int, dest='gpuid', default=-1)
@@ -85,12 +112,20 @@ if __name__ == '__main__':
                      choices=[1, 2, 3], default=1)
     opt.add_argument('--num_layers', action='store', type=int, dest='num_layers', default=1)
     opt.add_argument('--seed', action='store', dest='seed', default=1234, type=int)
+    opt.add_argument('--num_workers', action='store', dest='num_workers', default=0, type=int,
+                     help='processes that build padded batches ahead of training (0=inline)')
+    opt.add_argument('--prefetch_depth', action='store', dest='prefetch_depth', default=4, type=int,
+                     help='max ready batches queued per worker')
     opt.add_argument('--use_early_stop', action='store', dest='use_early_stop',
                      default=1, type=int, choices=set([0, 1]))
     opt.add_argument('--context_encoder', action='store', dest='context_encoder',
                      choices=['cloze', 'cloze_mask', 'lm'], required=True)
     opt.add_argument('--checkpoint_freq', action='store', required=True,
                      dest='checkpoint_freq', type=int, default=10)
+    opt.add_argument('--ckpt_every', action='store', dest='ckpt_every', default=0, type=int,
+                     help='write a resumable checkpoint (save_dir/last.ckpt) every N batches and after every epoch (0=off)')
+    opt.add_argument('--resume', action='store', dest='resume', default=None,
+                     help='checkpoint written with --ckpt_every to continue training from')
     opt.add_argument('--char_aware', action='store', required=False, choices=[0, 1, 2],
                      dest='char_aware', type=int, default=0)
     opt.add_argument('--pool_type', action='store',
@@ -101,12 +136,28 @@ if __name__ == '__main__':
                      type=int, choices=[0, 1], required=True)
     opt.add_argument('--vmat', action='store', dest='vmat', required=True,
                      help='l1 word embeddings')
+    opt.add_argument('--bundle', action='store', dest='bundle', required=False, default=None,
+                     help='artifact bundle from preprocess.py --bundle, the files named by the vocab/matrix/spelling flags are read from it')
+    opt.add_argument('--sampled_softmax', action='store', dest='sampled_softmax', default=0, type=int,
+                     help='train against this many negatives sampled from --unigram_prob instead of the full vocab (0=full softmax), dev uses the full softmax')
+    opt.add_argument('--adaptive_softmax', action='store', dest='adaptive_softmax', default=None,
+                     help='comma separated frequency rank cutoffs (e.g. 2000,10000) of an adaptive softmax over the words of --unigram_prob, used for training and dev')
+    opt.add_argument('--unigram_prob', action='store', dest='unigram_prob', required=False, default=None,
+                     help='l1.vidx2unigram_prob.pkl, the sampling distribution for --sampled_softmax and the word frequencies for --adaptive_softmax')
+    opt.add_argument('--scaling_baseline', action='store', dest='scaling_baseline', default=None, type=float,
+                     help='sentences/s printed by a 1-rank run of the same job, multi-rank runs then also print the scaling efficiency against it')
+    opt.add_argument('--precision', action='store', dest='precision', default='fp32',
+                     choices=['fp32', 'bf16', 'fp16'],
+                     help='bf16/fp16 run the forward matmuls under autocast, weights, optimizer state and loss stay fp32')
     options = opt.parse_args()
     print(options)
     assert 0.0 <= options.lang_bit_ratio <= 1.0, " lang_bit_ratio should be [0,1.0]"
     torch.manual_seed(options.seed)
     random.seed(options.seed)
     np.random.seed(options.seed)
+    # launched with torchrun --nproc_per_node N every rank trains on its share of each batch
+    rank, world_size = init_distributed()
+    assert world_size == 1 or options.gpuid == -1, "distributed training runs on cpu (gloo)"
     if options.gpuid > -1:
         torch.cuda.set_device(options.gpuid)
         tmp = torch.ByteTensor([0])
@@ -115,33 +166,36 @@ if __name__ == '__main__':
     else:
         print("using CPU")
 
-    v2i = pickle.load(open(options.v2i, 'rb'))
-    i2v = {v: k for k, v in v2i.items()}
+    bundle = ArtifactBundle(options.bundle) if options.bundle is not None else None
+    if bundle is not None:
+        v2i, i2v = bundle.vocab(options.v2i)
+    else:
+        v2i = pickle.load(open(options.v2i, 'rb'))
+        i2v = {v: k for k, v in v2i.items()}
     assert len(v2i) == len(i2v)
     vocab_size = len(v2i)
-    v2i = pickle.load(open(options.v2i, 'rb'))
-    i2v = {v: k for k, v in v2i.items()}
-    assert len(v2i) == len(i2v)
 
     #load cgrams
     cgram_files = options.cgram2i.split(',')
     cgram2i_list = []
     i2cgram_list = []
     for cgram_file in cgram_files:
-        cngram2i = pickle.load(open(cgram_file, 'rb'))
-        i2cngram = {v: k for k, v in cngram2i.items()}
+        if bundle is not None:
+            cngram2i, i2cngram = bundle.vocab(cgram_file)
+        else:
+            cngram2i = pickle.load(open(cgram_file, 'rb'))
+            i2cngram = {v: k for k, v in cngram2i.items()}
         cgram2i_list.append(cngram2i)
         i2cgram_list.append(i2cngram)
     v2cgramspell_files = options.v2cgramspell.split(',')
     cgram_spelling_mat_list = []
     for v2cgramspell_file in v2cgramspell_files:
-        f = pickle.load(open(v2cgramspell_file, 'rb'))
-        m = spell2mat(f)
+        m = bundle.array(v2cgramspell_file) if bundle is not None else load_spelling_mat(v2cgramspell_file)
         assert vocab_size == m.shape[0]
         cgram_spelling_mat_list.append(m)
 
     if options.embedding_pretrain == 1:
-        vmat = torch.load(options.vmat)
+        vmat = bundle.array(options.vmat) if bundle is not None else load_mat(options.vmat)
     else:
         vmat = None
 
@@ -181,11 +235,21 @@ if __name__ == '__main__':
                                                   mode='l1', vmat=vmat)
         tied_encoder_decoder.param_type = 'l1'
 
-    train_dataset = TextDataset(options.train_corpus, v2i, shuffle=True, sort_by_len=True,
-                                min_batch_size=options.batch_size)
+    if options.corpus_format == 'mmap':
+        train_dataset = MMapTextDataset(options.train_corpus, shuffle=True, sort_by_len=True,
+                                        min_batch_size=options.batch_size)
+    else:
+        train_dataset = TextDataset(options.train_corpus, v2i, shuffle=True, sort_by_len=True,
+                                    min_batch_size=options.batch_size, length_index=options.length_index == 1,
+                                    num_readers=options.num_readers,
+                                    pin_memory=options.gpuid > -1 and options.num_workers == 0)
     if options.dev_corpus is not None:
-        dev_dataset = TextDataset(options.dev_corpus, v2i, shuffle=False, sort_by_len=True,
-                                  min_batch_size=2000)
+        if options.corpus_format == 'mmap':
+            dev_dataset = MMapTextDataset(options.dev_corpus, shuffle=False, sort_by_len=True,
+                                          min_batch_size=2000)
+        else:
+            dev_dataset = TextDataset(options.dev_corpus, v2i, shuffle=False, sort_by_len=True,
+                                      min_batch_size=2000, length_index=options.length_index == 1)
     if options.context_encoder == 'cloze_mask':
         context_encoder = ClozeMaskContextEncoder(input_size=options.embedding_size,
                                                   rnn_size=options.model_size,
@@ -209,6 +273,18 @@ if __name__ == '__main__':
 
     if options.gpuid > -1:
         simulation_model.init_cuda()
+    simulation_model.set_precision(options.precision)
+    if options.sampled_softmax > 0:
+        assert options.unigram_prob is not None, "--sampled_softmax needs --unigram_prob"
+        simulation_model.set_sampled_softmax(pickle.load(open(options.unigram_prob, 'rb')), options.sampled_softmax)
+    if options.adaptive_softmax is not None:
+        assert options.unigram_prob is not None, "--adaptive_softmax needs --unigram_prob"
+        simulation_model.set_adaptive_softmax(pickle.load(open(options.unigram_prob, 'rb')),
+                                              [int(c) for c in options.adaptive_softmax.split(',')])
+    if world_size > 1:
+        broadcast_params(simulation_model)
+        torch.manual_seed(options.seed + rank)  # same weights, different dropout per rank
+        print('rank', rank, 'of', world_size)
 
     print(simulation_model)
     for n, p in simulation_model.named_parameters():
@@ -217,23 +293,51 @@ if __name__ == '__main__':
     print(sum([p.numel() for p in simulation_model.parameters()]), ' parameters ( if char_aware spelling_mat is not learnable)')
     ave_time = 0.
     s = time.time()
-    total_batches = 0  # train_dataset.num_batches
+    total_batches = train_dataset.num_batches
     early_stops = []
     num_updates = 0
     prev_dev_acc_mu = 0
     nsc = 0
-    for epoch in range(options.epochs):
-        for batch_idx, batch in enumerate(train_dataset):
+    train_batches = BatchPrefetcher(train_dataset, options.num_workers, options.prefetch_depth, options.seed,
+                                    pad_idx=v2i[SPECIAL_TOKENS.PAD], rank=rank, world_size=world_size)
+    ckpt_file = os.path.join(options.save_folder, 'last.ckpt')
+    # models and checkpoints are written in the background while training continues
+    checkpoint_writer = AsyncWriter()
+    start_epoch = 0
+    ckpt = None
+    if options.resume is not None:
+        ckpt = load_checkpoint(options.resume, simulation_model, rank)
+        start_epoch = ckpt['epoch']
+        num_updates = ckpt['loop_state']['num_updates']
+        prev_dev_acc_mu = ckpt['loop_state']['prev_dev_acc_mu']
+        nsc = ckpt['loop_state']['nsc']
+        train_batches.epoch = start_epoch
+        print('resuming from', options.resume, 'epoch', start_epoch, 'batch', ckpt['batch_idx'])
+    for epoch in range(start_epoch, options.epochs):
+        if ckpt is not None and ckpt['batch_idx'] > 0:
+            # part way into this epoch, the batches done before the checkpoint are skipped
+            epoch_rng = ckpt['epoch_rng']
+            train_batches.skip = ckpt['batch_idx']
+        else:
+            epoch_rng = {'python': random.getstate(), 'numpy': np.random.get_state()}
+        ckpt = None
+        num_sents = 0
+        epoch_start = time.time()
+        # a resumed epoch whose batches were all done before the checkpoint yields nothing
+        batch_idx = train_batches.skip - 1
+        for batch_idx, batch in enumerate(train_batches, train_batches.skip):
             simulation_model.train()
-            l, data, text_data = batch
-            ind = data.ne(v2i[SPECIAL_TOKENS.PAD]).long()
+            l, data, text_data, ind, _ = batch
             if simulation_model.is_cuda():
-                data = data.cuda()
+                data = data.cuda(non_blocking=True)
                 ind = ind.cuda()
             cuda_batch = l, data, data, ind
-            loss, grad_norm, acc = simulation_model.train_step(cuda_batch)
+            loss, grad_norm, acc = simulation_model.train_step(cuda_batch, options.max_tokens)
             num_updates += 1
-            if batch_idx % 100 == 0 and batch_idx > 0:
+            num_sents += len(l)
+            if rank > 0:
+                pass
+            elif batch_idx % 100 == 0 and batch_idx > 0:
                 e = time.time()
                 ave_time = (e - s) / 100.
                 s = time.time()
@@ -256,8 +360,20 @@ if __name__ == '__main__':
             if num_updates % options.checkpoint_freq == 0 and epoch > 1:
                 continue_train, prev_dev_acc_mu, nsc = do_dev_batch(simulation_model, dev_dataset, nsc, prev_dev_acc_mu)
                 if not continue_train:
+                    checkpoint_writer.wait()
                     exit()
-        total_batches = batch_idx
+            if options.ckpt_every > 0 and (batch_idx + 1) % options.ckpt_every == 0:
+                save_checkpoint(ckpt_file, simulation_model, epoch, batch_idx + 1, epoch_rng, checkpoint_writer,
+                                num_updates=num_updates, prev_dev_acc_mu=prev_dev_acc_mu, nsc=nsc)
+        total_batches = batch_idx + 1
+        num_sents, = all_reduce_sum([num_sents])
+        if rank == 0:
+            print(format_throughput(epoch, num_sents / (time.time() - epoch_start), world_size,
+                                    options.scaling_baseline))
         _, prev_dev_acc_mu, nsc = do_dev_batch(simulation_model, dev_dataset, nsc, prev_dev_acc_mu)
+        if options.ckpt_every > 0:
+            save_checkpoint(ckpt_file, simulation_model, epoch + 1, 0, writer=checkpoint_writer,
+                            num_updates=num_updates, prev_dev_acc_mu=prev_dev_acc_mu, nsc=nsc)
         #if not continue_train:
         #    exit()
+    checkpoint_writer.wait()
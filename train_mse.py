@@ -9,19 +9,23 @@ import time
 import torch
 from src.utils.utils import SPECIAL_TOKENS
 from src.utils.utils import TextDataset
+from src.utils.utils import MMapTextDataset
+from src.utils.utils import BatchPrefetcher
+from src.utils.utils import load_mat
+from src.utils.bundle import ArtifactBundle
+from src.utils.distributed import init_distributed
+from src.utils.distributed import broadcast_params
+from src.utils.distributed import all_reduce_sum
+from src.utils.distributed import format_throughput
+from src.utils.checkpoint import save_checkpoint
+from src.utils.checkpoint import load_checkpoint
+from src.utils.checkpoint import snapshot_module
+from src.utils.checkpoint import AsyncWriter
+from src.utils.utils import make_random_mask
 
 from src.models.mse_model import MSE_CLOZE
 from src.models.model_untils import make_context_encoder
 
-def make_random_mask(data, lengths, mask_val, pad_idx):
-    drop_num = int(lengths[-1] * mask_val)
-    mask = data.eq(pad_idx)
-    if drop_num > 0:
-        drop_samples_col = torch.multinomial(torch.ones(data.shape[0], lengths[-1]), drop_num)
-        drop_samples_row = torch.arange(data.shape[0]).unsqueeze(1).expand_as(drop_samples_col)
-        mask[drop_samples_row, drop_samples_col] = 1
-    return mask
-
 
 if __name__ == '__main__':
     opt = argparse.ArgumentParser(description="write program description here")
@@ -30,10 +34,24 @@ if __name__ == '__main__':
                      help='folder to save the model after every epoch')
     opt.add_argument('--train_corpus', action='store', dest='train_corpus', required=True)
     opt.add_argument('--dev_corpus', action='store', dest='dev_corpus', required=False, default=None)
+    opt.add_argument('--corpus_format', action='store', dest='corpus_format', default='text',
+                     choices=['text', 'mmap'],
+                     help='mmap expects --train_corpus/--dev_corpus to be prefixes written by compile_corpus.py')
+    opt.add_argument('--length_index', action='store', dest='length_index', default=1, type=int, choices=[0, 1],
+                     help='batch text corpora from a cached length index instead of sorting 100k-line windows')
+    opt.add_argument('--num_readers', action='store', dest='num_readers', default=4, type=int,
+                     help='parallel reader processes when --train_corpus is a shard directory or glob')
     opt.add_argument('--v2i', action='store', dest='v2i', required=True,
                      help='vocab to index pickle obj')
     opt.add_argument('--vmat', action='store', dest='vmat', required=True,
                      help='l1 word embeddings')
+    opt.add_argument('--bundle', action='store', dest='bundle', required=False, default=None,
+                     help='artifact bundle from preprocess.py --bundle, the files named by the vocab/matrix/spelling flags are read from it')
+    opt.add_argument('--scaling_baseline', action='store', dest='scaling_baseline', default=None, type=float,
+                     help='sentences/s printed by a 1-rank run of the same job, multi-rank runs then also print the scaling efficiency against it')
+    opt.add_argument('--precision', action='store', dest='precision', default='fp32',
+                     choices=['fp32', 'bf16', 'fp16'],
+                     help='bf16/fp16 run the forward matmuls under autocast, weights, optimizer state and loss stay fp32')
     opt.add_argument('--v2spell', action='store', dest='v2spell', required=True,
                      help='vocab to spelling pickle obj')
     opt.add_argument('--c2i', action='store', dest='c2i', required=True,
@@ -42,6 +60,8 @@ if __name__ == '__main__':
     opt.add_argument('--context_encoder_type', action='store', type=str, dest='context_encoder_type',
                      required=True, choices=['RNN', 'Attention'])
     opt.add_argument('--batch_size', action='store', type=int, dest='batch_size', default=20)
+    opt.add_argument('--max_tokens', action='store', type=int, dest='max_tokens', default=None,
+                     help='backprop each batch in micro-batches of at most this many (padded) tokens, one update per batch')
     opt.add_argument('--loss_type', action='store', type=str,
                      choices=['ce', 'cs', 'cs_margin', 'mse', 'huber'], required=True)
     opt.add_argument('--loss_at', action='store', type=str,
@@ -59,13 +79,24 @@ if __name__ == '__main__':
     opt.add_argument('--nn_mat', action='store', type=str, dest='nn_mat')
     opt.add_argument('--nn_mat_size', action='store', type=int, dest='nn_mat_size', default=20)
     opt.add_argument('--seed', action='store', dest='seed', default=1234, type=int)
+    opt.add_argument('--num_workers', action='store', dest='num_workers', default=0, type=int,
+                     help='processes that build padded batches and noise masks ahead of training (0=inline)')
+    opt.add_argument('--prefetch_depth', action='store', dest='prefetch_depth', default=4, type=int,
+                     help='max ready batches queued per worker')
     opt.add_argument('--use_early_stop', action='store',
                      dest='use_early_stop', default=1, type=int, choices=set([0, 1]))
+    opt.add_argument('--ckpt_every', action='store', dest='ckpt_every', default=0, type=int,
+                     help='write a resumable checkpoint (save_dir/last.ckpt) every N batches and after every epoch (0=off)')
+    opt.add_argument('--resume', action='store', dest='resume', default=None,
+                     help='checkpoint written with --ckpt_every to continue training from')
     options = opt.parse_args()
     print(options)
     torch.manual_seed(options.seed)
     random.seed(options.seed)
     np.random.seed(options.seed)
+    # launched with torchrun --nproc_per_node N every rank trains on its share of each batch
+    rank, world_size = init_distributed()
+    assert world_size == 1 or options.gpuid == -1, "distributed training runs on cpu (gloo)"
     if options.gpuid > -1:
         torch.cuda.set_device(options.gpuid)
         tmp = torch.ByteTensor([0])
@@ -74,25 +105,36 @@ if __name__ == '__main__':
     else:
         print("using CPU")
 
-    v2i = pickle.load(open(options.v2i, 'rb'))
-    i2v = {v: k for k, v in v2i.items()}
+    bundle = ArtifactBundle(options.bundle) if options.bundle is not None else None
+    if bundle is not None:
+        v2i, i2v = bundle.vocab(options.v2i)
+    else:
+        v2i = pickle.load(open(options.v2i, 'rb'))
+        i2v = {v: k for k, v in v2i.items()}
     assert len(v2i) == len(i2v)
     vocab_size = len(v2i)
-    v2i = pickle.load(open(options.v2i, 'rb'))
-    i2v = {v: k for k, v in v2i.items()}
-    assert len(v2i) == len(i2v)
 
-    vmat = torch.load(options.vmat)
+    vmat = bundle.array(options.vmat) if bundle is not None else load_mat(options.vmat)
     assert vmat.shape[0] == vocab_size
     emb_dim = vmat.shape[1]
     l1_encoder = torch.nn.Embedding(vocab_size, emb_dim)
     l1_encoder.weight.data = vmat
 
-    train_dataset = TextDataset(options.train_corpus, v2i, shuffle=True, sort_by_len=True,
-                                min_batch_size=options.batch_size)
+    if options.corpus_format == 'mmap':
+        train_dataset = MMapTextDataset(options.train_corpus, shuffle=True, sort_by_len=True,
+                                        min_batch_size=options.batch_size)
+    else:
+        train_dataset = TextDataset(options.train_corpus, v2i, shuffle=True, sort_by_len=True,
+                                    min_batch_size=options.batch_size, length_index=options.length_index == 1,
+                                    num_readers=options.num_readers,
+                                    pin_memory=options.gpuid > -1 and options.num_workers == 0)
     if options.dev_corpus is not None:
-        dev_dataset = TextDataset(options.dev_corpus, v2i, shuffle=False, sort_by_len=True,
-                                  min_batch_size=2000)
+        if options.corpus_format == 'mmap':
+            dev_dataset = MMapTextDataset(options.dev_corpus, shuffle=False, sort_by_len=True,
+                                          min_batch_size=2000)
+        else:
+            dev_dataset = TextDataset(options.dev_corpus, v2i, shuffle=False, sort_by_len=True,
+                                      min_batch_size=2000, length_index=options.length_index == 1)
     #if options.use_orthographic_model == 1:
     #    print('MSE_ORTHOGRAPHIC_CLOZE mode 1')
     #    simulation_model = MSE_ORTHOGRAPHIC_CLOZE(input_size=emb_dim,
@@ -134,30 +176,63 @@ if __name__ == '__main__':
 
     if options.gpuid > -1:
         simulation_model.init_cuda()
+    simulation_model.set_precision(options.precision)
+    if world_size > 1:
+        broadcast_params(simulation_model)
+        torch.manual_seed(options.seed + rank)  # same weights, different noise per rank
+        print('rank', rank, 'of', world_size)
 
     print(simulation_model)
     print(sum([p.numel() for p in simulation_model.parameters() if p.requires_grad]), ' learnable parameters')
     print(sum([p.numel() for p in simulation_model.parameters()]), ' parameters')
     ave_time = 0.
     s = time.time()
-    total_batches = 0  # train_dataset.num_batches
+    total_batches = train_dataset.num_batches
     mask_val = options.mask_val
     early_stops = []
-    for epoch in range(options.epochs):
+    train_batches = BatchPrefetcher(train_dataset, options.num_workers, options.prefetch_depth, options.seed,
+                                    mask_val=mask_val, pad_idx=v2i[SPECIAL_TOKENS.PAD],
+                                    rank=rank, world_size=world_size)
+    ckpt_file = os.path.join(options.save_folder, 'last.ckpt')
+    # models and checkpoints are written in the background while training continues
+    checkpoint_writer = AsyncWriter()
+    start_epoch = 0
+    ckpt = None
+    if options.resume is not None:
+        ckpt = load_checkpoint(options.resume, simulation_model, rank)
+        start_epoch = ckpt['epoch']
+        early_stops = ckpt['loop_state']['early_stops']
+        train_batches.epoch = start_epoch
+        print('resuming from', options.resume, 'epoch', start_epoch, 'batch', ckpt['batch_idx'])
+    for epoch in range(start_epoch, options.epochs):
         simulation_model.train()
-        train_losses = []
-        train_accs = []
-        for batch_idx, batch in enumerate(train_dataset):
-            l, data, text_data = batch
-            ind = data.ne(v2i[SPECIAL_TOKENS.PAD]).long()
-            mask = make_random_mask(data, l, mask_val, v2i[SPECIAL_TOKENS.PAD])
+        if ckpt is not None and ckpt['batch_idx'] > 0:
+            # part way into this epoch, the batches done before the checkpoint are skipped
+            train_losses = ckpt['loop_state']['train_losses']
+            train_accs = ckpt['loop_state']['train_accs']
+            epoch_rng = ckpt['epoch_rng']
+            train_batches.skip = ckpt['batch_idx']
+        else:
+            train_losses = []
+            train_accs = []
+            epoch_rng = {'python': random.getstate(), 'numpy': np.random.get_state()}
+        ckpt = None
+        num_sents = 0
+        epoch_start = time.time()
+        # a resumed epoch whose batches were all done before the checkpoint yields nothing
+        batch_idx = train_batches.skip - 1
+        for batch_idx, batch in enumerate(train_batches, train_batches.skip):
+            l, data, text_data, ind, mask = batch
             if simulation_model.is_cuda():
-                data = data.cuda()
+                data = data.cuda(non_blocking=True)
                 ind = ind.cuda()
                 mask = mask.cuda()
             cuda_batch = l, data, data, ind, mask #mask arg is not used.. TODO: remove it
-            loss, grad_norm, acc = simulation_model.do_backprop(cuda_batch)
-            if batch_idx % 100 == 0 and batch_idx > 0:
+            loss, grad_norm, acc = simulation_model.do_backprop(cuda_batch, options.max_tokens)
+            num_sents += len(l)
+            if rank > 0:
+                pass
+            elif batch_idx % 100 == 0 and batch_idx > 0:
                 e = time.time()
                 ave_time = (e - s) / 100.
                 s = time.time()
@@ -172,13 +247,22 @@ if __name__ == '__main__':
                 pass
             train_losses.append(loss)
             train_accs.append(acc)
-        total_batches = batch_idx
+            if options.ckpt_every > 0 and (batch_idx + 1) % options.ckpt_every == 0:
+                save_checkpoint(ckpt_file, simulation_model, epoch, batch_idx + 1, epoch_rng, checkpoint_writer,
+                                train_losses=train_losses, train_accs=train_accs, early_stops=early_stops)
+        total_batches = batch_idx + 1
+        num_sents, = all_reduce_sum([num_sents])
+        if rank == 0:
+            print(format_throughput(epoch, num_sents / (time.time() - epoch_start), world_size,
+                                    options.scaling_baseline))
         dev_losses = []
         dev_accs = []
         assert options.dev_corpus is not None
         simulation_model.eval()
         print('completed epoch', epoch)
         for batch_idx, batch in enumerate(dev_dataset):
+            if batch_idx % world_size != rank:
+                continue
             l, data, text_data = batch
             mask = make_random_mask(data, l, mask_val, v2i[SPECIAL_TOKENS.PAD])
             ind = torch.ones_like(data).long()
@@ -195,10 +279,13 @@ if __name__ == '__main__':
             dev_losses.append(loss)
             dev_accs.append(acc)
 
-        dev_acc_mu = np.mean(dev_accs)
-        dev_losses_mu = np.mean(dev_losses)
-        train_acc_mu = np.mean(train_accs)
-        train_losses_mu = np.mean(train_losses)
+        # averaged over all ranks so that every rank saves/stops on the same numbers
+        sums = all_reduce_sum([sum(dev_accs), sum(dev_losses), len(dev_losses),
+                               sum(train_accs), sum(train_losses), len(train_losses)])
+        dev_acc_mu = sums[0] / sums[2]
+        dev_losses_mu = sums[1] / sums[2]
+        train_acc_mu = sums[3] / sums[5]
+        train_losses_mu = sums[4] / sums[5]
         print("Ending e{:d} AveTrainLoss:{:7.6f} AveTrainAcc{:.3f} AveDevLoss:{:7.6f} AveDecAcc:{:.3f}\r".format(epoch,
                                                                                                        train_losses_mu,
                                                                                                        train_acc_mu,
@@ -208,11 +295,17 @@ if __name__ == '__main__':
                                                                                      train_losses_mu,
                                                                                      dev_losses_mu,
                                                                                      dev_acc_mu)
-        if options.save_folder is not None:
-            simulation_model.save_model(os.path.join(options.save_folder, save_name + '.model'))
+        if options.save_folder is not None and rank == 0:
+            checkpoint_writer.submit(snapshot_module(simulation_model),
+                                     os.path.join(options.save_folder, save_name + '.model'))
         if options.use_early_stop == 1:
             if epoch > 5 and dev_losses_mu > max(early_stops[-3:]):
                 print('early stopping...')
+                checkpoint_writer.wait()
                 exit()
             else:
                 early_stops.append(dev_losses_mu)
+        if options.ckpt_every > 0:
+            save_checkpoint(ckpt_file, simulation_model, epoch + 1, 0, writer=checkpoint_writer,
+                            early_stops=early_stops)
+    checkpoint_writer.wait()